@@ -1,15 +1,26 @@
-from fastapi import FastAPI, HTTPException, File, Form, UploadFile, Path, Body
+import time
+APP_IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, File, Form, UploadFile, Path, Body, Header
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from models.chat import get_chatbot_response
-import os, shutil, json, re
-from fastapi.responses import FileResponse
+from models.chat import aget_chatbot_response, astream_chatbot_response, astream_chatbot_response_from_file, semantic_cache
+import os, shutil, json, re, threading
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from typing import List, Dict
 from models.user_files import get_user_DB
-from models.raptor_query import RAPTOR, get_files_user
-from models.config import get_llm
-from llama_index.llms.google_genai import GoogleGenAI
+from models.raptor_query import RAPTOR, get_files_user, index_user_file, invalidate_user_query_engine, query_engine_pool, embedding_store, lexical_index
+from models.raptor_query import tombstone_user_file, clear_tombstone, compact_user_collection, remove_shared_document
+from models.config import get_llm, new_llm, llm_cache, llm_rate_limiter, STARTUP_WARM_UP, STARTUP_REQUIRED_COMPONENTS, RAPTOR_INCREMENTAL_INDEXING, INDEX_JOB_WORKERS, INDEX_JOB_HISTORY, RAPTOR_STORAGE_LAYOUT
+from models.config import RAPTOR_DELETE_INLINE_MAX_NODES, RAPTOR_COMPACTION_INTERVAL, COURSE_FILES_DIR
+from models.course_index import CourseManifest, sync_course_index
 from models.web_scraper_query_engine import WebScraperQueryEngine
+from models.intent_classifier import intent_stats
+from models.single_flight import SingleFlight
+from models.text_similarity import question_key
+from models.startup import startup
+from models.index_jobs import IndexJobQueue
+from fastapi.concurrency import run_in_threadpool
 import random
 from datetime import datetime
 
@@ -25,6 +36,9 @@ from models.exercise_utils import (
     generate_random_questions
 )
 
+# Token required by the /admin endpoints (open when unset, e.g. local development)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
 # DIR To Upload file 
 UPLOAD_DIR = os.path.join("models", "uploaded_files")
 EXERCISE_HISTORY_DIR = os.path.join("models", "exercise_history")
@@ -65,9 +79,16 @@ class PracticeQuestionRequest(BaseModel):
 class RandomQuestionRequest(BaseModel):
     count: int = 5
 
-# Khởi tạo LLM và Query Engine
-llm = GoogleGenAI(api_key=os.getenv("GOOGLE_API_KEY"))
-query_engine = WebScraperQueryEngine(llm=llm)
+# Khởi tạo LLM và Query Engine (lazily, see models/startup.py)
+web_query_engine = startup.register("web_query_engine", lambda: WebScraperQueryEngine(llm=get_llm()))
+
+# Identical concurrent requests share one computation
+query_flight = SingleFlight("query")
+chat_flight = SingleFlight("chat")
+chat_with_file_flight = SingleFlight("chat_with_file")
+
+# Uploads are indexed in the background, progress is served by GET /jobs/{job_id}
+index_jobs = IndexJobQueue(max_workers=INDEX_JOB_WORKERS, max_history=INDEX_JOB_HISTORY)
 
 # Story templates
 STORY_TEMPLATES = [
@@ -209,7 +230,12 @@ async def generate_random_questions_endpoint(request: RandomQuestionRequest):
 async def query_ielts_vocabulary(request: QueryRequest):
     """Query IELTS vocabulary based on a user question."""
     try:
-        result = query_engine.custom_query(request.query, request.custom_url)
+        result = await query_flight.do(
+            (question_key(request.query), request.custom_url),
+            lambda: web_query_engine.get().acustom_query(request.query, request.custom_url)
+        )
+        # Concurrent duplicates share the result, copy it before adding exercises
+        result = dict(result)
         
         # Extract vocabulary from the response
         vocabulary = extract_vocabulary(result.get("response", ""))
@@ -274,21 +300,53 @@ class ChatResponse(BaseModel):
     bot_response: str
 
 @app.post("/chat", response_model=ChatResponse)
-def chat_with_bot(request: ChatRequest):
+async def chat_with_bot(request: ChatRequest):
     user_input = request.user_input.strip()
     if not user_input:
         raise HTTPException(status_code=400, detail="Input text cannot be empty.")
 
-    bot_response = get_chatbot_response(f"User: {user_input}\nBot:")
+    bot_response = await chat_flight.do(
+        question_key(user_input),
+        lambda: aget_chatbot_response(f"User: {user_input}\nBot:")
+    )
     return ChatResponse(bot_response=bot_response)
 
+def sse_event(data: dict, event: str | None = None) -> str:
+    """Format one Server-Sent Events message."""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(token_stream) -> StreamingResponse:
+    """Wrap an async token generator into a text/event-stream response."""
+    async def event_stream():
+        try:
+            async for token in token_stream:
+                yield sse_event({"token": token})
+            yield sse_event({}, event="done")
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/chat_stream")
+async def chat_with_bot_stream(request: ChatRequest):
+    user_input = request.user_input.strip()
+    if not user_input:
+        raise HTTPException(status_code=400, detail="Input text cannot be empty.")
+
+    return sse_response(astream_chatbot_response(f"User: {user_input}\nBot:"))
+
 class ChatWithFileRequest(BaseModel):
     user_input: str
     user_id: str
     file_path: List[str]
 
 @app.post("/chat_with_file", response_model=ChatResponse)
-def chat_with_file(request: ChatWithFileRequest):
+async def chat_with_file(request: ChatWithFileRequest):
     user_input = request.user_input.strip()
     file_paths = [fp.strip() for fp in request.file_path]
     user_id = request.user_id.strip()
@@ -297,9 +355,23 @@ def chat_with_file(request: ChatWithFileRequest):
         raise HTTPException(status_code=400, detail="Input text cannot be empty.")
 
     from models.chat import get_chatbot_response_from_file
-    bot_response = get_chatbot_response_from_file(user_input, user_id, file_paths)
+    bot_response = await chat_with_file_flight.do(
+        (user_id, tuple(sorted(file_paths)), question_key(user_input)),
+        lambda: run_in_threadpool(get_chatbot_response_from_file, user_input, user_id, file_paths)
+    )
     return ChatResponse(bot_response=bot_response)
 
+@app.post("/chat_with_file_stream")
+async def chat_with_file_stream(request: ChatWithFileRequest):
+    user_input = request.user_input.strip()
+    file_paths = [fp.strip() for fp in request.file_path]
+    user_id = request.user_id.strip()
+
+    if not user_input:
+        raise HTTPException(status_code=400, detail="Input text cannot be empty.")
+
+    return sse_response(astream_chatbot_response_from_file(user_input, user_id, file_paths))
+
 @app.post("/upload_pdf/")
 def upload_pdf(user_id: str = Form(...), file: UploadFile = File(...)):
     # Check file extension
@@ -312,16 +384,154 @@ def upload_pdf(user_id: str = Form(...), file: UploadFile = File(...)):
     with open(file_path, "wb") as buffer:
         shutil.copyfileobj(file.file, buffer)
 
-    cur_file_paths = os.listdir(os.path.join("models", "uploaded_files", user_id)) or []
+    if RAPTOR_STORAGE_LAYOUT != "dedup":
+        clear_tombstone(user_id, file.filename)
+    job = index_jobs.submit(user_id, file_path, lambda job: index_uploaded_file(job, user_id, file_path))
+
+    return {"message": "Upload thành công", "file_path": file_path, "job_id": job.id}
+
+def index_uploaded_file(job, user_id: str, file_path: str):
+    """Body of an indexing job, runs on the job queue's worker threads."""
+    if RAPTOR_INCREMENTAL_INDEXING or RAPTOR_STORAGE_LAYOUT != "per_user":
+        # Only the new PDF is parsed, embedded and summarized. Shared collections are never rebuilt wholesale.
+        result = index_user_file(user_id, file_path, llm=new_llm(), progress=job.report)
+    else:
+        job.report("parse")
+        cur_file_paths = os.listdir(os.path.join("models", "uploaded_files", user_id)) or []
+
+        custom_velociraptor = RAPTOR(
+            files=get_files_user(user_id, cur_file_paths),
+            collection_name=user_id,
+            llm=new_llm(), # the tree build runs in its own event loop
+            force_rebuild=True
+        )
+        result = None
+    invalidate_user_query_engine(user_id)
+    return result
+
+def compact_user_files(job, user_id: str):
+    """Body of a compaction job: drop the user's deleted files from the collection."""
+    result = compact_user_collection(user_id, llm=new_llm(), progress=job.report)
+    invalidate_user_query_engine(user_id)
+    return result
+
+def schedule_compactions():
+    """Queue a compaction job for every collection with deleted files still stored."""
+    db = get_user_DB()
+    user_ids = db.get_tombstoned_collections()
+    db.close()
+    return [
+        index_jobs.submit(user_id, "", lambda job, user_id=user_id: compact_user_files(job, user_id))
+        for user_id in user_ids
+    ]
+
+def sync_course_files(job):
+    """Body of a course index sync job; cached answers from the course tree are dropped once it changed."""
+    result = sync_course_index(new_llm(), progress=job.report)
+    if semantic_cache is not None and (result["indexed"] or result["removed"]):
+        semantic_cache.invalidate(intent="raptor_query_engine")
+    read_course_index_stats()
+    return result
+
+def compaction_loop():
+    while True:
+        time.sleep(RAPTOR_COMPACTION_INTERVAL)
+        try:
+            schedule_compactions()
+        except Exception as e:
+            print(f"Scheduling compactions failed: {e}")
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of an indexing job: queued, running (with its current stage), done or failed."""
+    job = index_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job không tồn tại.")
+    return job.to_dict()
+
+@app.on_event("startup")
+async def warm_up():
+    if STARTUP_WARM_UP:
+        startup.start_warm_up()
+    if RAPTOR_COMPACTION_INTERVAL:
+        threading.Thread(target=compaction_loop, name="raptor-compaction", daemon=True).start()
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 during warm-up and while a required component is not built, with per-component timings."""
+    status = startup.stats(STARTUP_REQUIRED_COMPONENTS)
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+@app.get("/metrics")
+async def metrics():
+    """Runtime counters of the chat pipeline."""
+    return {
+        "startup": startup.stats(STARTUP_REQUIRED_COMPONENTS),
+        "intent_router": intent_stats.snapshot(),
+        "llm_cache": llm_cache.stats() if llm_cache else None,
+        "llm_rate_limiter": llm_rate_limiter.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "raptor_engine_pool": query_engine_pool.stats(),
+        "embedding_cache": embedding_store.get().stats() if embedding_store.ready else None,
+        "lexical_index": lexical_index.get().stats() if lexical_index.ready else None,
+        "index_jobs": index_jobs.stats(),
+        "course_index": await course_index_stats(),
+        "single_flight": {
+            flight.name: flight.stats() for flight in (chat_flight, chat_with_file_flight, query_flight)
+        },
+    }
 
-    custom_velociraptor = RAPTOR(
-        files=get_files_user(user_id, cur_file_paths),
-        collection_name=user_id,
-        llm=get_llm(),
-        force_rebuild=True
-    )
+# Manifest stats as of the last sync, re-read at most every COURSE_INDEX_STATS_TTL seconds
+# to also see syncs run from the command line.
+COURSE_INDEX_STATS_TTL = 60
+course_index_status = {"stats": None, "read_at": None}
 
-    return {"message": "Upload thành công", "file_path": file_path}
+def read_course_index_stats() -> dict:
+    manifest = CourseManifest()
+    try:
+        stats = manifest.stats()
+    finally:
+        manifest.close()
+    course_index_status.update(stats=stats, read_at=time.monotonic())
+    return stats
+
+async def course_index_stats() -> dict:
+    read_at = course_index_status["read_at"]
+    if read_at is not None and time.monotonic() - read_at < COURSE_INDEX_STATS_TTL:
+        return course_index_status["stats"]
+    return await run_in_threadpool(read_course_index_stats)
+
+def check_admin_token(token: str | None):
+    if ADMIN_TOKEN and token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+@app.delete("/admin/semantic_cache")
+async def invalidate_semantic_cache(
+    intent: str | None = None,
+    question: str | None = None,
+    x_admin_token: str | None = Header(default=None),
+):
+    """Drop cached answers: all of them, one intent, or one question."""
+    check_admin_token(x_admin_token)
+    if semantic_cache is None:
+        return {"removed": 0}
+    return {"removed": semantic_cache.invalidate(intent=intent, question=question)}
+
+@app.post("/admin/compact")
+async def compact_collections(x_admin_token: str | None = Header(default=None)):
+    """Compact every collection with deleted files now instead of waiting for the periodic run."""
+    check_admin_token(x_admin_token)
+    return {"job_ids": [job.id for job in schedule_compactions()]}
+
+@app.post("/admin/course_index/sync")
+async def sync_course_index_files(x_admin_token: str | None = Header(default=None)):
+    """Index the added / changed course files and drop the removed ones, in the background."""
+    check_admin_token(x_admin_token)
+    # Jobs are serialized per key, two syncs never run at the same time.
+    job = index_jobs.submit("course_index", COURSE_FILES_DIR, sync_course_files)
+    return {"job_id": job.id}
 
 @app.get("/pdf/{user_path:path}")
 async def pdf(user_path: str = Path(...)):
@@ -333,7 +543,9 @@ async def pdf(user_path: str = Path(...)):
     return FileResponse(file_path, media_type="application/pdf")
 
 @app.delete("/delete_pdf/")
-async def delete_pdf(user_id: str = Form(...), file_path: str = Form(...)):
+def delete_pdf(user_id: str = Form(...), file_path: str = Form(...)):
+    # Plain def like upload_pdf: FastAPI runs it in its threadpool, the SQLite and Chroma calls
+    # below never block the event loop. Compaction and removal themselves are index jobs.
     # Đảm bảo file_path hợp lệ và thuộc thư mục user
     expected_dir = os.path.join(UPLOAD_DIR, user_id)
     abs_expected_dir = os.path.abspath(expected_dir)
@@ -346,6 +558,25 @@ async def delete_pdf(user_id: str = Form(...), file_path: str = Form(...)):
 
     try:
         os.remove(abs_file_path)
-        return {"message": "Xóa file thành công."}
+        file_name = os.path.basename(abs_file_path)
+        job = None
+        if RAPTOR_STORAGE_LAYOUT == "dedup":
+            db = get_user_DB()
+            doc_id = db.remove_user_document(user_id, file_name)
+            unreferenced = doc_id is not None and db.count_document_references(doc_id) == 0
+            db.close()
+            if unreferenced:
+                job = index_jobs.submit(
+                    user_id, abs_file_path, lambda job: remove_shared_document(doc_id, new_llm(), progress=job.report)
+                )
+        else:
+            # Hidden from retrieval right away; small documents are removed from the collection now,
+            # big ones by the next periodic compaction.
+            if tombstone_user_file(user_id, file_name) <= RAPTOR_DELETE_INLINE_MAX_NODES:
+                job = index_jobs.submit(user_id, abs_file_path, lambda job: compact_user_files(job, user_id))
+        invalidate_user_query_engine(user_id)
+        return {"message": "Xóa file thành công.", "job_id": job.id if job else None}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Lỗi khi xóa file: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Lỗi khi xóa file: {str(e)}")
+
+startup.record_phase("app_import", time.perf_counter() - APP_IMPORT_STARTED)
@@ -0,0 +1,99 @@
+"""Knowledge tokens and answer retention of the context budgeting stage (fake embedder and LLM).
+
+    python -m benchmarks.context_budget PJS_PDF/*.pdf --budgets 0 2000 1000 500
+
+A tree is built from the PDFs like benchmarks/raptor_retrieval.py and each
+query (a window of words of a chunk) retrieves `--top-k` nodes in collapsed
+mode. The knowledge given to the final prompt is measured as it was (all
+nodes joined) and through models/context_budget.py at every budget (0 =
+only re-rank and deduplicate). A query is retained when the knowledge still
+contains every sentence of its chunk that the window of words overlaps.
+Deduplication may keep such a sentence in another passage than its
+neighbours, so the window itself is not looked for verbatim.
+"""
+import argparse
+import glob
+import statistics
+import time
+
+from llama_index.vector_stores.chroma import ChromaVectorStore
+
+from benchmarks.fake_models import FakeEmbedding, FakeLLM
+from benchmarks.raptor_retrieval import build_tree, make_queries
+from models.config import CONTEXT_DEDUP_THRESHOLD, RAPTOR_TREE_DEPTH
+from models.context_budget import estimate_tokens, fit_nodes, split_sentences
+from models.custom_raptor_retriever import CustomRaptorRetriever
+from models.raptor_query import node_context
+from models.text_similarity import normalize_text
+
+
+def answer_sentences(query_str: str, chunk: str):
+    """Normalized sentences of the chunk overlapped by the query window."""
+    sentences = [normalize_text(sentence) for sentence in split_sentences(chunk)]
+    sentences = [sentence for sentence in sentences if sentence]
+    text = " ".join(sentences)
+    start = text.find(normalize_text(query_str))
+    if start < 0:
+        return None
+    end = start + len(normalize_text(query_str))
+    overlapped, offset = [], 0
+    for sentence in sentences:
+        if offset < end and start < offset + len(sentence):
+            overlapped.append(sentence)
+        offset += len(sentence) + 1
+    return overlapped
+
+
+def measure(queries, answers, retrieved, knowledge_fn):
+    tokens, seconds, retained = [], [], 0
+    for (query_str, _), sentences, nodes in zip(queries, answers, retrieved):
+        started = time.perf_counter()
+        knowledge = knowledge_fn(query_str, nodes)
+        seconds.append(time.perf_counter() - started)
+        tokens.append(estimate_tokens(knowledge))
+        normalized = normalize_text(knowledge)
+        retained += sentences is not None and all(sentence in normalized for sentence in sentences)
+    return statistics.mean(tokens), statistics.median(seconds) * 1000, retained / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", default=sorted(glob.glob("PJS_PDF/*.pdf")))
+    parser.add_argument("--budgets", type=int, nargs="+", default=[0, 2000, 1000, 500])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[6, 12])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=12)
+    args = parser.parse_args()
+
+    embed_model = FakeEmbedding(latency=0, embed_batch_size=1000)
+    collection = build_tree(args.files, embed_model)
+    queries = make_queries(collection, args.queries, args.query_words)
+    chunks = dict(zip(*[collection.get(ids=[id_ for _, id_ in queries])[key] for key in ("ids", "documents")]))
+    answers = [answer_sentences(query_str, chunks[id_]) for query_str, id_ in queries]
+    print(f"{collection.count()} nodes, {len(queries)} queries\n")
+
+    for top_k in args.top_k:
+        retriever = CustomRaptorRetriever(
+            [],
+            embed_model=embed_model,
+            llm=FakeLLM(latency=0),
+            vector_store=ChromaVectorStore(chroma_collection=collection),
+            similarity_top_k=top_k,
+            tree_depth=RAPTOR_TREE_DEPTH,
+        )
+        retrieved = [retriever.retrieve(query_str, mode="collapsed") for query_str, _ in queries]
+        tokens, ms, retained = measure(queries, answers, retrieved, lambda query_str, nodes: node_context(nodes))
+        print(f"top {top_k:>2}  all nodes: {tokens:7.0f} tokens, retained {retained:.1%}")
+        for budget in args.budgets:
+            max_tokens = budget or 10 ** 9
+            tokens, ms, retained = measure(
+                queries, answers, retrieved,
+                lambda query_str, nodes: fit_nodes(query_str, nodes, max_tokens, CONTEXT_DEDUP_THRESHOLD),
+            )
+            label = f"budget {budget}" if budget else "dedup only"
+            print(f"top {top_k:>2} {label:>11}: {tokens:7.0f} tokens, retained {retained:.1%}, p50 {ms:.2f}ms")
+        print()
+
+
+if __name__ == "__main__":
+    main()
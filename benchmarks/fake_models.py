@@ -0,0 +1,88 @@
+"""Offline stand-ins for Cohere and Gemini, with simulated API latency."""
+import asyncio
+import hashlib
+import math
+import random
+import re
+import time
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.llms import CompletionResponse, CompletionResponseGen, CustomLLM, LLMMetadata
+from pydantic import Field
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class FakeEmbedding(BaseEmbedding):
+    """Hashed bag-of-words vectors: deterministic, and similar texts get similar vectors."""
+
+    dim: int = Field(default=256)
+    latency: float = Field(default=0.2, description="Seconds per API call, whatever the batch size.")
+    calls: int = Field(default=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def _vector(self, text: str) -> Embedding:
+        vector = [0.0] * self.dim
+        for word in WORD.findall(text.lower()):
+            bucket = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:4], "little")
+            vector[bucket % self.dim] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._get_text_embeddings([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return (await self._aget_text_embeddings([query]))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+
+class FakeLLM(CustomLLM):
+    """'Summarizes' by keeping the first words of the context, after a simulated generation delay."""
+
+    latency: float = Field(default=1.0, description="Seconds per completion.")
+    failure_rate: float = Field(default=0.0, description="Share of calls failing like a 429/5xx would.")
+    summary_words: int = Field(default=80)
+    calls: int = Field(default=0)
+    failures: int = Field(default=0)
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=32000, num_output=512, model_name="fake-llm")
+
+    def _answer(self, prompt: str) -> str:
+        self.calls += 1
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise RuntimeError("simulated provider error")
+        context = prompt.split("---------------------")
+        text = context[1] if len(context) > 2 else prompt
+        return " ".join(text.split()[:self.summary_words])
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.latency)
+        return CompletionResponse(text=self._answer(prompt))
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self._answer(prompt))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        response = self.complete(prompt, formatted=formatted, **kwargs)
+        yield CompletionResponse(text=response.text, delta=response.text)
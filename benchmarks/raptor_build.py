@@ -0,0 +1,92 @@
+"""Offline benchmark of the RAPTOR tree build (fake embedder and LLM, in-memory Chroma).
+
+    python -m benchmarks.raptor_build PJS_PDF/*.pdf --embed-latency 0.2 --llm-latency 1.0
+
+"baseline" mimics RaptorPack's defaults: 10 texts per embed call and 4
+summaries in flight. "tuned" uses the settings from models/config.py.
+"""
+import argparse
+import asyncio
+import glob
+import time
+
+import chromadb
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.packs.raptor.clustering import get_clusters
+
+from benchmarks.fake_models import FakeEmbedding, FakeLLM
+from models.config import (
+    RAPTOR_TREE_DEPTH,
+    RAPTOR_EMBED_BATCH_SIZE,
+    RAPTOR_EMBED_CONCURRENCY,
+    RAPTOR_SUMMARY_CONCURRENCY,
+    RAPTOR_BUILD_MAX_RETRIES,
+)
+from models.raptor_builder import IncrementalRaptorBuilder
+
+SETTINGS = {
+    "baseline": dict(embed_batch_size=10, embed_concurrency=1000, summary_concurrency=4),
+    "tuned": dict(
+        embed_batch_size=RAPTOR_EMBED_BATCH_SIZE,
+        embed_concurrency=RAPTOR_EMBED_CONCURRENCY,
+        summary_concurrency=RAPTOR_SUMMARY_CONCURRENCY,
+    ),
+}
+
+
+def warm_up_clustering():
+    """UMAP compiles with numba on first use, keep that out of the first measured build."""
+    nodes = [TextNode(text=str(i)) for i in range(20)]
+    get_clusters(nodes, {node.id_: np.random.rand(16).tolist() for node in nodes})
+
+
+def run(name, files, args):
+    embed_model = FakeEmbedding(latency=args.embed_latency, embed_batch_size=1000)
+    llm = FakeLLM(latency=args.llm_latency, failure_rate=args.failure_rate)
+    collection = chromadb.EphemeralClient().get_or_create_collection(f"benchmark_{name}")
+    builder = IncrementalRaptorBuilder(
+        collection,
+        embed_model=embed_model,
+        llm=llm,
+        tree_depth=RAPTOR_TREE_DEPTH,
+        max_retries=RAPTOR_BUILD_MAX_RETRIES,
+        retry_base_delay=0.05,
+        **SETTINGS[name],
+    )
+
+    started = time.perf_counter()
+    stage_totals = {}
+    for file_path in files:
+        result = asyncio.run(builder.add_document(file_path))
+        print(f"  [{name}] {result['file_name']}: {result['seconds']:.1f}s")
+        for level, stages in result["levels"].items():
+            print(f"      level {level}: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in stages.items()))
+            for stage, seconds in stages.items():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+    total = time.perf_counter() - started
+    print(
+        f"{name}: {total:.1f}s (" + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_totals.items())
+        + f"), {embed_model.calls} embed calls, {llm.calls} LLM calls ({llm.failures} failed and retried), "
+        f"{collection.count()} nodes\n"
+    )
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", default=sorted(glob.glob("PJS_PDF/*.pdf")))
+    parser.add_argument("--embed-latency", type=float, default=0.2)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--settings", nargs="+", default=list(SETTINGS), choices=list(SETTINGS))
+    args = parser.parse_args()
+
+    warm_up_clustering()
+    totals = {name: run(name, args.files, args) for name in args.settings}
+    if "baseline" in totals and "tuned" in totals:
+        print(f"speedup: {totals['baseline'] / totals['tuned']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
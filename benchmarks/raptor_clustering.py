@@ -0,0 +1,152 @@
+"""Speed and quality of the RAPTOR clustering methods (fake embedder and LLM, in-memory Chroma).
+
+    python -m benchmarks.raptor_clustering PJS_PDF/*.pdf --copies 1 4 16
+
+The chunks of every PDF are embedded with the hashed bag-of-words
+FakeEmbedding. Each method clusters the chunks of each document (level 0,
+as the builder does) and the chunks of the whole corpus repeated `--copies`
+times with a little noise, a stand-in for one big PDF. Cohesion is the mean
+cosine similarity of a chunk to its cluster centroid, silhouette is
+sklearn's (cosine). Then a tree is built with each method and queried like
+benchmarks/raptor_retrieval.py: a query is a window of words of a chunk and
+is recalled when the retrieved nodes contain that chunk.
+"""
+import argparse
+import glob
+import time
+
+import numpy as np
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import TextNode
+from llama_index.vector_stores.chroma import ChromaVectorStore
+from sklearn.metrics import silhouette_score
+
+from benchmarks.fake_models import FakeEmbedding, FakeLLM
+from benchmarks.raptor_build import warm_up_clustering
+from benchmarks.raptor_retrieval import build_tree, make_queries
+from models.config import RAPTOR_CHILDREN_TOP_K, RAPTOR_CLUSTER_SIZE, RAPTOR_TREE_DEPTH, SIMILARITY_TOP_K
+from models.custom_raptor_retriever import CustomRaptorRetriever
+from models.ingestion import iter_node_batches
+from models.raptor_clustering import CLUSTERING_METHODS, get_clusterer
+
+
+def clusterer(method: str):
+    if method == "umap_gmm":
+        return get_clusterer(method)
+    return get_clusterer(method, cluster_size=RAPTOR_CLUSTER_SIZE)
+
+
+def chunks(file_path: str, embed_model):
+    nodes = [node for batch in iter_node_batches([file_path], [SentenceSplitter()]) for node in batch]
+    vectors = embed_model.get_text_embedding_batch([node.get_content() for node in nodes])
+    return nodes, dict(zip((node.id_ for node in nodes), vectors))
+
+
+def copies(documents, count: int, seed: int = 0):
+    """The chunks of all documents `count` times over, every copy with its own noise."""
+    rng = np.random.default_rng(seed)
+    nodes, embedding_map = [], {}
+    for _ in range(count):
+        for document_nodes, document_map in documents:
+            for node in document_nodes:
+                vector = np.array(document_map[node.id_])
+                vector += rng.normal(0, 0.02, len(vector))
+                copy = TextNode(text=node.get_content())
+                nodes.append(copy)
+                embedding_map[copy.id_] = (vector / np.linalg.norm(vector)).tolist()
+    return nodes, embedding_map
+
+
+def quality(clusters, embedding_map):
+    labels, vectors = [], []
+    for label, cluster in enumerate(clusters):
+        for node in cluster:
+            labels.append(label)
+            vectors.append(embedding_map[node.id_])
+    vectors = np.array(vectors)
+    # Chunks without any word embed to the zero vector.
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    labels = np.array(labels)
+    cohesion = []
+    for label in range(len(clusters)):
+        members = vectors[labels == label]
+        centroid = members.mean(axis=0)
+        cohesion.extend(members @ (centroid / (np.linalg.norm(centroid) + 1e-12)))
+    silhouette = silhouette_score(vectors, labels, metric="cosine") if 1 < len(clusters) < len(labels) else 0.0
+    return float(np.mean(cohesion)), float(silhouette)
+
+
+def measure(method: str, nodes, embedding_map):
+    started = time.perf_counter()
+    clusters = clusterer(method)(nodes, embedding_map)
+    seconds = time.perf_counter() - started
+    cohesion, silhouette = quality(clusters, embedding_map)
+    return seconds, len(clusters), cohesion, silhouette
+
+
+def tree_recall(method: str, files, embed_model, query_count: int, query_words: int):
+    started = time.perf_counter()
+    collection = build_tree(files, embed_model, clusterer=clusterer(method))
+    build_seconds = time.perf_counter() - started
+    queries = make_queries(collection, query_count, query_words)
+    retriever = CustomRaptorRetriever(
+        [],
+        embed_model=embed_model,
+        llm=FakeLLM(latency=0),
+        vector_store=ChromaVectorStore(chroma_collection=collection),
+        similarity_top_k=SIMILARITY_TOP_K,
+        tree_depth=RAPTOR_TREE_DEPTH,
+        children_top_k=RAPTOR_CHILDREN_TOP_K,
+    )
+    recall = {}
+    for mode in ("collapsed", "tree_traversal"):
+        found = sum(
+            expected in {node.node.node_id for node in retriever.retrieve(query_str, mode=mode)}
+            for query_str, expected in queries
+        )
+        recall[mode] = found / len(queries)
+    return build_seconds, collection.count(), recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", default=sorted(glob.glob("PJS_PDF/*.pdf")))
+    parser.add_argument("--methods", nargs="+", default=list(CLUSTERING_METHODS), choices=list(CLUSTERING_METHODS))
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=12)
+    args = parser.parse_args()
+
+    warm_up_clustering()
+    embed_model = FakeEmbedding(latency=0, dim=args.dim, embed_batch_size=1000)
+    documents = [chunks(file_path, embed_model) for file_path in args.files]
+    print(f"{sum(len(nodes) for nodes, _ in documents)} chunks in {len(documents)} documents, dim {args.dim}\n")
+
+    for method in args.methods:
+        results = [measure(method, nodes, embedding_map) for nodes, embedding_map in documents]
+        print(
+            f"{method:>13} per document: {sum(r[0] for r in results):.2f}s, {sum(r[1] for r in results)} clusters, "
+            f"cohesion {np.mean([r[2] for r in results]):.3f}, silhouette {np.mean([r[3] for r in results]):.3f}"
+        )
+        for count in args.copies:
+            nodes, embedding_map = copies(documents, count)
+            try:
+                seconds, clusters, cohesion, silhouette = measure(method, nodes, embedding_map)
+            except ValueError as e:
+                # GaussianMixture gives up on collapsed components.
+                print(f"{method:>13} {len(nodes):>5} chunks: failed, {e}")
+                continue
+            print(
+                f"{method:>13} {len(nodes):>5} chunks: {seconds:.2f}s, {clusters} clusters, "
+                f"cohesion {cohesion:.3f}, silhouette {silhouette:.3f}"
+            )
+        build_seconds, node_count, recall = tree_recall(method, args.files, embed_model, args.queries, args.query_words)
+        print(
+            f"{method:>13} tree: built in {build_seconds:.1f}s, {node_count} nodes, "
+            f"recall collapsed {recall['collapsed']:.1%}, tree_traversal {recall['tree_traversal']:.1%}\n"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Offline benchmark of RAPTOR retrieval modes: latency and recall (fake embedder and LLM, in-memory Chroma).
+
+    python -m benchmarks.raptor_retrieval PJS_PDF/*.pdf --queries 200 --embed-latency 0.05
+
+The tree is built once with the incremental builder. Each query is a random
+window of words from a random chunk, and counts as recalled when that chunk
+is among the retrieved nodes.
+
+"per_parent" is the previous tree traversal: one vector query (and one query
+embedding) per selected parent. "tree_traversal" is the current one, a single
+query per level over the children of all selected parents.
+"""
+import argparse
+import asyncio
+import glob
+import random
+import statistics
+import time
+
+import chromadb
+from llama_index.core.schema import QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilters, MetadataFilter
+from llama_index.vector_stores.chroma import ChromaVectorStore
+
+from benchmarks.fake_models import FakeEmbedding, FakeLLM
+from benchmarks.raptor_build import warm_up_clustering
+from models.config import RAPTOR_TREE_DEPTH, SIMILARITY_TOP_K, RAPTOR_CHILDREN_TOP_K
+from models.custom_raptor_retriever import CustomRaptorRetriever
+from models.raptor_builder import IncrementalRaptorBuilder
+
+
+def build_tree(files, embed_model, clusterer=None):
+    client = chromadb.EphemeralClient()
+    # The ephemeral client is shared by the process, start from an empty collection.
+    if "benchmark_retrieval" in [collection.name for collection in client.list_collections()]:
+        client.delete_collection("benchmark_retrieval")
+    collection = client.get_or_create_collection("benchmark_retrieval")
+    builder = IncrementalRaptorBuilder(
+        collection, embed_model=embed_model, llm=FakeLLM(latency=0), tree_depth=RAPTOR_TREE_DEPTH, clusterer=clusterer
+    )
+    for file_path in files:
+        asyncio.run(builder.add_document(file_path))
+    return collection
+
+
+def make_queries(collection, count: int, words: int, seed: int = 0):
+    rng = random.Random(seed)
+    stored = collection.get(include=["documents", "metadatas"])
+    leaves = [
+        (id_, text) for id_, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+        if "level" not in metadata and len(text.split()) >= words
+    ]
+    queries = []
+    for id_, text in rng.sample(leaves, min(count, len(leaves))):
+        tokens = text.split()
+        start = rng.randrange(len(tokens) - words + 1)
+        queries.append((" ".join(tokens[start:start + words]), id_))
+    return queries
+
+
+def per_parent_traversal(retriever: CustomRaptorRetriever, query_str: str):
+    selected_nodes = []
+    nodes = retriever.index.as_retriever(
+        similarity_top_k=retriever.similarity_top_k,
+        filters=MetadataFilters(filters=[MetadataFilter(key="level", value=retriever.tree_depth - 1)]),
+    ).retrieve(query_str)
+    while nodes:
+        selected_nodes.extend(nodes)
+        children = []
+        for node in nodes:
+            children.extend(retriever.index.as_retriever(
+                similarity_top_k=retriever.similarity_top_k,
+                filters=MetadataFilters(filters=[MetadataFilter(key="parent_id", value=node.node.node_id)]),
+            ).retrieve(query_str))
+        nodes = children
+    return selected_nodes
+
+
+def run(name, retriever, queries, concurrency):
+    label = name
+    if name == "tree_traversal":
+        label = f"{name} (children_top_k {retriever.children_top_k or retriever.similarity_top_k})"
+    if name == "per_parent":
+        retrieve = lambda query: asyncio.to_thread(per_parent_traversal, retriever, query)
+    else:
+        retrieve = lambda query: retriever.aretrieve(QueryBundle(query), mode=name)
+
+    async def timed(query_str, slots):
+        async with slots:
+            started = time.perf_counter()
+            nodes = await retrieve(query_str)
+            return time.perf_counter() - started, nodes
+
+    async def run_all():
+        slots = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(timed(query_str, slots) for query_str, _ in queries))
+
+    started = time.perf_counter()
+    results = asyncio.run(run_all())
+    wall = time.perf_counter() - started
+
+    latencies = sorted(seconds for seconds, _ in results)
+    recalled = sum(
+        expected in {node.node.node_id for node in nodes}
+        for (_, expected), (_, nodes) in zip(queries, results)
+    )
+    print(
+        f"{label}: p50 {statistics.median(latencies) * 1000:.0f}ms, "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f}ms, "
+        f"{len(queries) / wall:.1f} queries/s, recall {recalled / len(queries):.2%}, "
+        f"{statistics.mean(len(nodes) for _, nodes in results):.1f} nodes per query"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", default=sorted(glob.glob("PJS_PDF/*.pdf")))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=12)
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Seconds per query embedding call.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--children-top-k", type=int, nargs="+", default=[RAPTOR_CHILDREN_TOP_K])
+    parser.add_argument(
+        "--modes", nargs="+", default=["collapsed", "tree_traversal", "per_parent"],
+        choices=["collapsed", "tree_traversal", "per_parent"],
+    )
+    args = parser.parse_args()
+
+    warm_up_clustering()
+    embed_model = FakeEmbedding(latency=0, embed_batch_size=1000)
+    collection = build_tree(args.files, embed_model)
+    queries = make_queries(collection, args.queries, args.query_words)
+    print(f"{collection.count()} nodes, {len(queries)} queries, top_k {SIMILARITY_TOP_K}\n")
+
+    embed_model.latency = args.embed_latency
+    retriever = CustomRaptorRetriever(
+        [],
+        embed_model=embed_model,
+        llm=FakeLLM(latency=0),
+        vector_store=ChromaVectorStore(chroma_collection=collection),
+        similarity_top_k=SIMILARITY_TOP_K,
+        tree_depth=RAPTOR_TREE_DEPTH,
+    )
+    for name in args.modes:
+        for children_top_k in args.children_top_k if name == "tree_traversal" else [None]:
+            retriever.children_top_k = children_top_k
+            run(name, retriever, queries, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Hits and false hits of the semantic answer cache per similarity threshold.
+
+    python -m benchmarks.semantic_cache --thresholds 0.7 0.75 0.8 0.85 0.9
+    python -m benchmarks.semantic_cache --local
+
+Each stored question is looked up through paraphrases (which should hit it)
+and through close but different questions (which must not). The questions
+are embedded with EMBEDDING_MODEL through the embedding cache (needs
+COHERE_API_KEY), or vectorized locally with `--local`.
+SEMANTIC_CACHE_THRESHOLD (or SEMANTIC_CACHE_LOCAL_THRESHOLD) should be the
+lowest threshold without false hits.
+"""
+import argparse
+
+from models.semantic_cache import SemanticCache
+
+# stored question -> (paraphrases, different questions)
+CASES = {
+    "what does cumulative mean": (
+        ["define cumulative", "what is the meaning of cumulative", "What does cumulative means",
+         "cumulative nghĩa là gì", "meaning of the word cumulative"],
+        ["what does cumulus mean", "what does accumulate mean", "define cumulative frequency"],
+    ),
+    "what is a closure in JavaScript": (
+        ["explain closures in JavaScript", "closure trong JavaScript là gì", "what are JavaScript closures"],
+        ["what is a closure in Python", "what is a promise in JavaScript", "what is hoisting in JavaScript"],
+    ),
+    "how do I declare a variable in JavaScript": (
+        ["how to declare variables in JavaScript", "cách khai báo biến trong JavaScript"],
+        ["how do I declare a constant in JavaScript", "how do I declare a variable in Python"],
+    ),
+    "what is new in ES6": (
+        ["what are the new features of ES6", "ES6 có gì mới"],
+        ["what is new in ES2020", "what is new in ES5"],
+    ),
+    "what is C++": (
+        ["explain C++", "C++ là gì"],
+        ["what is C#", "what is C"],
+    ),
+    "what does == do in JavaScript": (
+        ["what does the == operator do in JavaScript"],
+        ["what does === do in JavaScript", "what does != do in JavaScript"],
+    ),
+    "sinh viên cần bao nhiêu tín chỉ để tốt nghiệp": (
+        ["cần bao nhiêu tín chỉ để tốt nghiệp", "how many credits do students need to graduate"],
+        ["sinh viên cần bao nhiêu tín chỉ để học bổng", "học phí một tín chỉ là bao nhiêu"],
+    ),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.7, 0.75, 0.8, 0.85, 0.9])
+    parser.add_argument("--local", action="store_true", help="Local word/n-gram vectors instead of embeddings.")
+    args = parser.parse_args()
+
+    if args.local:
+        embed_fn = None
+    else:
+        from models.raptor_query import get_embed_model
+
+        embed_fn = get_embed_model().get_query_embedding
+
+    paraphrases = sum(len(same) for same, _ in CASES.values())
+    different = sum(len(other) for _, other in CASES.values())
+    for threshold in args.thresholds:
+        cache = SemanticCache(threshold=threshold, embed_fn=embed_fn)
+        for question in CASES:
+            cache.store(question, "llm_query_tool", question)
+        hits, false_hits, misses = 0, [], []
+        for question, (same, other) in CASES.items():
+            for lookup in same:
+                entry = cache.lookup(lookup)
+                if entry is not None and entry.answer == question:
+                    hits += 1
+                else:
+                    misses.append(lookup)
+            for lookup in other:
+                if cache.lookup(lookup) is not None:
+                    false_hits.append(lookup)
+        print(f"threshold {threshold:.2f}: hits {hits}/{paraphrases}, false hits {len(false_hits)}/{different}")
+        for lookup in false_hits:
+            print(f"    false hit: {lookup}")
+        for lookup in misses:
+            print(f"    miss: {lookup}")
+
+
+if __name__ == "__main__":
+    main()
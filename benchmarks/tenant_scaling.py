@@ -0,0 +1,118 @@
+"""Query latency, memory and open files of the per-user and tenant layouts as the number of users grows.
+
+    python -m benchmarks.tenant_scaling --tenants 10 100 1000 --nodes 60 --shards 8
+
+Every user gets `--nodes` random vectors (about one lecture). Each case
+runs in a fresh process on a fresh on-disk Chroma: the collections are
+written, the client is reopened (like a server restart) and `--queries`
+searches for random users are timed, including the first, cold ones.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+TOP_K = 6
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def open_files() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def disk_mb(path: str) -> float:
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    ) / 2 ** 20
+
+
+def run_case(layout: str, tenants: int, args) -> dict:
+    import chromadb
+
+    rng = np.random.default_rng(0)
+    users = [f"user{i:06d}" for i in range(tenants)]
+    shard_of = {user: f"tenants_{i % args.shards:03d}" for i, user in enumerate(users)}
+    path = tempfile.mkdtemp(prefix=f"tenants_{layout}_")
+
+    client = chromadb.PersistentClient(path=path)
+    started = time.perf_counter()
+    for user in users:
+        vectors = rng.standard_normal((args.nodes, args.dim)).astype(np.float32)
+        ids = [f"{user}-{i}" for i in range(args.nodes)]
+        if layout == "per_user":
+            client.get_or_create_collection(user).add(ids=ids, embeddings=vectors)
+        else:
+            client.get_or_create_collection(shard_of[user]).add(
+                ids=ids, embeddings=vectors, metadatas=[{"user_id": user}] * args.nodes
+            )
+    write_seconds = time.perf_counter() - started
+    del client
+
+    client = chromadb.PersistentClient(path=path)
+    picker = random.Random(1)
+    latencies = []
+    for _ in range(args.queries):
+        user = picker.choice(users)
+        query = rng.standard_normal(args.dim).astype(np.float32)
+        started = time.perf_counter()
+        if layout == "per_user":
+            client.get_collection(user).query(query_embeddings=[query], n_results=TOP_K)
+        else:
+            client.get_collection(shard_of[user]).query(
+                query_embeddings=[query], n_results=TOP_K, where={"user_id": user}
+            )
+        latencies.append(time.perf_counter() - started)
+
+    latencies.sort()
+    result = {
+        "write_seconds": write_seconds,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "rss_mb": rss_mb(),
+        "open_files": open_files(),
+        "disk_mb": disk_mb(path),
+        "collections": len(client.list_collections()),
+    }
+    del client
+    shutil.rmtree(path, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenants", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--nodes", type=int, default=60)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--layouts", nargs="+", default=["per_user", "tenant"], choices=["per_user", "tenant"])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{args.nodes} nodes per user, dim {args.dim}, {args.shards} shards, {args.queries} queries\n")
+    for tenants in args.tenants:
+        for layout in args.layouts:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (layout, tenants, args))
+            print(
+                f"{tenants:>6} users {layout:>8}: query p50 {result['p50_ms']:.1f}ms p95 {result['p95_ms']:.1f}ms, "
+                f"write {result['write_seconds']:.1f}s, {result['collections']} collections, "
+                f"{result['disk_mb']:.0f} MB on disk, RSS {result['rss_mb']:.0f} MB, {result['open_files']} open files"
+            )
+
+
+if __name__ == "__main__":
+    main()
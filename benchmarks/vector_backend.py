@@ -0,0 +1,157 @@
+"""Memory, cold load and query latency of the Chroma and local (memory-mapped) vector backends.
+
+    python -m benchmarks.vector_backend --nodes 1000 5000 20000 --queries 1000
+
+Every collection holds `--nodes` clustered, normalized 1024-d vectors (like
+Cohere embeddings) with RAPTOR-like metadata. It is written once, then each
+backend is measured in a fresh process: cold load is opening the client and
+answering the first query, memory is the RSS growth over the process after
+its imports. Queries are timed unfiltered (collapsed retrieval) and with a
+`parent_id $in` filter (one tree traversal level). Recall@k is against an
+exact float32 search.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+TOP_K = 6
+WRITE_BATCH = 5000
+BACKENDS = ["chroma", "int8", "float16", "int8-ivf"]
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def make_data(nodes: int, dim: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, nodes // 50), dim)).astype(np.float32)
+    vectors = centers[rng.integers(len(centers), size=nodes)] + 0.6 * rng.standard_normal((nodes, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"node-{i}" for i in range(nodes)]
+    # Three levels of summaries over the chunks, 6 children per parent.
+    metadatas = [{"level": 0, "parent_id": f"node-{i // 6}", "file_name": f"file-{i % 20}.pdf"} for i in range(nodes)]
+    return ids, vectors, metadatas
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((count, vectors.shape[1])) / np.sqrt(vectors.shape[1])
+    queries = vectors[rng.integers(len(vectors), size=count)] + 0.5 * noise
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    parents = [[f"node-{p}" for p in rng.integers(len(vectors) // 6, size=TOP_K)] for _ in range(count)]
+    return queries, parents
+
+
+def open_client(backend: str, path: str):
+    if backend == "chroma":
+        import chromadb
+        return chromadb.PersistentClient(path=path)
+    from models.local_vector_store import LocalVectorClient
+    dtype = "float16" if backend == "float16" else "int8"
+    return LocalVectorClient(path, dtype=dtype, ivf_min_nodes=2000 if backend == "int8-ivf" else 0)
+
+
+def write_case(backend: str, path: str, args):
+    ids, vectors, metadatas = make_data(args.nodes_case, args.dim)
+    collection = open_client(backend, path).get_or_create_collection("bench")
+    started = time.perf_counter()
+    for start in range(0, len(ids), WRITE_BATCH):
+        end = start + WRITE_BATCH
+        collection.add(
+            ids=ids[start:end],
+            embeddings=vectors[start:end],
+            metadatas=metadatas[start:end],
+            documents=[f"chunk {i}" for i in range(start, min(end, len(ids)))],
+        )
+    return time.perf_counter() - started
+
+
+def query_case(backend: str, path: str, args) -> dict:
+    _, vectors, _ = make_data(args.nodes_case, args.dim)
+    queries, parents = make_queries(vectors, args.queries)
+    exact = [set(np.argsort(-(vectors @ query))[:TOP_K]) for query in queries]
+    del vectors
+    if backend == "chroma":
+        import chromadb  # noqa: F401, imported before the memory baseline
+    else:
+        import models.local_vector_store  # noqa: F401
+
+    baseline = rss_mb()
+    started = time.perf_counter()
+    collection = open_client(backend, path).get_collection("bench")
+    collection.query(query_embeddings=[queries[0]], n_results=TOP_K)
+    cold_ms = (time.perf_counter() - started) * 1000
+
+    latencies, filtered, hits = [], [], 0
+    for query, exact_ids, parent_ids in zip(queries, exact, parents):
+        started = time.perf_counter()
+        result = collection.query(query_embeddings=[query], n_results=TOP_K)
+        latencies.append(time.perf_counter() - started)
+        hits += len({int(id_.split("-")[1]) for id_ in result["ids"][0]} & exact_ids)
+
+        started = time.perf_counter()
+        collection.query(query_embeddings=[query], n_results=TOP_K, where={"parent_id": {"$in": parent_ids}})
+        filtered.append(time.perf_counter() - started)
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    return {
+        "cold_ms": cold_ms,
+        "rss_mb": rss_mb() - baseline,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99),
+        "filtered_p99_ms": percentile(filtered, 0.99),
+        "recall": hits / (len(queries) * TOP_K),
+    }
+
+
+def disk_mb(path: str) -> float:
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    ) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"dim {args.dim}, top {TOP_K}, {args.queries} queries\n")
+    for nodes in args.nodes:
+        args.nodes_case = nodes
+        for backend in args.backends:
+            path = tempfile.mkdtemp(prefix=f"vectors_{backend}_")
+            try:
+                with context.Pool(1) as pool:
+                    write_seconds = pool.apply(write_case, (backend, path, args))
+                with context.Pool(1) as pool:
+                    result = pool.apply(query_case, (backend, path, args))
+                print(
+                    f"{nodes:>7} nodes {backend:>8}: cold load {result['cold_ms']:.0f}ms, "
+                    f"+{result['rss_mb']:.0f} MB RSS, {disk_mb(path):.1f} MB on disk, write {write_seconds:.1f}s | "
+                    f"query p50 {result['p50_ms']:.2f}ms p99 {result['p99_ms']:.2f}ms, "
+                    f"filtered p99 {result['filtered_p99_ms']:.2f}ms, recall@{TOP_K} {result['recall']:.3f}"
+                )
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,35 @@
 from llama_index.core.tools import QueryEngineTool
 from llama_index.core.selectors import LLMSingleSelector
 from llama_index.core.query_engine import RouterQueryEngine
+from llama_index.core.schema import QueryBundle
+import asyncio
+import logging
 
-from models.sqlrag_query import SQLQueryEngine, get_sql_template,get_create_table_statement, get_tables
+from models.sqlrag_query import SQLQueryEngine, get_sql_template, get_schemas_str
 from models.llm_query import LlmQueryEngine
 from models.config import *
-from models.raptor_query import get_raptor, get_files, RAPTOR, get_files_user
+from models.raptor_query import RAPTOR, get_embed_model, get_files_user, get_user_file_query_engine, get_course_query_engine, node_context
 from models.web_scraper_query_engine import WebScraperQueryEngine
 
 from models.user_files import get_user_DB
 from models.dictionary_query import DictionaryQueryEngine
+from models.intent_classifier import PreClassifierSelector, IntentClassifier
+from models.semantic_cache import SemanticCache
+from models.context_budget import fit_nodes, fit_records, fit_text
+from models.startup import startup
+
+logger = logging.getLogger(__name__)
 
 
 def init_tool():
     # Create query engine
     # llm
-    llm = get_llm()
+    llm = shared_llm.get()
     llm_query_engine = LlmQueryEngine(llm_gemini=llm, prompt=DEFUALT_DIRECT_LLM_PROMPT)
 
     #sql rag
-    table_schemas = []
-    for table in get_tables():
-        table_schemas.append(get_create_table_statement(table))
-    schemas_str = "\n".join(table_schemas) #get table schema.
-    sql_prompt = get_sql_template(schemas_str)
-    sql_query_engine = SQLQueryEngine(prompt=sql_prompt, llm=llm)
-
-    # #RAPTOR
-    # velociraptor = get_raptor(files=get_files(), force_rebuild=False)
-    # raptor_query_engine = velociraptor.query_engine
+    sql_prompt = get_sql_template(sql_schema.get())
+    sql_query_engine = SQLQueryEngine(prompt=sql_prompt, llm=llm, raw_output=SINGLE_CALL_ANSWERS)
 
     #LLM tool
     llm_tool = QueryEngineTool.from_defaults(
@@ -44,34 +45,29 @@ def init_tool():
         description=DEFUALT_SQL_RAG_QUERY_TOOL_DESCRIPTION
     )
 
-    # #RAPTOR tool
-    # raptor_tool = QueryEngineTool.from_defaults(
-    #     query_engine=raptor_query_engine,
-    #     name="raptor_query_engine",
-    #     description=DEFAULT_RAPTOR_QUERY_TOOL_DESCRIPTION
-    # )
-
     #Web scraper tool
-    web_scraper_engine = WebScraperQueryEngine(llm=llm)
+    web_scraper_engine = WebScraperQueryEngine(llm=llm, raw_output=SINGLE_CALL_ANSWERS)
     web_scraper_tool = QueryEngineTool.from_defaults(
         query_engine=web_scraper_engine,
         name="web_scraper_tool",
         description=DEFAULT_WEB_SCRAPER_QUERY_TOOL_DESCRIPTION
     )
 
-    dictionary_engine = DictionaryQueryEngine(llm=llm)
+    dictionary_engine = DictionaryQueryEngine(llm=llm, raw_output=SINGLE_CALL_ANSWERS)
     dictionary_tool = QueryEngineTool.from_defaults(
         query_engine=dictionary_engine,
         name='dictionary_tool',
         description=DEFAULT_DICTIONARY_QUERY_TOOL_DESCRIPTION
     )
 
-    return llm_tool, sql_rag_tool, web_scraper_tool, dictionary_tool
+    #RAPTOR tool
+    raptor_tool = init_raptor_tool()
+
+    return llm_tool, sql_rag_tool, web_scraper_tool, dictionary_tool, raptor_tool
 
 def init_raptor_tool():
-    #RAPTOR
-    velociraptor = get_raptor(files=get_files(),llm=get_llm(), force_rebuild=False)
-    raptor_query_engine = velociraptor.query_engine
+    # Opens the course tree persisted by `python -m models.course_index sync`, nothing is built here.
+    raptor_query_engine = get_course_query_engine(shared_llm.get(), raw_output=SINGLE_CALL_ANSWERS)
 
     #RAPTOR tool
     raptor_tool = QueryEngineTool.from_defaults(
@@ -81,41 +77,89 @@ def init_raptor_tool():
     )
     return raptor_tool
 
-def init_custom_raptor_tool(user_id):
-    # Get current files (from filesystem)
-    # cur_file_paths = os.listdir(os.path.join("models", "uploaded_files", user_id)) or []
+def init_custom_raptor_tool(user_id, file_paths=None):
+    # Warm hits reuse the pooled engine, the pool is invalidated on upload / delete.
+    # With file_paths, only the nodes of those files are searched.
+    return get_user_file_query_engine(user_id, file_paths, shared_llm.get())
+
+
+def init_query_engine_tools():
+    llm_tool, sql_rag_tool, web_scraper_tool, dictionary_tool, raptor_tool = init_tool()
+    # build_tailored_prompt and the semantic cache go by these positions, new tools are appended.
+    return [llm_tool, sql_rag_tool, dictionary_tool, web_scraper_tool, raptor_tool]
+
 
-    custom_velociraptor = RAPTOR(
-        # files=get_files_user(user_id, cur_file_paths),
-        files=[],
-        collection_name=user_id,
-        llm=get_llm(),
-        force_rebuild=False
+def get_selector():
+    """LLM selector, fronted by the local intent pre-classifier when enabled."""
+    llm_selector = LLMSingleSelector.from_defaults(llm=shared_llm.get())
+    if not INTENT_PRECLASSIFIER_ENABLED:
+        return llm_selector
+    return PreClassifierSelector(
+        llm_selector,
+        classifier=IntentClassifier(),
+        confidence_threshold=INTENT_CONFIDENCE_THRESHOLD,
+        shadow_rate=INTENT_SHADOW_RATE,
     )
-    return custom_velociraptor.query_engine
 
 
-llm_tool, sql_rag_tool, web_scraper_tool, dictionary_tool = init_tool()
+# Built on first use, or ahead of traffic by startup.start_warm_up().
+shared_llm = startup.register("llm", get_llm)
+sql_schema = startup.register("sql_schema", get_schemas_str)
+query_engine_tools = startup.register("query_engine_tools", init_query_engine_tools)
+intent_selector = startup.register("intent_selector", get_selector)
 
-def get_chatbot_response(user_prompt: str) -> str:
-    """Generate a chatbot response based on the conversation context."""
+def embed_question(question: str):
+    # Query embeddings go through the embedding cache, so storing the answer does not embed again.
+    return get_embed_model().get_query_embedding(question)
 
 
-    # raptor_tool = init_raptor_tool()
-    router_query_engine = RouterQueryEngine(
-        selector=LLMSingleSelector.from_defaults(llm=llm),
-        query_engine_tools=[llm_tool,
-                            sql_rag_tool,
-                            dictionary_tool,
-                            web_scraper_tool],
-        llm=llm
-    )
-    response = router_query_engine.query(user_prompt)
+semantic_cache = SemanticCache(
+    threshold=SEMANTIC_CACHE_THRESHOLD if SEMANTIC_CACHE_EMBEDDINGS else SEMANTIC_CACHE_LOCAL_THRESHOLD,
+    ttl_per_intent=SEMANTIC_CACHE_TTL,
+    max_entries_per_intent=SEMANTIC_CACHE_MAX_ENTRIES_PER_INTENT,
+    embed_fn=embed_question if SEMANTIC_CACHE_EMBEDDINGS else None,
+) if SEMANTIC_CACHE_ENABLED else None
 
-    intent = response.metadata["selector_result"].selections[0]
-    if intent.index == 1:
+
+def lookup_cached_answer(user_prompt: str) -> str | None:
+    if semantic_cache is None:
+        return None
+    entry = semantic_cache.lookup(user_prompt)
+    if entry is None:
+        return None
+    logger.info("Semantic cache hit (%s): %r", entry.intent, entry.question)
+    return entry.answer
+
+
+def store_answer(user_prompt: str, intent_index: int, answer: str):
+    if semantic_cache is not None:
+        semantic_cache.store(user_prompt, query_engine_tools.get()[intent_index].metadata.name, answer)
+
+def fit_knowledge(intent_index: int, user_prompt: str, response):
+    """A tool result cut to CONTEXT_TOKEN_BUDGET, unchanged when budgeting is disabled."""
+    if not CONTEXT_BUDGET_ENABLED:
+        return response
+    if intent_index == 4 and getattr(response, "source_nodes", None):
+        return fit_nodes(user_prompt, response.source_nodes, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+    if intent_index in (1, 3):
+        # SQL rows and the latest news keep their order, they are only cut between records.
+        return fit_records(user_prompt, str(response), CONTEXT_TOKEN_BUDGET)
+    return fit_text(user_prompt, str(response), CONTEXT_TOKEN_BUDGET, dedup_threshold=CONTEXT_DEDUP_THRESHOLD)
+
+
+def file_knowledge(user_prompt: str, nodes) -> str:
+    if not CONTEXT_BUDGET_ENABLED:
+        return node_context(nodes)
+    return fit_nodes(user_prompt, nodes, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+
+
+def build_tailored_prompt(intent_index: int, user_prompt: str, response) -> str | None:
+    """Build the prompt that rewrites a tool result for the user, None for direct LLM answers."""
+    if intent_index != 0:
+        response = fit_knowledge(intent_index, user_prompt, response)
+    if intent_index == 1:
         print("SQL RAG INTENT")
-        tailored_response = llm.complete(
+        return (
             f"***Instructions for answering the user query:***\n"
             f"Always make sure to answer in Vietnamese language.\n"
             f"Based on user query and result SQL query result. Answer the user question directly to user.\n"
@@ -130,11 +174,10 @@ def get_chatbot_response(user_prompt: str) -> str:
                 <SQL QUERY RESULT END>
             """
         )
-        return str(tailored_response)
-    elif intent.index == 2:
+    elif intent_index == 2:
         print("DICTIONARY INTENT")
         print(response)
-        tailored_response = llm.complete(
+        return (
             f"***Instructions for answering the user query:***\n"
             f"Always make sure to answer in Vietnamese language, but do not translate the code snippets nor IT terms.\n"
             f"You are a good professor and know how to explain things well to students of different levels. Student is asking you the following question:\n"
@@ -149,13 +192,15 @@ def get_chatbot_response(user_prompt: str) -> str:
             <KNOWLEDGE END>
             """
         )
-        return str(tailored_response)
-    elif intent.index == 3:
+    elif intent_index == 3:
         print("WEB SCRAPER INTENT")
         print(response)
-        tailored_response = llm.complete(
+        return (
             f"***Instructions for answering the user query:***\n"
             f"Always make sure to answer in Vietnamese language.\n"
+            f"<LATEST USER QUERY>\n"
+            f"{user_prompt} \n"
+            f"<LATEST USER QUERY END>\n"
             f"Your task is to present the user with the latest news from the website. Here are the news:\n"
             f""""
                 <NEWS START>
@@ -163,20 +208,15 @@ def get_chatbot_response(user_prompt: str) -> str:
                 <NEWS END>
             """
         )
-        return str(tailored_response)
+    elif intent_index == 4:
+        print("RAPTOR INTENT")
+        return build_file_prompt(user_prompt, response)
     print('Direct LLM')
-    return str(response)
+    return None
 
 
-def get_chatbot_response_from_file(user_prompt: str, user_id: str, file_paths: list) -> str:
-    # Only RAPTOR tools.
-    query_engine = init_custom_raptor_tool(user_id)
-
-
-    response = query_engine.query(user_prompt)
-    print(response)
-    print("_" * 20)
-    tailored_response = llm.complete(
+def build_file_prompt(user_prompt: str, knowledge) -> str:
+    return (
         f"***Instructions for answering the user query:***\n"
         f"Always make sure to answer in Vietnamese language, but do not translate the code snippets nor IT terms.\n"
         f"You are a good professor and know how to explain things well to students of different levels. Student is asking you the following question:\n"
@@ -187,8 +227,114 @@ def get_chatbot_response_from_file(user_prompt: str, user_id: str, file_paths: l
         f"Use the following knowledge to answer the question:\n"
         f"""
         <KNOWLEDGE START>
-        {response}
+        {knowledge}
         <KNOWLEDGE END>
         """
     )
+
+
+def get_router_query_engine() -> RouterQueryEngine:
+    return RouterQueryEngine(
+        selector=intent_selector.get(),
+        query_engine_tools=query_engine_tools.get(),
+        llm=shared_llm.get()
+    )
+
+
+def get_chatbot_response(user_prompt: str) -> str:
+    """Generate a chatbot response based on the conversation context."""
+    cached_answer = lookup_cached_answer(user_prompt)
+    if cached_answer is not None:
+        return cached_answer
+
+    router_query_engine = get_router_query_engine()
+    response = router_query_engine.query(user_prompt)
+
+    intent = response.metadata["selector_result"].selections[0]
+    tailored_prompt = build_tailored_prompt(intent.index, user_prompt, response)
+    if tailored_prompt is None:
+        answer = str(response)
+    else:
+        answer = str(shared_llm.get().complete(tailored_prompt))
+    store_answer(user_prompt, intent.index, answer)
+    return answer
+
+
+async def aget_chatbot_response(user_prompt: str) -> str:
+    """Async version of get_chatbot_response, never blocks the event loop on LLM calls."""
+    cached_answer = await asyncio.to_thread(lookup_cached_answer, user_prompt)
+    if cached_answer is not None:
+        return cached_answer
+
+    router_query_engine = get_router_query_engine()
+    response = await router_query_engine.aquery(user_prompt)
+
+    intent = response.metadata["selector_result"].selections[0]
+    # Context budgeting is CPU work, kept off the event loop.
+    tailored_prompt = await asyncio.to_thread(build_tailored_prompt, intent.index, user_prompt, response)
+    if tailored_prompt is None:
+        answer = str(response)
+    else:
+        answer = str(await shared_llm.get().acomplete(tailored_prompt))
+    await asyncio.to_thread(store_answer, user_prompt, intent.index, answer)
+    return answer
+
+
+async def astream_completion(prompt: str):
+    """Yield the text deltas of a streamed completion."""
+    completion = await shared_llm.get().astream_complete(prompt)
+    async for chunk in completion:
+        if chunk.delta:
+            yield chunk.delta
+
+
+async def astream_chatbot_response(user_prompt: str):
+    """Stream the final generation step of the router path token by token."""
+    cached_answer = await asyncio.to_thread(lookup_cached_answer, user_prompt)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    tools = query_engine_tools.get()
+    selector_result = await intent_selector.get().aselect(
+        [tool.metadata for tool in tools], QueryBundle(user_prompt)
+    )
+    intent_index = selector_result.selections[0].index
+
+    if intent_index == 0:
+        # Direct LLM: stream the tool prompt itself instead of running the tool.
+        print('Direct LLM')
+        prompt = tools[0].query_engine.prompt.format(query=user_prompt)
+    else:
+        response = await tools[intent_index].query_engine.aquery(user_prompt)
+        prompt = await asyncio.to_thread(build_tailored_prompt, intent_index, user_prompt, response)
+
+    tokens = []
+    async for token in astream_completion(prompt):
+        tokens.append(token)
+        yield token
+    await asyncio.to_thread(store_answer, user_prompt, intent_index, "".join(tokens))
+
+
+async def astream_chatbot_response_from_file(user_prompt: str, user_id: str, file_paths: list):
+    """Stream the answer for /chat_with_file; retrieved nodes go straight into the final prompt."""
+    query_engine = await asyncio.to_thread(init_custom_raptor_tool, user_id, file_paths)
+
+    nodes = await query_engine.aretrieve(QueryBundle(user_prompt))
+    knowledge = await asyncio.to_thread(file_knowledge, user_prompt, nodes)
+
+    async for token in astream_completion(build_file_prompt(user_prompt, knowledge)):
+        yield token
+
+
+def get_chatbot_response_from_file(user_prompt: str, user_id: str, file_paths: list) -> str:
+    # Only RAPTOR tools.
+    query_engine = init_custom_raptor_tool(user_id, file_paths)
+
+    # The retrieved nodes go straight into the final prompt, no intermediate synthesis call.
+    nodes = query_engine.retrieve(QueryBundle(user_prompt))
+    knowledge = file_knowledge(user_prompt, nodes)
+    print(knowledge)
+    print("_" * 20)
+    tailored_response = shared_llm.get().complete(build_file_prompt(user_prompt, knowledge))
     return str(tailored_response)
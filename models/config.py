@@ -1,5 +1,7 @@
 from dotenv import load_dotenv
 from llama_index.llms.google_genai import GoogleGenAI
+from models.llm_cache import CompletionCache, CachedGoogleGenAI
+from models.llm_pool import RateLimiter, LLMClientRegistry
 import os
 
 def read_prompt_file(file_path):
@@ -24,8 +26,6 @@ load_dotenv()
 google_api_key = os.getenv("GOOGLE_API_KEY")
 cohere_api_key = os.getenv("COHERE_API_KEY")
 
-llm = GoogleGenAI(model="models/gemini-2.0-flash", google_api_key=google_api_key)
-
 DEFUALT_DIRECT_LLM_PROMPT = read_prompt_file("./prompts/default/DEFUALT_DIRECT_LLM_PROMPT.txt")
 DEFAULT_LLM_QUERY_TOOL_DESCRIPTION = read_prompt_file("./prompts/default/DEFAULT_LLM_QUERY_TOOL_DESCRIPTION.txt")
 DEFUALT_SQL_RAG_QUERY_TOOL_DESCRIPTION = read_prompt_file("./prompts/default/DEFAULT_SQL_RAG_QUERY_TOOL_DESCRIPTION.txt")
@@ -35,13 +35,141 @@ DEFAULT_DICTIONARY_QUERY_TOOL_DESCRIPTION = read_prompt_file("./prompts/default/
 
 
 #RAPTOR
-RETRIEVAL_METHOD="collapsed"
+RETRIEVAL_METHOD="collapsed" # "collapsed": one search over every level, "tree_traversal": top-down, one search per level
 SIMILARITY_TOP_K=6
+RAPTOR_CHILDREN_TOP_K = 18 # tree_traversal: children kept per level below the top, across all selected parents
+RETRIEVAL_HYBRID = True # collapsed mode fuses BM25 (SQLite FTS5) hits with the vector hits
+LEXICAL_INDEX_PATH = "./models/db/lexical_index.db"
+HYBRID_RRF_K = 60 # reciprocal rank fusion constant
+LEXICAL_FAST_PATH_MAX_TERMS = 3 # identifier / quoted-term lookups up to this many terms skip the embedding call, 0 disables
 EMBEDDING_MODEL = "embed-multilingual-v3.0"
+EMBEDDING_CACHE_ENABLED = True
+EMBEDDING_CACHE_PATH = "./models/db/embedding_cache" # one float16 vector file + index per model
+CHROMA_PATH = "chroma_db"
+RAPTOR_VECTOR_BACKEND = "chroma" # "chroma", or "local": memory-mapped int8/float16 matrices searched with NumPy
+LOCAL_VECTOR_PATH = "./models/db/vectors" # "local" backend: one directory per collection
+LOCAL_VECTOR_DTYPE = "int8" # or "float16", for new collections
+LOCAL_VECTOR_IVF_MIN_NODES = 20000 # bigger searches only scan the nearest k-means partitions, 0 disables
+LOCAL_VECTOR_IVF_PROBES = 16 # partitions scanned per query
+RAPTOR_ENGINE_POOL_SIZE = 64 # ready per-user query engines kept in memory
+RAPTOR_INCREMENTAL_INDEXING = True # index only the uploaded PDF instead of rebuilding the collection
+RAPTOR_TREE_DEPTH = 3
+# "per_user": one collection per user. "dedup": identical PDFs are indexed once into a shared
+# collection and users only keep references (user_documents table) to them. "tenant": the nodes of
+# every user live in a few shared collections (shards), tagged and filtered by user_id.
+RAPTOR_STORAGE_LAYOUT = "per_user"
+SHARED_DOCUMENTS_COLLECTION = "shared_documents"
+RAPTOR_TENANT_SHARDS = 8 # collections of the "tenant" layout, users are assigned by hash
+TENANT_COLLECTION_PREFIX = "tenants"
+DOCUMENT_STORE_DIR = "models/document_store" # one copy of each unique uploaded PDF
+
+#COURSE INDEX
+# The global collection behind the router's RAPTOR tool, kept in step with the course files by
+# `python -m models.course_index sync` or POST /admin/course_index/sync.
+COURSE_COLLECTION = "edubot_raptor"
+COURSE_FILES_DIR = "models/uploaded_files" # course PDFs at the top level, users' uploads are in subdirectories
+COURSE_MANIFEST_PATH = "./models/db/course_manifest.db"
+COURSE_INDEX_VERSION = 1 # bump to re-index every course file, e.g. after a change to chunking or summaries
+
+#PDF INGESTION
+PDF_PARSE_WORKERS = None # parsing processes, None = one per CPU core
+PDF_PAGES_PER_TASK = 8 # pages parsed by one process task
+PDF_MAX_PENDING_TASKS = 16 # page ranges parsed ahead of chunking/embedding, bounds memory
+PDF_PAGES_PER_BATCH = 16 # pages chunked and embedded together
+
+#RAPTOR TREE BUILD
+RAPTOR_EMBED_BATCH_SIZE = 96 # texts per Cohere embed call, the API maximum
+RAPTOR_EMBED_CONCURRENCY = 4 # embed calls in flight per build
+RAPTOR_SUMMARY_CONCURRENCY = 16 # cluster summaries in flight per build (the LLM rate limiter still applies)
+RAPTOR_BUILD_MAX_RETRIES = 3 # per embed batch / summary, with exponential backoff
+RAPTOR_CLUSTERING = "kmeans" # "umap_gmm" (RaptorPack's), "kmeans" or "agglomerative", see models/raptor_clustering.py
+RAPTOR_CLUSTER_SIZE = 8 # nodes per cluster for kmeans / agglomerative
+RAPTOR_CLUSTER_WORKERS = None # threads for the kmeans restarts, None = ThreadPoolExecutor's default
+RAPTOR_JOIN_THRESHOLD = 0.8 # cosine similarity for a new document to join an existing top-level summary
+INDEX_JOB_WORKERS = 4 # uploads indexed at the same time, jobs of one user run in order
+INDEX_JOB_HISTORY = 1000 # finished jobs kept for GET /jobs/{job_id}
+
+#RAPTOR DELETION
+# A deleted PDF is hidden from retrieval at once (tombstone). Documents up to this many nodes are then
+# removed from the collection right away; bigger ones wait for the periodic compaction, which refreshes
+# the summaries shared by several deleted documents only once.
+RAPTOR_DELETE_INLINE_MAX_NODES = 200
+RAPTOR_COMPACTION_INTERVAL = 15 * 60 # seconds between compactions, 0 disables them
+
+#ANSWER GENERATION
+# Tools return raw data (SQL rows, definitions, scraped news) and one final prompt writes the answer.
+SINGLE_CALL_ANSWERS = True
+# Knowledge given to the final prompt (retrieved nodes, SQL rows, definitions, news) is re-ranked,
+# stripped of repeated sentences and cut to a budget, see models/context_budget.py.
+CONTEXT_BUDGET_ENABLED = True
+CONTEXT_TOKEN_BUDGET = 2000 # estimated tokens of knowledge per final prompt
+CONTEXT_DEDUP_THRESHOLD = 0.95 # a sentence this similar (local text vectors) to a kept one is dropped, lower drops distinct code lines
+
+#INTENT PRE-CLASSIFIER
+INTENT_PRECLASSIFIER_ENABLED = True
+INTENT_CONFIDENCE_THRESHOLD = 0.8 # below this the LLMSingleSelector decides
+INTENT_SHADOW_RATE = 0.05 # share of local decisions re-checked by the LLM to measure agreement
+
+#SEMANTIC ANSWER CACHE
+SEMANTIC_CACHE_ENABLED = True
+SEMANTIC_CACHE_EMBEDDINGS = True # compare questions by their embedding (EMBEDDING_MODEL), else by local word/n-gram vectors
+SEMANTIC_CACHE_THRESHOLD = 0.92 # cosine similarity of the question embeddings, tune with benchmarks/semantic_cache.py
+SEMANTIC_CACHE_LOCAL_THRESHOLD = 0.9 # same, for the local vectors
+SEMANTIC_CACHE_MAX_ENTRIES_PER_INTENT = 5000
+SEMANTIC_CACHE_TTL = { # seconds, 0 disables caching for that intent
+    "llm_query_tool": 24 * 3600,
+    "dictionary_tool": 7 * 24 * 3600,
+    "web_scraper_tool": 30 * 60,
+    "sql_rag_tool": 0, # answers depend on live database rows
+    "raptor_query_engine": 24 * 3600, # also dropped by a course index sync that changed the tree
+}
+
+#LLM CACHE
+LLM_MODEL = "models/gemini-2.0-flash"
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = "./models/db/llm_cache.db"
+LLM_CACHE_TTL = 7 * 24 * 3600 # seconds
+LLM_CACHE_MAX_MEMORY_ENTRIES = 1024
+LLM_CACHE_MAX_DISK_ENTRIES = 50000
+
+#LLM CLIENT POOL
+LLM_REQUESTS_PER_MINUTE = 1000
+LLM_TOKENS_PER_MINUTE = 1000000
+LLM_MAX_CONCURRENCY = 32 # in-flight Gemini calls per process, the rest queue
+
+#STARTUP
+# Build the tools, selector and clients in a background thread once the server is up,
+# instead of on the first request. Readiness is reported by GET /ready.
+STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "1") != "0"
+# GET /ready answers 503 while these are not built, other components may fail to warm up
+# and are built again by the first request using them.
+STARTUP_REQUIRED_COMPONENTS = ["llm", "query_engine_tools", "intent_selector"]
 
 #WEB SCRAPER
 selected_web_url = "https://ielts-fighter.com/tin-tuc.html"
 max_number_of_posts = 15
 
-def get_llm():
-    return GoogleGenAI(model="models/gemini-2.0-flash", google_api_key=google_api_key)
+# One completion cache per process, shared by every LLM returned by get_llm().
+llm_cache = CompletionCache(
+    LLM_CACHE_PATH,
+    max_memory_entries=LLM_CACHE_MAX_MEMORY_ENTRIES,
+    max_disk_entries=LLM_CACHE_MAX_DISK_ENTRIES,
+    ttl=LLM_CACHE_TTL,
+) if LLM_CACHE_ENABLED else None
+
+# Rate limits are per process and shared by every client, pooled or dedicated.
+llm_rate_limiter = RateLimiter(
+    requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+    tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+)
+
+def new_llm(model=LLM_MODEL):
+    """Dedicated client with its own connections, for code that runs its own event loop (asyncio.run)."""
+    return CachedGoogleGenAI(model=model, api_key=google_api_key, cache=llm_cache, limiter=llm_rate_limiter)
+
+llm_registry = LLMClientRegistry(new_llm)
+
+def get_llm(model=LLM_MODEL):
+    """Shared client for the serving path, one per model per process."""
+    return llm_registry.get(model)
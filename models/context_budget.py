@@ -0,0 +1,177 @@
+"""Fit the knowledge given to the final answer prompt into a token budget.
+
+Retrieved RAPTOR nodes overlap: a summary restates its chunks, sibling
+summaries restate each other. Before the final LLM call the passages are
+
+1. re-ranked: their retrieval rank is fused (reciprocal rank fusion, as in
+   hybrid retrieval) with their similarity to the question, computed locally
+   with the vectors of models/text_similarity.py;
+2. split into sentences, and a sentence already said by a better ranked
+   passage is dropped (same text up to case and spacing, or cosine >=
+   dedup_threshold with a kept sentence sharing a word trigram and the same
+   operators with it: "a == b" never repeats "a != b");
+3. cut once `max_tokens` is reached, estimated like the LLM rate limiter;
+   the sentence that does not fit is truncated to the tokens left, so a
+   single sentence longer than the budget still gives some knowledge.
+
+Tool outputs whose order matters (SQL rows, latest news) keep their order
+and are cut between records, with a note of how many were left out.
+"""
+import json
+import math
+import re
+from typing import List, Sequence
+
+from models.llm_cache import CHARS_PER_TOKEN
+from models.text_similarity import cosine, normalize_text, text_vector
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+PASSAGE_RE = re.compile(r"\n\s*\n")
+SHINGLE_WORDS = 3
+# Operators are dropped by normalize_text, sentences differing only by them are not repeats ("x += 1", "x -= 1").
+OPERATOR_RE = re.compile(r"[=+\-*/%<>!&|^~#]+")
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Leading words of the text within max_tokens."""
+    max_chars = max(max_tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > 0 else cut).rstrip()
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in SENTENCE_RE.split(text) if sentence.strip()]
+
+
+def _shingles(normalized: str) -> set:
+    words = normalized.split()
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def rank_passages(query: str, passages: Sequence[str], rrf_k: int = 60) -> List[int]:
+    """Positions of the passages, best first: retrieval order fused with local similarity to the query."""
+    query_vector = text_vector(query)
+    scores = [cosine(query_vector, text_vector(passage)) for passage in passages]
+    by_score = sorted(range(len(passages)), key=lambda i: scores[i], reverse=True)
+    fused = [1 / (rrf_k + i) for i in range(len(passages))]
+    for rank, i in enumerate(by_score):
+        fused[i] += 1 / (rrf_k + rank)
+    return sorted(range(len(passages)), key=lambda i: fused[i], reverse=True)
+
+
+class SentenceDeduplicator:
+    """Remembers kept sentences; seen() is True for a sentence close to one of them."""
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._texts = set()
+        self._vectors = []
+        self._operators = []
+        self._by_shingle = {}
+
+    def seen(self, sentence: str) -> bool:
+        text = " ".join(sentence.casefold().split())
+        normalized = normalize_text(sentence)
+        if not normalized or text in self._texts:
+            return True
+        shingles = _shingles(normalized)
+        candidates = set()
+        for shingle in shingles:
+            candidates.update(self._by_shingle.get(shingle, ()))
+        vector = text_vector(normalized)
+        operators = OPERATOR_RE.findall(text.rstrip(".!?"))
+        if any(
+            self._operators[i] == operators and cosine(vector, self._vectors[i]) >= self.threshold
+            for i in candidates
+        ):
+            return True
+        self._texts.add(text)
+        for shingle in shingles:
+            self._by_shingle.setdefault(shingle, []).append(len(self._vectors))
+        self._vectors.append(vector)
+        self._operators.append(operators)
+        return False
+
+
+def fit_passages(
+    query: str,
+    passages: Sequence[str],
+    max_tokens: int,
+    rerank: bool = True,
+    dedup_threshold: float = 0.95,
+) -> List[str]:
+    """The passages, re-ranked, without repeated sentences and cut at max_tokens."""
+    order = rank_passages(query, passages) if rerank else range(len(passages))
+    deduplicator = SentenceDeduplicator(dedup_threshold)
+    kept, used, full = [], 0, False
+    for i in order:
+        sentences = []
+        for sentence in split_sentences(passages[i]):
+            if deduplicator.seen(sentence):
+                continue
+            tokens = estimate_tokens(sentence) + 1
+            if used + tokens > max_tokens:
+                truncated = truncate_to_tokens(sentence, max_tokens - used - 1)
+                if truncated:
+                    sentences.append(truncated)
+                full = True
+                break
+            sentences.append(sentence)
+            used += tokens
+        if sentences:
+            kept.append(" ".join(sentences))
+        if full:
+            break
+    return kept
+
+
+def fit_nodes(query: str, nodes, max_tokens: int, dedup_threshold: float = 0.95) -> str:
+    """Retrieved nodes (NodeWithScore, in retrieval order) as one knowledge text."""
+    passages = [node.node.get_content() for node in nodes]
+    return "\n\n".join(fit_passages(query, passages, max_tokens, dedup_threshold=dedup_threshold))
+
+
+def fit_text(query: str, text: str, max_tokens: int, rerank: bool = True, dedup_threshold: float = 0.95) -> str:
+    """Free text (blank-line separated passages, or lines) as one knowledge text."""
+    passages = PASSAGE_RE.split(text)
+    if len(passages) == 1:
+        passages = text.splitlines()
+    return "\n\n".join(fit_passages(query, passages, max_tokens, rerank=rerank, dedup_threshold=dedup_threshold))
+
+
+def _fit_records(records: list, max_tokens: int):
+    """Leading records that fit, and how many were left out."""
+    kept, used = [], 0
+    for record in records:
+        tokens = estimate_tokens(json.dumps(record, ensure_ascii=False, default=str)) + 1
+        if kept and used + tokens > max_tokens:
+            break
+        kept.append(record)
+        used += tokens
+    return kept, len(records) - len(kept)
+
+
+def fit_records(query: str, text: str, max_tokens: int) -> str:
+    """JSON tool output (SQL result with "rows", or a list of news) cut between records, in order."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return fit_text(query, text, max_tokens, rerank=False)
+    if isinstance(data, dict) and isinstance(data.get("rows"), list):
+        data["rows"], omitted = _fit_records(data["rows"], max_tokens)
+        data["rows_omitted"] = omitted
+    elif isinstance(data, list):
+        kept, omitted = _fit_records(data, max_tokens)
+        data = {"items": kept, "items_omitted": omitted}
+    else:
+        return fit_text(query, text, max_tokens, rerank=False)
+    return json.dumps(data, ensure_ascii=False, default=str)
@@ -0,0 +1,174 @@
+"""Manifest of the course files in the global RAPTOR collection, and the sync that keeps them in step.
+
+    python -m models.course_index sync [--dry-run]
+    python -m models.course_index status
+
+Every PDF directly under COURSE_FILES_DIR is a course file. The manifest
+(SQLite) records the content hash each one was indexed from and the index
+version it was indexed with. A sync only indexes files that were added or
+changed, or indexed with another version, and removes files that are gone,
+through the incremental builder. The manifest row is written once the file
+is in the collection, so an interrupted sync just picks up where it
+stopped. Serving never builds anything: it opens the persisted collection.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+from typing import Dict, List
+
+from models.config import (
+    COURSE_COLLECTION,
+    COURSE_FILES_DIR,
+    COURSE_INDEX_VERSION,
+    COURSE_MANIFEST_PATH,
+    EMBEDDING_MODEL,
+    RAPTOR_JOIN_THRESHOLD,
+    RAPTOR_TREE_DEPTH,
+)
+
+
+def index_version() -> str:
+    """Everything a stored tree depends on; any change re-indexes every file."""
+    return f"{COURSE_INDEX_VERSION}:{EMBEDDING_MODEL}:depth{RAPTOR_TREE_DEPTH}"
+
+
+class CourseManifest:
+    def __init__(self, db_path: str = COURSE_MANIFEST_PATH):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS course_files (
+                file_name TEXT PRIMARY KEY,
+                content_hash TEXT,
+                index_version TEXT,
+                nodes INTEGER,
+                indexed_at REAL
+            )
+        ''')
+        self.conn.commit()
+
+    def files(self) -> Dict[str, tuple]:
+        """file_name -> (content_hash, index_version) of every indexed file."""
+        self.cursor.execute('SELECT file_name, content_hash, index_version FROM course_files')
+        return {file_name: (content_hash, version) for file_name, content_hash, version in self.cursor.fetchall()}
+
+    def record(self, file_name: str, content_hash: str, version: str, nodes: int):
+        self.cursor.execute('''
+            INSERT INTO course_files (file_name, content_hash, index_version, nodes, indexed_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(file_name) DO UPDATE SET
+                content_hash=excluded.content_hash,
+                index_version=excluded.index_version,
+                nodes=excluded.nodes,
+                indexed_at=excluded.indexed_at
+        ''', (file_name, content_hash, version, nodes, time.time()))
+        self.conn.commit()
+
+    def remove(self, file_names: List[str]):
+        self.cursor.executemany('DELETE FROM course_files WHERE file_name = ?', [(name,) for name in file_names])
+        self.conn.commit()
+
+    def stats(self) -> dict:
+        self.cursor.execute('SELECT COUNT(*), COALESCE(SUM(nodes), 0), MAX(indexed_at) FROM course_files')
+        files, nodes, last_indexed_at = self.cursor.fetchone()
+        return {"files": files, "nodes": nodes, "last_indexed_at": last_indexed_at, "index_version": index_version()}
+
+    def close(self):
+        self.conn.close()
+
+
+def course_files(course_dir: str = COURSE_FILES_DIR) -> Dict[str, str]:
+    """file_name -> path of the course PDFs; subdirectories (users' uploads) are not course files."""
+    if not os.path.isdir(course_dir):
+        return {}
+    return {
+        entry.name: entry.path
+        for entry in sorted(os.scandir(course_dir), key=lambda entry: entry.name)
+        if entry.is_file() and entry.name.lower().endswith(".pdf")
+    }
+
+
+def plan_sync(manifest: CourseManifest, files: Dict[str, str]) -> dict:
+    """What a sync would do: file names to index (with their hash) and to remove."""
+    from models.raptor_builder import file_doc_id
+
+    version = index_version()
+    indexed = manifest.files()
+    to_index = {}
+    for file_name, path in files.items():
+        content_hash = file_doc_id(path)
+        if indexed.get(file_name) != (content_hash, version):
+            to_index[file_name] = content_hash
+    return {
+        "index": to_index,
+        "remove": sorted(set(indexed) - set(files)),
+        "unchanged": len(files) - len(to_index),
+    }
+
+
+def sync_course_index(llm, course_dir: str = COURSE_FILES_DIR, progress=None, dry_run: bool = False) -> dict:
+    """Bring the global collection in step with the course directory, returns what was done."""
+    from models.raptor_builder import tenant_where
+    from models.raptor_query import new_builder
+
+    report = progress or (lambda stage, **detail: None)
+    manifest = CourseManifest()
+    try:
+        files = course_files(course_dir)
+        plan = plan_sync(manifest, files)
+        result = {"indexed": [], "removed": plan["remove"], "unchanged": plan["unchanged"]}
+        if dry_run:
+            result["indexed"] = sorted(plan["index"])
+            return result
+
+        builder = new_builder(COURSE_COLLECTION, llm, join_threshold=RAPTOR_JOIN_THRESHOLD)
+        indexed = manifest.files()
+        if plan["remove"]:
+            report("remove", files=plan["remove"])
+            asyncio.run(builder.remove_documents({"file_name": {"$in": plan["remove"]}}))
+            manifest.remove(plan["remove"])
+
+        version = index_version()
+        for file_name, content_hash in plan["index"].items():
+            report("index", file_name=file_name)
+            if file_name in indexed:
+                # Changed content is replaced by add_document, an older index version must be removed first.
+                asyncio.run(builder.remove_documents({"file_name": file_name}))
+            asyncio.run(builder.add_document(files[file_name], doc_id=content_hash))
+            # Counted in the collection: a file indexed by an interrupted sync is skipped by add_document.
+            where = tenant_where(None, doc_id=content_hash, file_name=file_name)
+            nodes = len(builder.collection.get(where=where, include=[])["ids"])
+            manifest.record(file_name, content_hash, version, nodes)
+            result["indexed"].append(file_name)
+        return result
+    finally:
+        manifest.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["sync", "status"])
+    parser.add_argument("--dir", default=COURSE_FILES_DIR, help="Course files directory.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what a sync would do.")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        manifest = CourseManifest()
+        plan = plan_sync(manifest, course_files(args.dir))
+        print({**manifest.stats(), "to_index": sorted(plan["index"]), "to_remove": plan["remove"]})
+        manifest.close()
+        return
+
+    from models.config import new_llm
+
+    result = sync_course_index(
+        new_llm(), args.dir, progress=lambda stage, **detail: print(stage, detail), dry_run=args.dry_run
+    )
+    print(result)
+
+
+if __name__ == "__main__":
+    main()
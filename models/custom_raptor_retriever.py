@@ -1,11 +1,89 @@
+import asyncio
+import copy
+
 from llama_index.packs.raptor import RaptorRetriever
 from typing import Optional, List
 from llama_index.core.base.base_retriever import QueryType
 from llama_index.packs.raptor.base import QueryModes
 from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.base.response.schema import Response
-from llama_index.core.vector_stores.types import MetadataFilters, MetadataFilter
+from llama_index.core.vector_stores.types import MetadataFilters, MetadataFilter, FilterOperator
+
+from models.lexical_index import is_keyword_query
+
+
 class CustomRaptorRetriever(RaptorRetriever):
+    """RaptorRetriever whose sync path stays sync.
+
+    The upstream retriever runs every sync query through asyncio.run(), i.e. a
+    throwaway event loop, which breaks the shared async Cohere/Gemini clients.
+
+    With `tenant_id`, only that user's nodes of a shared collection are
+    searched. With `doc_ids`, only the nodes of those documents (shared
+    document collection), with `file_names` only the nodes of those uploaded
+    files. scoped() returns a restricted copy sharing the index. Nodes of the
+    `excluded_file_names` (deleted, not compacted yet) are never returned.
+
+    In tree traversal, `children_top_k` children of the selected parents are
+    kept at every level below the top (default: similarity_top_k).
+
+    With a `lexical_index`, collapsed retrieval fuses the BM25 hits of the
+    collection with the vector hits (reciprocal rank fusion). Keyword lookups
+    of at most `fast_path_max_terms` terms are answered by BM25 alone, without
+    embedding the query, when it finds anything.
+    """
+
+    def __init__(
+        self,
+        *args,
+        tenant_id: Optional[str] = None,
+        doc_ids: Optional[List[str]] = None,
+        file_names: Optional[List[str]] = None,
+        excluded_file_names: Optional[List[str]] = None,
+        children_top_k: Optional[int] = None,
+        lexical_index=None,
+        lexical_collection: Optional[str] = None,
+        rrf_k: int = 60,
+        fast_path_max_terms: int = 0,
+        **kwargs,
+    ):
+        self.tenant_id = tenant_id
+        self.doc_ids = doc_ids
+        self.file_names = file_names
+        self.excluded_file_names = excluded_file_names
+        self.children_top_k = children_top_k
+        self.lexical_index = lexical_index
+        self.lexical_collection = lexical_collection
+        self.rrf_k = rrf_k
+        self.fast_path_max_terms = fast_path_max_terms
+        super().__init__(*args, **kwargs)
+
+    def _filters(self, *filters: MetadataFilter) -> Optional[MetadataFilters]:
+        filters = list(filters)
+        if self.tenant_id is not None:
+            filters.append(MetadataFilter(key="user_id", value=self.tenant_id))
+        if self.doc_ids is not None:
+            filters.append(MetadataFilter(key="doc_id", value=self.doc_ids, operator=FilterOperator.IN))
+        if self.file_names is not None:
+            filters.append(MetadataFilter(key="file_name", value=self.file_names, operator=FilterOperator.IN))
+        if self.excluded_file_names:
+            # Chroma's $nin keeps the nodes without a file name, i.e. the cross-document summaries.
+            filters.append(
+                MetadataFilter(key="file_name", value=self.excluded_file_names, operator=FilterOperator.NIN)
+            )
+        return MetadataFilters(filters=filters) if filters else None
+
+    def _empty_scope(self) -> bool:
+        return self.doc_ids == [] or self.file_names == []
+
+    def scoped(self, doc_ids: Optional[List[str]] = None, file_names: Optional[List[str]] = None):
+        """A copy of this retriever that only searches the given documents / files."""
+        retriever = copy.copy(self)
+        if doc_ids is not None:
+            retriever.doc_ids = doc_ids
+        if file_names is not None:
+            retriever.file_names = file_names
+        return retriever
 
     def retrieve(
         self, query_str_or_bundle: QueryType, mode: Optional[QueryModes] = None
@@ -16,66 +94,162 @@ class CustomRaptorRetriever(RaptorRetriever):
         else:
             query_str = query_str_or_bundle
 
-        return  self.aretrieve(query_str, mode or self.mode)
+        mode = mode or self.mode
+        if mode == "tree_traversal":
+            return self.tree_traversal_retrieval(query_str)
+        elif mode == "collapsed":
+            return self.collapsed_retrieval(query_str)
+        else:
+            raise ValueError(f"Invalid mode: {mode}")
+
+    def _vector_retriever(self):
+        return self.index.as_retriever(similarity_top_k=self.similarity_top_k, filters=self._filters())
+
+    def _lexical_search(self, query_str: str):
+        return self.lexical_index.search(
+            self.lexical_collection,
+            query_str,
+            self.similarity_top_k,
+            self.doc_ids,
+            self.file_names,
+            self.excluded_file_names,
+        )
+
+    def _is_fast_path(self, query_str: str, lexical_hits) -> bool:
+        if lexical_hits and is_keyword_query(query_str, self.fast_path_max_terms):
+            self.lexical_index.record_fast_path()
+            return True
+        return False
+
+    def _lexical_nodes(self, lexical_hits) -> List[NodeWithScore]:
+        nodes = {
+            node.node_id: node
+            for node in self.index.vector_store.get_nodes(node_ids=[node_id for node_id, _ in lexical_hits])
+        }
+        return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in lexical_hits if node_id in nodes]
 
+    def _fuse(self, vector_nodes: List[NodeWithScore], lexical_hits) -> List[NodeWithScore]:
+        """Reciprocal rank fusion of both result lists, the missing lexical hits are read from the store."""
+        scores, nodes = {}, {}
+        for rank, node in enumerate(vector_nodes):
+            scores[node.node.node_id] = 1 / (self.rrf_k + rank + 1)
+            nodes[node.node.node_id] = node.node
+        for rank, (node_id, _) in enumerate(lexical_hits):
+            scores[node_id] = scores.get(node_id, 0.0) + 1 / (self.rrf_k + rank + 1)
+        best = sorted(scores, key=scores.get, reverse=True)[:self.similarity_top_k]
+        missing = [(node_id, scores[node_id]) for node_id in best if node_id not in nodes]
+        if missing:
+            nodes.update((node.node.node_id, node.node) for node in self._lexical_nodes(missing))
+        return [NodeWithScore(node=nodes[node_id], score=scores[node_id]) for node_id in best if node_id in nodes]
 
     def collapsed_retrieval(self, query_str: str) -> List[NodeWithScore]:
         """Query the index as a collapsed tree -- i.e. a single pool of nodes."""
-        # retriver = (CustomRaptorRetriever) self.index.as_retriever(similarity_top_k=self.similarity_top_k)
-        return self.index.as_retriever(similarity_top_k=self.similarity_top_k).aretrieve(query_str)
+        if self._empty_scope():
+            return []
+        if self.lexical_index is None:
+            return self._vector_retriever().retrieve(query_str)
+        lexical_hits = self._lexical_search(query_str)
+        if self._is_fast_path(query_str, lexical_hits):
+            return self._lexical_nodes(lexical_hits)
+        return self._fuse(self._vector_retriever().retrieve(query_str), lexical_hits)
+
+    async def _avector_retrieve(self, query_str: str) -> List[NodeWithScore]:
+        # Chroma has no async query, its aquery would block the event loop: only the embedding is awaited.
+        query = QueryBundle(query_str, embedding=await self.index._embed_model.aget_query_embedding(query_str))
+        return await asyncio.to_thread(self._vector_retriever().retrieve, query)
+
+    async def acollapsed_retrieval(self, query_str: str) -> List[NodeWithScore]:
+        if self._empty_scope():
+            return []
+        if self.lexical_index is None:
+            return await self._avector_retrieve(query_str)
+        lexical_hits = await asyncio.to_thread(self._lexical_search, query_str)
+        if self._is_fast_path(query_str, lexical_hits):
+            return await asyncio.to_thread(self._lexical_nodes, lexical_hits)
+        vector_nodes = await self._avector_retrieve(query_str)
+        return await asyncio.to_thread(self._fuse, vector_nodes, lexical_hits)
+
+    def _root_retrievers(self):
+        """Searches for the first level of a traversal, from the top of the tree down.
+
+        The top summaries span documents and carry no file name, so a search
+        scoped to some files starts at the highest level that has their
+        nodes, or at the chunks themselves when no summary matches the scope.
+        """
+        for level in range(self.tree_depth - 1, -1, -1):
+            yield self.index.as_retriever(
+                similarity_top_k=self.similarity_top_k,
+                filters=self._filters(MetadataFilter(key="level", value=level)),
+            )
+            if self.file_names is None:
+                return
+        yield self._vector_retriever()
+
+    def _children_retriever(self, parent_ids: List[str]):
+        """The children of all selected parents in one query."""
+        # Children belong to the documents of their parent, only deleted files are filtered out.
+        filters = [MetadataFilter(key="parent_id", value=parent_ids, operator=FilterOperator.IN)]
+        if self.excluded_file_names:
+            filters.append(
+                MetadataFilter(key="file_name", value=self.excluded_file_names, operator=FilterOperator.NIN)
+            )
+        return self.index.as_retriever(
+            similarity_top_k=self.children_top_k or self.similarity_top_k,
+            filters=MetadataFilters(filters=filters),
+        )
+
+    def _select(self, selected_nodes: List[NodeWithScore], nodes: List[NodeWithScore], depth: int):
+        """Keep the nodes of one level, returns the parent ids for the next one (None at the leaves)."""
+        if self._verbose:
+            print(f"Retrieved {len(nodes)} nodes at depth {depth}.")
+        selected_nodes.extend(nodes)
+        return [node.node.node_id for node in nodes] or None
 
     def tree_traversal_retrieval(self, query_str: str) -> List[NodeWithScore]:
-        """Query the index as a tree, traversing the tree from the top down."""
-        # get top k nodes for each level, starting with the top
-        parent_ids = None
-        selected_node_ids = set()
+        """Query the index as a tree, traversing the tree from the top down.
+
+        The query is embedded once, and every level costs a single vector
+        query: the best `children_top_k` children of the parents selected at
+        the level above. The walk stops at the leaf chunks.
+        """
+        if self._empty_scope():
+            return []
+        query = QueryBundle(query_str, embedding=self.index._embed_model.get_query_embedding(query_str))
+        nodes = []
+        for retriever in self._root_retrievers():
+            nodes = retriever.retrieve(query)
+            if nodes:
+                break
         selected_nodes = []
-        level = self.tree_depth - 1
-        while level >= 0:
-            # retrieve nodes at the current level
+        parent_ids = self._select(selected_nodes, nodes, 0)
+        # tree_depth summary levels plus the chunks.
+        for depth in range(1, self.tree_depth + 1):
             if parent_ids is None:
-                nodes = self.index.as_retriever(
-                    similarity_top_k=self.similarity_top_k,
-                    filters=MetadataFilters(
-                        filters=[MetadataFilter(key="level", value=level)]
-                    ),
-                ).aretrieve(query_str)
-
-                for node in nodes:
-                    if node.id_ not in selected_node_ids:
-                        selected_nodes.append(node)
-                        selected_node_ids.add(node.id_)
-
-                parent_ids = [node.id_ for node in nodes]
-                if self._verbose:
-                    print(f"Retrieved parent IDs from level {level}: {parent_ids!s}")
-            # retrieve nodes that are children of the nodes at the previous level
-            elif parent_ids is not None and len(parent_ids) > 0:
-                nodes = []
-                for id_ in parent_ids:
-                    child_nodes = self.index.as_retriever(
-                        similarity_top_k=self.similarity_top_k,
-                        filters=MetadataFilters(
-                            filters=[MetadataFilter(key="parent_id", value=id_)]
-                        ),
-                    ).aretrieve(query_str)
-
-                    nodes.extend(child_nodes)
-
-                for node in nodes:
-                    if node.id_ not in selected_node_ids:
-                        selected_nodes.append(node)
-                        selected_node_ids.add(node.id_)
-
-                if self._verbose:
-                    print(f"Retrieved {len(nodes)} from parents at level {level}.")
-
-                level -= 1
-                parent_ids = None
+                break
+            nodes = self._children_retriever(parent_ids).retrieve(query)
+            parent_ids = self._select(selected_nodes, nodes, depth)
+        return selected_nodes
 
+    async def atree_traversal_retrieval(self, query_str: str) -> List[NodeWithScore]:
+        if self._empty_scope():
+            return []
+        query = QueryBundle(query_str, embedding=await self.index._embed_model.aget_query_embedding(query_str))
+        # Chroma has no async query, its aquery would block the event loop.
+        nodes = []
+        for retriever in self._root_retrievers():
+            nodes = await asyncio.to_thread(retriever.retrieve, query)
+            if nodes:
+                break
+        selected_nodes = []
+        parent_ids = self._select(selected_nodes, nodes, 0)
+        for depth in range(1, self.tree_depth + 1):
+            if parent_ids is None:
+                break
+            nodes = await asyncio.to_thread(self._children_retriever(parent_ids).retrieve, query)
+            parent_ids = self._select(selected_nodes, nodes, depth)
         return selected_nodes
 
-    def aretrieve(
+    async def aretrieve(
             self, query_str_or_bundle: QueryType, mode: Optional[QueryModes] = None
     ) -> List[NodeWithScore]:
         """Retrieve nodes given query and mode."""
@@ -86,8 +260,8 @@ class CustomRaptorRetriever(RaptorRetriever):
 
         mode = mode or self.mode
         if mode == "tree_traversal":
-            return self.tree_traversal_retrieval(query_str)
+            return await self.atree_traversal_retrieval(query_str)
         elif mode == "collapsed":
-            return self.collapsed_retrieval(query_str)
+            return await self.acollapsed_retrieval(query_str)
         else:
-            raise ValueError(f"Invalid mode: {mode}")
\ No newline at end of file
+            raise ValueError(f"Invalid mode: {mode}")
@@ -3,9 +3,40 @@ from llama_index.core import PromptTemplate
 from llama_index.llms.google_genai import GoogleGenAI
 from pydantic import Field
 from freedictionaryapi.clients.sync_client import DictionaryApiClient
+from freedictionaryapi.clients.async_client import AsyncDictionaryApiClient
+from models.text_similarity import extract_user_query
+import asyncio
 import ast
+import re
 import traceback
 
+# Phrasings where the looked-up word can be read off the question without an LLM.
+WORD_QUESTION_PATTERNS = [
+    re.compile(r"what (?:does|do|is) (?:the (?:word|phrase|term) )?(.+?) mean\b", re.IGNORECASE),
+    re.compile(r"(?:meaning|definition|synonyms?|examples?) (?:of|for) (?:the (?:word|phrase|term) )?(.+)$", re.IGNORECASE),
+    re.compile(r"^(?:define|explain) (?:the (?:word|phrase|term) )?(.+)$", re.IGNORECASE),
+    re.compile(r"^(?:từ |cụm từ )?(.+?) (?:có )?nghĩa là gì", re.IGNORECASE),
+    re.compile(r"(?:nghĩa|định nghĩa) của (?:từ |cụm từ )?(.+?)(?: là gì)?$", re.IGNORECASE),
+]
+WORD_SPLIT_RE = re.compile(r"\s*(?:,|\band\b|\bvà\b)\s*", re.IGNORECASE)
+ENGLISH_TERM_RE = re.compile(r"^[a-z][a-z' -]*$", re.IGNORECASE)
+MAX_WORDS_PER_TERM = 4
+
+
+def format_meaning(parser):
+    meaning = {
+        'Definitions': [v for v in parser.get_all_definitions() if v],
+        'Synonyms': [v for v in parser.get_all_synonyms() if v],
+        'Examples': [v for v in parser.get_all_examples() if v],
+    }
+
+    parts = []
+    for key, values in meaning.items():
+        value_str = '; '.join(values) if values else 'None'
+        parts.append(f"{key}: {value_str}")
+
+    return f"Word: {parser.word.word} | " + ' | '.join(parts)
+
 
 def meaning_of_words(words):
     meanings = ""
@@ -13,19 +44,26 @@ def meaning_of_words(words):
         with DictionaryApiClient() as client:
             for word in words:
                     parser = client.fetch_parser(word)
-                    meaning = {
-                        'Definitions': [v for v in parser.get_all_definitions() if v],
-                        'Synonyms': [v for v in parser.get_all_synonyms() if v],
-                        'Examples': [v for v in parser.get_all_examples() if v],
-                    }
-
-                    parts = []
-                    for key, values in meaning.items():
-                        value_str = '; '.join(values) if values else 'None'
-                        parts.append(f"{key}: {value_str}")
-
-                    final_str = f"Word: {parser.word.word} | " + ' | '.join(parts)
-                    meanings += final_str + "\n"
+                    meanings += format_meaning(parser) + "\n"
+    except Exception as e:
+        print(traceback.format_exc())
+    return meanings
+
+
+async def ameaning_of_words(words):
+    """Fetch all words concurrently; a failed lookup only drops that word."""
+    meanings = ""
+    try:
+        async with AsyncDictionaryApiClient() as client:
+            parsers = await asyncio.gather(
+                *[client.fetch_parser(word) for word in words],
+                return_exceptions=True
+            )
+        for word, parser in zip(words, parsers):
+            if isinstance(parser, Exception):
+                print(f"Word: {word} | Error: {parser}")
+                continue
+            meanings += format_meaning(parser) + "\n"
     except Exception as e:
         print(traceback.format_exc())
     return meanings
@@ -47,6 +85,26 @@ def get_prompt_template():
     return dictionary_prompt
 
 
+def extract_words_locally(query_str: str) -> list[str]:
+    """Read the asked-about words straight off common question phrasings, [] if unsure."""
+    question = extract_user_query(query_str).strip().strip("?!. ")
+    quoted = re.findall(r"[\"“'‘](.+?)[\"”'’]", question)
+    candidates = quoted
+    if not candidates:
+        for pattern in WORD_QUESTION_PATTERNS:
+            match = pattern.search(question)
+            if match:
+                candidates = WORD_SPLIT_RE.split(match.group(1))
+                break
+
+    words = [c.strip().strip("?!. ") for c in candidates if c.strip()]
+    if not words or not all(
+        ENGLISH_TERM_RE.match(w) and len(w.split()) <= MAX_WORDS_PER_TERM for w in words
+    ):
+        return []
+    return words
+
+
 def parse_word_list(output_str: str) -> list[str]:
     try:
         return ast.literal_eval(output_str.strip())
@@ -59,15 +117,19 @@ class DictionaryQueryEngine(CustomQueryEngine):
     """Custom query engine for SQL queries."""
 
     llm: GoogleGenAI | None = Field(default=None)
+    # Try to read the words off the question before asking the LLM to extract them.
+    raw_output: bool = Field(default=False)
 
     def custom_query(self, query_str: str): #That is user question ?
-        prompt = get_prompt_template()
-        llm_prompt = prompt.format(query_str=query_str)
+        word_list = extract_words_locally(query_str) if self.raw_output else []
+        if not word_list:
+            prompt = get_prompt_template()
+            llm_prompt = prompt.format(query_str=query_str)
 
-        generated_query = self.llm.complete(llm_prompt)
+            generated_query = self.llm.complete(llm_prompt)
 
-        print(f"Generated query: {generated_query}")
-        word_list = parse_word_list(str(generated_query))
+            print(f"Generated query: {generated_query}")
+            word_list = parse_word_list(str(generated_query))
 
         print(f"Word list: {word_list}")
 
@@ -76,6 +138,24 @@ class DictionaryQueryEngine(CustomQueryEngine):
 
         return str(result)
 
+    async def acustom_query(self, query_str: str):
+        word_list = extract_words_locally(query_str) if self.raw_output else []
+        if not word_list:
+            prompt = get_prompt_template()
+            llm_prompt = prompt.format(query_str=query_str)
+
+            generated_query = await self.llm.acomplete(llm_prompt)
+
+            print(f"Generated query: {generated_query}")
+            word_list = parse_word_list(str(generated_query))
+
+        print(f"Word list: {word_list}")
+
+        result = await ameaning_of_words(word_list)
+        print(f"Result: {result}")
+
+        return str(result)
+
 # if __name__ == "__main__":
 #     wordlist = ast.literal_eval('["Cumulative"]')
 #     print(type(wordlist))
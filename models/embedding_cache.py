@@ -0,0 +1,216 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from pydantic import Field, PrivateAttr
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process may write to a store.
+    fcntl = None
+
+# sqlite has a limit on the number of bound parameters per statement.
+LOOKUP_CHUNK = 500
+
+
+class EmbeddingStore:
+    """Content-addressed embeddings on local disk.
+
+    Vectors are appended as float16 rows to `vectors.f16` and read back
+    through a memory map. A SQLite index maps sha256(model, kind, text) to
+    the row number. Several processes (server workers, the course index
+    sync) share a store: an append holds an exclusive lock on the file and
+    takes its row numbers from the file size, and the index rows are only
+    written once the vectors are on disk. A crash can leave orphan rows or
+    a partially written last row behind, which the next append cuts off.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, "vectors.f16")
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(os.path.join(path, "index.db"), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, row INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+        self.dim = self._stored_dim()
+        self.rows = self._file_rows()
+        self._map = None
+        self._mapped_rows = 0
+
+    @staticmethod
+    def make_key(model: str, kind: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\x00{kind}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _stored_dim(self) -> int | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def _file_rows(self) -> int:
+        """Complete rows in the vectors file, including those appended by other processes."""
+        if not self.dim or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * 2)
+
+    @contextmanager
+    def _append_lock(self):
+        with open(self.vectors_path, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _vectors(self):
+        if self._map is None or self._mapped_rows != self.rows:
+            self._map = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(self.rows, self.dim))
+            self._mapped_rows = self.rows
+        return self._map
+
+    def get_many(self, keys: List[str]) -> List[List[float] | None]:
+        """Cached vectors in the order of `keys`, None for misses."""
+        rows = {}
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start:start + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows.update(self.conn.execute(
+                    f'SELECT key, row FROM embeddings WHERE key IN ({placeholders})', chunk
+                ).fetchall())
+            if rows and max(rows.values()) >= self.rows:
+                # Rows appended by another process since the last lookup.
+                self.dim = self.dim or self._stored_dim()
+                self.rows = self._file_rows()
+            vectors = self._vectors() if rows else None
+            result = [
+                vectors[rows[key]].astype(np.float32).tolist() if key in rows else None
+                for key in keys
+            ]
+            found = len([v for v in result if v is not None])
+            self.hits += found
+            self.misses += len(keys) - found
+            return result
+
+    def put_many(self, keys: List[str], embeddings: List[List[float]]):
+        if not keys:
+            return
+        matrix = np.asarray(embeddings, dtype=np.float16)
+        with self._lock, self._append_lock() as f:
+            self.dim = self.dim or self._stored_dim()
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+                self.conn.commit()
+                self.dim = self._stored_dim()
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match the cache ({self.dim})")
+            # Under the lock the file only grows by our own write: its size gives our first row.
+            first = self._file_rows()
+            f.truncate(first * self.dim * 2)  # a row left partially written by a crashed process
+            f.write(matrix.tobytes())
+            f.flush()
+            self.rows = first + len(keys)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, row) VALUES (?, ?)',
+                [(key, first + i) for i, key in enumerate(keys)]
+            )
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "vectors": self.rows,
+                "disk_bytes": self.rows * (self.dim or 0) * 2,
+            }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model that only calls the wrapped model for texts it has not embedded before.
+
+    Query and document embeddings are cached separately, since Cohere embeds
+    them with different input types.
+    """
+
+    embed_model: BaseEmbedding = Field(description="The embedding model doing the actual work.")
+    _store: EmbeddingStore = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, store: EmbeddingStore, **kwargs: Any):
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._store = store
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _keys(self, kind: str, texts: List[str]) -> List[str]:
+        return [self._store.make_key(self.model_name, kind, text) for text in texts]
+
+    def _lookup(self, kind: str, texts: List[str]):
+        keys = self._keys(kind, texts)
+        cached = self._store.get_many(keys)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        return keys, cached, missing
+
+    def _fill(self, keys, cached, missing, embeddings) -> List[Embedding]:
+        for i, embedding in zip(missing, embeddings):
+            cached[i] = embedding
+        self._store.put_many([keys[i] for i in missing], embeddings)
+        return cached
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        keys, cached, missing = self._lookup("query", [query])
+        if missing:
+            return self._fill(keys, cached, missing, [self.embed_model.get_query_embedding(query)])[0]
+        return cached[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        keys, cached, missing = self._lookup("query", [query])
+        if missing:
+            return self._fill(keys, cached, missing, [await self.embed_model.aget_query_embedding(query)])[0]
+        return cached[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, cached, missing = self._lookup("text", texts)
+        if missing:
+            embeddings = self.embed_model.get_text_embedding_batch([texts[i] for i in missing])
+            self._fill(keys, cached, missing, embeddings)
+        return cached
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, cached, missing = self._lookup("text", texts)
+        if missing:
+            embeddings = await self.embed_model.aget_text_embedding_batch([texts[i] for i in missing])
+            self._fill(keys, cached, missing, embeddings)
+        return cached
+
+
+def embedding_store_path(root: str, model_name: str) -> str:
+    return os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
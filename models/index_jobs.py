@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Indexing stages, in the order a job goes through them.
+STAGES = ["parse", "embed", "cluster", "summarize", "persist"]
+
+
+@dataclass
+class IndexJob:
+    id: str
+    user_id: str
+    file_path: str
+    status: str = "queued"  # queued -> running -> done | failed
+    stage: str | None = None
+    progress: list = field(default_factory=list)
+    result: dict | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    def report(self, stage: str, **detail):
+        """Progress callback handed to the indexing code."""
+        self.stage = stage
+        self.progress.append({"stage": stage, "at": time.time(), **detail})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class IndexJobQueue:
+    """Thread pool running indexing jobs in the background.
+
+    At most `max_workers` jobs run at once, and the jobs of one user run one
+    after the other in submission order, since they write to the same
+    collection.
+    """
+
+    def __init__(self, max_workers: int = 4, max_history: int = 1000):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="index-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pending = {}  # user_id -> deque of (job, fn) waiting for the user's running job
+        self.max_history = max_history
+
+    def submit(self, user_id: str, file_path: str, fn: Callable[[IndexJob], dict]) -> IndexJob:
+        job = IndexJob(id=uuid.uuid4().hex, user_id=user_id, file_path=file_path)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+            if user_id in self._pending:
+                self._pending[user_id].append((job, fn))
+                return job
+            self._pending[user_id] = deque()
+        self._executor.submit(self._run_user, job, fn)
+        return job
+
+    def get(self, job_id: str) -> IndexJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run_user(self, job: IndexJob, fn):
+        while True:
+            self._run(job, fn)
+            with self._lock:
+                waiting = self._pending[job.user_id]
+                if not waiting:
+                    del self._pending[job.user_id]
+                    return
+                job, fn = waiting.popleft()
+
+    @staticmethod
+    def _run(job: IndexJob, fn):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(job)
+            job.status = "done"
+        except Exception as e:
+            logger.exception(f"Indexing job {job.id} ({job.file_path}) failed")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+    def _trim(self):
+        # Forget the oldest finished jobs, never queued or running ones.
+        overflow = len(self._jobs) - self.max_history
+        for job_id in list(self._jobs):
+            if overflow <= 0:
+                break
+            if self._jobs[job_id].status in ("done", "failed"):
+                del self._jobs[job_id]
+                overflow -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"jobs": counts, "users_indexing": len(self._pending)}
@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List
+
+from llama_index.core import Document, SimpleDirectoryReader
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import BaseNode
+
+from models.config import PDF_PARSE_WORKERS, PDF_PAGES_PER_TASK, PDF_MAX_PENDING_TASKS, PDF_PAGES_PER_BATCH
+from models.pdf_pages import count_pdf_pages, parse_pdf_pages
+
+# Same metadata SimpleDirectoryReader hides from the embedding and the LLM.
+EXCLUDED_FILE_METADATA_KEYS = ["file_name", "file_type", "file_size"]
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """One process pool per server for PDF parsing, which is CPU bound."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn: the server process has threads, forking it is unsafe.
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PDF_PARSE_WORKERS or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _parse_pool
+
+
+def page_document(text: str, page_label: str, file_path: str) -> Document:
+    # Same per-page documents as SimpleDirectoryReader + PDFReader.
+    return Document(
+        text=text,
+        metadata={
+            "page_label": page_label,
+            "file_name": os.path.basename(file_path),
+            "file_path": file_path,
+            "file_type": "application/pdf",
+            "file_size": os.path.getsize(file_path),
+        },
+        excluded_embed_metadata_keys=list(EXCLUDED_FILE_METADATA_KEYS),
+        excluded_llm_metadata_keys=list(EXCLUDED_FILE_METADATA_KEYS),
+    )
+
+
+def iter_page_documents(
+    files: List[str],
+    pages_per_task: int = PDF_PAGES_PER_TASK,
+    max_pending_tasks: int = PDF_MAX_PENDING_TASKS,
+    pool: ProcessPoolExecutor | None = None,
+) -> Iterator[Document]:
+    """Yield one Document per page, in file and page order, while later pages are still being parsed.
+
+    PDFs are split into page ranges parsed in parallel by the process pool. At
+    most `max_pending_tasks` ranges are parsed ahead of the consumer, which
+    bounds memory whatever the number and size of the files.
+    """
+    pool = pool or get_parse_pool()
+    pending = deque()
+
+    def tasks():
+        for file_path in files:
+            if not file_path.lower().endswith(".pdf"):
+                yield file_path, None
+                continue
+            num_pages = count_pdf_pages(file_path)
+            for start in range(0, num_pages, pages_per_task):
+                yield file_path, pool.submit(parse_pdf_pages, file_path, start, min(start + pages_per_task, num_pages))
+
+    task_iter = tasks()
+    for task in task_iter:
+        pending.append(task)
+        if len(pending) < max_pending_tasks:
+            continue
+        yield from _documents_of(*pending.popleft())
+    while pending:
+        yield from _documents_of(*pending.popleft())
+
+
+def _documents_of(file_path: str, future):
+    if future is None:
+        # Other file types go through the regular reader.
+        yield from SimpleDirectoryReader(input_files=[file_path]).load_data()
+        return
+    for text, page_label in future.result():
+        yield page_document(text, page_label, file_path)
+
+
+def iter_node_batches(
+    files: List[str],
+    transformations,
+    pages_per_batch: int = PDF_PAGES_PER_BATCH,
+    **kwargs,
+) -> Iterator[List[BaseNode]]:
+    """Chunk the page stream `pages_per_batch` pages at a time."""
+    batch = []
+    for document in iter_page_documents(files, **kwargs):
+        batch.append(document)
+        if len(batch) >= pages_per_batch:
+            yield run_transformations(batch, transformations, in_place=False)
+            batch = []
+    if batch:
+        yield run_transformations(batch, transformations, in_place=False)
+
+
+def load_documents(files: List[str], **kwargs) -> List[Document]:
+    """Drop-in for SimpleDirectoryReader(input_files=files).load_data(), parsed in parallel."""
+    return list(iter_page_documents(files, **kwargs))
@@ -0,0 +1,240 @@
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import random
+from dataclasses import dataclass
+from typing import Sequence
+
+from llama_index.core.base.base_selector import BaseSelector, SelectorResult, SingleSelection
+from llama_index.core.schema import QueryBundle
+from llama_index.core.tools.types import ToolMetadata
+
+from models.text_similarity import text_vector, cosine, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Keyword / regex rules per tool, matched against the normalized user query.
+INTENT_RULES = {
+    # Single-term lookups only ("define X", "what does X mean", X one or two words): a match skips
+    # the LLM selector, and questions like "define a function that ..." are about code, not words.
+    "dictionary_tool": [
+        r"^(từ )?\w+( \w+)? (có )?nghĩa là gì$",
+        r"^(định )?nghĩa (của )?(từ )?\w+( \w+)?( là gì)?$",
+        r"\btừ đồng nghĩa\b",
+        r"^what (does|do) (the (word|term) )?(?!(this|that|it|my|your)\b)\w+( \w+)? mean$",
+        r"^(what is |whats )?(the )?(meaning|definition) of (the (word|term) )?\w+( \w+)?$",
+        r"^(please )?define (the (word|term) )?\w+( \w+)?$",
+        r"^synonyms? (of|for) \w+( \w+)?$",
+        r"\bhow (do|to) (you )?use \w+ in a sentence\b",
+    ],
+    "sql_rag_tool": [
+        r"\b(điểm số|bảng điểm|điểm danh|chuyên cần)\b",
+        r"\bđiểm (của (tôi|em|mình)|môn|thi|trung bình|giữa kỳ|cuối kỳ)\b",
+        r"\b(my|tôi|em|mình) .*\b(grades?|points?|scores?|attendance)\b",
+        r"\b(grades?|points?|scores?|attendance) (of|for|in) (me|my)\b",
+        r"\bthông tin (cá nhân|của (tôi|em|mình))\b",
+    ],
+    "web_scraper_tool": [
+        r"\b(tin tức|tin mới|news)\b",
+        r"\b(tin|bài viết|thông báo) mới nhất\b",
+        r"\blatest (news|posts|articles|announcements|events)\b",
+        r"\b(hội thảo|seminar|workshop|conference|cuộc thi|competition|tuyển sinh|admissions?|sự kiện)\b",
+    ],
+    "raptor_query_engine": [
+        r"\b(giáo trình|bài giảng|tài liệu (học|khóa học|môn học)|syllabus|course materials?)\b",
+        r"\b(làm (sao|thế nào) để|how (can|do) i|how to) (cải thiện|luyện|improve|practi[cs]e)\b",
+        r"\bielts (writing|speaking|reading|listening)\b",
+    ],
+    "llm_query_tool": [
+        r"^(hi|hello|hey|xin chào|chào|chào bạn)$",
+        r"\b(bạn là ai|who are you|bạn (có thể|làm được) (làm )?gì|what can you do)\b",
+    ],
+}
+COMPILED_RULES = {
+    name: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    for name, patterns in INTENT_RULES.items()
+}
+
+RULE_CONFIDENCE = 0.9
+AMBIGUOUS_RULE_CONFIDENCE = 0.5
+MIN_DESCRIPTION_SIMILARITY = 0.05
+
+
+@dataclass
+class IntentPrediction:
+    index: int
+    name: str
+    confidence: float
+    reason: str
+
+
+class IntentClassifier:
+    """Local intent classifier: regex rules plus similarity to the tool descriptions."""
+
+    def __init__(self):
+        self._description_vectors = {}
+
+    def _description_vector(self, choice: ToolMetadata):
+        vector = self._description_vectors.get(choice.name)
+        if vector is None:
+            description = choice.description.replace("Query: {query}", "")
+            vector = text_vector(description)
+            self._description_vectors[choice.name] = vector
+        return vector
+
+    def classify(self, query_str: str, choices: Sequence[ToolMetadata]) -> IntentPrediction | None:
+        if not choices:
+            return None
+        text = normalize_text(query_str)
+        query_vector = text_vector(text)
+        similarities = [cosine(query_vector, self._description_vector(c)) for c in choices]
+
+        rule_matches = [
+            i for i, choice in enumerate(choices)
+            if any(rule.search(text) for rule in COMPILED_RULES.get(choice.name, []))
+        ]
+        if len(rule_matches) == 1:
+            index = rule_matches[0]
+            return IntentPrediction(index, choices[index].name, RULE_CONFIDENCE, "matched keyword rule")
+        if len(rule_matches) > 1:
+            index = max(rule_matches, key=lambda i: similarities[i])
+            return IntentPrediction(index, choices[index].name, AMBIGUOUS_RULE_CONFIDENCE, "conflicting keyword rules")
+
+        ranked = sorted(range(len(choices)), key=lambda i: similarities[i], reverse=True)
+        index = ranked[0]
+        top = similarities[index]
+        if top < MIN_DESCRIPTION_SIMILARITY:
+            return IntentPrediction(index, choices[index].name, 0.0, "no similar tool description")
+        second = similarities[ranked[1]] if len(ranked) > 1 else 0.0
+        confidence = (top - second) / top
+        return IntentPrediction(index, choices[index].name, confidence, "closest tool description")
+
+
+class IntentRouterStats:
+    """Thread-safe counters for the pre-classifier hit rate and its agreement with the LLM."""
+
+    def __init__(self, log_every: int = 50):
+        self._lock = threading.Lock()
+        self.log_every = log_every
+        self.total = 0
+        self.local_hits = 0
+        self.llm_fallbacks = 0
+        self.compared = 0
+        self.agreed = 0
+
+    def record_local_hit(self):
+        with self._lock:
+            self.total += 1
+            self.local_hits += 1
+            should_log = self.total % self.log_every == 0
+        if should_log:
+            self.log()
+
+    def record_llm_fallback(self):
+        with self._lock:
+            self.total += 1
+            self.llm_fallbacks += 1
+            should_log = self.total % self.log_every == 0
+        if should_log:
+            self.log()
+
+    def record_comparison(self, local_index: int, llm_index: int):
+        with self._lock:
+            self.compared += 1
+            if local_index == llm_index:
+                self.agreed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "total": self.total,
+                "local_hits": self.local_hits,
+                "llm_fallbacks": self.llm_fallbacks,
+                "hit_rate": self.local_hits / self.total if self.total else 0.0,
+                "compared_with_llm": self.compared,
+                "agreement_with_llm": self.agreed / self.compared if self.compared else None,
+            }
+
+    def log(self):
+        stats = self.snapshot()
+        agreement = stats["agreement_with_llm"]
+        logger.info(
+            "Intent pre-classifier: %d queries, hit rate %.1f%%, agreement with LLM %s (%d compared)",
+            stats["total"], stats["hit_rate"] * 100,
+            f"{agreement * 100:.1f}%" if agreement is not None else "n/a", stats["compared_with_llm"],
+        )
+
+
+intent_stats = IntentRouterStats()
+
+
+class PreClassifierSelector(BaseSelector):
+    """Selector that answers confident cases locally and falls back to an LLM selector.
+
+    Every fallback is compared with the local guess, and a sample of the local
+    hits is re-checked by the LLM in the background, so agreement can be tracked.
+    """
+
+    def __init__(
+        self,
+        fallback_selector: BaseSelector,
+        classifier: IntentClassifier | None = None,
+        confidence_threshold: float = 0.8,
+        shadow_rate: float = 0.0,
+        stats: IntentRouterStats = intent_stats,
+    ):
+        self._fallback_selector = fallback_selector
+        self._classifier = classifier or IntentClassifier()
+        self._confidence_threshold = confidence_threshold
+        self._shadow_rate = shadow_rate
+        self._stats = stats
+        self._shadow_executor = ThreadPoolExecutor(max_workers=1) if shadow_rate > 0 else None
+
+    def _get_prompts(self):
+        return {}
+
+    def _get_prompt_modules(self):
+        return {"fallback_selector": self._fallback_selector}
+
+    def _update_prompts(self, prompts_dict) -> None:
+        pass
+
+    def _local_select(self, choices: Sequence[ToolMetadata], query: QueryBundle):
+        prediction = self._classifier.classify(query.query_str, choices)
+        if prediction is not None and prediction.confidence >= self._confidence_threshold:
+            self._stats.record_local_hit()
+            if self._shadow_executor and random.random() < self._shadow_rate:
+                self._shadow_executor.submit(self._shadow_check, choices, query, prediction.index)
+            return prediction, SelectorResult(
+                selections=[SingleSelection(index=prediction.index, reason=f"Pre-classifier: {prediction.reason}")]
+            )
+        return prediction, None
+
+    def _shadow_check(self, choices, query, local_index):
+        try:
+            result = self._fallback_selector.select(choices, query)
+            self._stats.record_comparison(local_index, result.selections[0].index)
+        except Exception as e:
+            logger.warning(f"Intent shadow check failed: {e}")
+
+    def _record_fallback(self, prediction, result: SelectorResult):
+        self._stats.record_llm_fallback()
+        if prediction is not None and result.selections:
+            self._stats.record_comparison(prediction.index, result.selections[0].index)
+
+    def _select(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        prediction, result = self._local_select(choices, query)
+        if result is not None:
+            return result
+        result = self._fallback_selector.select(choices, query)
+        self._record_fallback(prediction, result)
+        return result
+
+    async def _aselect(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        prediction, result = self._local_select(choices, query)
+        if result is not None:
+            return result
+        result = await self._fallback_selector.aselect(choices, query)
+        self._record_fallback(prediction, result)
+        return result
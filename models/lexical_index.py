@@ -0,0 +1,215 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from typing import List, Tuple
+
+from llama_index.core.schema import BaseNode, MetadataMode
+
+# Identifiers are single tokens: getElementById, __proto__, $el.
+TOKEN = re.compile(r"[\w$]+", re.UNICODE)
+# camelCase, snake_case, member access, calls, or a quoted phrase.
+KEYWORD_LOOKUP = re.compile(r"[a-z][A-Z]|\w_\w|\w\.\w|\w\(|\$|^[\"'`].+[\"'`]$")
+# sqlite has a limit on the number of bound parameters per statement.
+SYNC_PAGE = 1000
+# Left out of the OR query: they match most nodes and only add noise to the BM25 ranking.
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from how i if in into is it its of on or so that the their then
+there these this to was what when where which who why will with you your
+bị bởi các cái cho chưa có của cũng đã đang để đến đó được gì hay khi không là làm lại mà một này nào nên
+những như nhưng ra rằng rất sẽ tại theo thì trên trong từ và vào về với
+""".split())
+
+
+def is_keyword_query(query: str, max_terms: int) -> bool:
+    """Short lookups of code identifiers or quoted terms, which BM25 answers well on its own."""
+    query = query.strip()
+    terms = TOKEN.findall(query)
+    return 0 < len(terms) <= max_terms and KEYWORD_LOOKUP.search(query) is not None
+
+
+def partition_name(collection: str, tenant_id: str | None = None) -> str:
+    """Key of a collection, or of one tenant of a shared collection, in the index."""
+    return collection if tenant_id is None else f"{collection}/{tenant_id}"
+
+
+def partition_key(partition: str) -> str:
+    """Single FTS5 token standing for a partition, whatever characters its name has."""
+    return "p" + hashlib.sha1(partition.encode("utf-8")).hexdigest()[:16]
+
+
+def match_expression(query: str) -> str | None:
+    """Any of the query terms but stopwords and single characters, quoted so FTS5 never parses user text as its query syntax."""
+    terms = dict.fromkeys(
+        term for term in (term.lower() for term in TOKEN.findall(query)) if len(term) > 1 and term not in STOPWORDS
+    )
+    return " OR ".join(f'"{term}"' for term in terms) or None
+
+
+class LexicalIndex:
+    """BM25 full-text index of RAPTOR nodes, next to the Chroma collections.
+
+    One SQLite FTS5 table holds the text of every node, with a token naming
+    its collection (partition_key) that every MATCH is restricted to, so a
+    search only reads the postings of its own collection. A regular table maps
+    its rows to (collection, node id, doc id, file name). The node text is the same as
+    the Chroma document, and results are node ids to be read from Chroma.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.fast_path_queries = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS lexical_nodes (
+                id INTEGER PRIMARY KEY,
+                collection TEXT,
+                node_id TEXT,
+                doc_id TEXT,
+                file_name TEXT,
+                UNIQUE (collection, node_id)
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_lexical_nodes_doc ON lexical_nodes(collection, doc_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_lexical_nodes_file ON lexical_nodes(collection, file_name)')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(lexical_text)')]
+        if columns and "partition_key" not in columns:
+            # Index written before collections were partitioned: every collection is re-read from Chroma by sync().
+            self.conn.execute('DROP TABLE lexical_text')
+            self.conn.execute('DELETE FROM lexical_nodes')
+        self.conn.execute(
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS lexical_text
+               USING fts5(text, partition_key, tokenize="unicode61 tokenchars '_$'")'''
+        )
+        self.conn.commit()
+
+    def add(self, collection: str, nodes: List[BaseNode]):
+        rows = [
+            (
+                node.node_id,
+                node.metadata.get("doc_id"),
+                node.metadata.get("file_name"),
+                node.get_content(metadata_mode=MetadataMode.NONE),
+            )
+            for node in nodes
+        ]
+        with self._lock:
+            self._delete_ids(collection, [row[0] for row in rows])
+            self._insert(collection, rows)
+            self.conn.commit()
+
+    def delete(self, collection: str, node_ids: List[str]):
+        with self._lock:
+            self._delete_ids(collection, node_ids)
+            self.conn.commit()
+
+    def drop(self, collection: str):
+        with self._lock:
+            self._drop(collection)
+            self.conn.commit()
+
+    def _insert(self, collection: str, rows):
+        key = partition_key(collection)
+        for node_id, doc_id, file_name, text in rows:
+            cursor = self.conn.execute(
+                'INSERT INTO lexical_nodes (collection, node_id, doc_id, file_name) VALUES (?, ?, ?, ?)',
+                (collection, node_id, doc_id, file_name),
+            )
+            self.conn.execute(
+                'INSERT INTO lexical_text (rowid, text, partition_key) VALUES (?, ?, ?)', (cursor.lastrowid, text, key)
+            )
+
+    def _delete_ids(self, collection: str, node_ids: List[str]):
+        for start in range(0, len(node_ids), SYNC_PAGE):
+            chunk = node_ids[start:start + SYNC_PAGE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = f'SELECT id FROM lexical_nodes WHERE collection = ? AND node_id IN ({placeholders})'
+            self.conn.execute(f'DELETE FROM lexical_text WHERE rowid IN ({rows})', [collection, *chunk])
+            self.conn.execute(
+                f'DELETE FROM lexical_nodes WHERE collection = ? AND node_id IN ({placeholders})', [collection, *chunk]
+            )
+
+    def _drop(self, collection: str):
+        self.conn.execute(
+            'DELETE FROM lexical_text WHERE rowid IN (SELECT id FROM lexical_nodes WHERE collection = ?)', (collection,)
+        )
+        self.conn.execute('DELETE FROM lexical_nodes WHERE collection = ?', (collection,))
+
+    def count(self, collection: str) -> int:
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM lexical_nodes WHERE collection = ?', (collection,)).fetchone()[0]
+
+    def sync(self, chroma_collection, tenant_id: str | None = None) -> bool:
+        """Rebuild the collection's index from Chroma when they disagree, e.g. after a RaptorPack rebuild.
+
+        The incremental builder keeps both in step; this catches every other writer.
+        With a `tenant_id`, only that tenant's nodes of a shared collection.
+        """
+        name = partition_name(chroma_collection.name, tenant_id)
+        where = {"user_id": tenant_id} if tenant_id is not None else None
+        stored = (
+            chroma_collection.count() if where is None
+            else len(chroma_collection.get(where=where, include=[])["ids"])
+        )
+        if self.count(name) == stored:
+            return False
+        rows = []
+        for offset in range(0, stored, SYNC_PAGE):
+            page = chroma_collection.get(where=where, include=["documents", "metadatas"], limit=SYNC_PAGE, offset=offset)
+            rows.extend(
+                (node_id, (metadata or {}).get("doc_id"), (metadata or {}).get("file_name"), text or "")
+                for node_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+            )
+        with self._lock:
+            self._drop(name)
+            self._insert(name, rows)
+            self.conn.commit()
+        return True
+
+    def search(
+        self,
+        collection: str,
+        query: str,
+        top_k: int,
+        doc_ids: List[str] | None = None,
+        file_names: List[str] | None = None,
+        excluded_file_names: List[str] | None = None,
+    ) -> List[Tuple[str, float]]:
+        """Best (node id, BM25 score) pairs, higher is better, optionally only from some documents / files."""
+        expression = match_expression(query)
+        if expression is None or doc_ids == [] or file_names == []:
+            return []
+        sql = '''
+            SELECT n.node_id, -bm25(lexical_text, 1.0, 0.0) AS score
+            FROM lexical_text JOIN lexical_nodes n ON n.id = lexical_text.rowid
+            WHERE lexical_text MATCH ? AND n.collection = ?
+        '''
+        params = [f"partition_key : {partition_key(collection)} AND text : ({expression})", collection]
+        for column, values in (("doc_id", doc_ids), ("file_name", file_names)):
+            if values is not None:
+                sql += f' AND n.{column} IN ({",".join("?" * len(values))})'
+                params.extend(values)
+        if excluded_file_names:
+            sql += f' AND (n.file_name IS NULL OR n.file_name NOT IN ({",".join("?" * len(excluded_file_names))}))'
+            params.extend(excluded_file_names)
+        sql += ' ORDER BY score DESC LIMIT ?'
+        params.append(top_k)
+        with self._lock:
+            self.searches += 1
+            return self.conn.execute(sql, params).fetchall()
+
+    def record_fast_path(self):
+        """A query was answered from this index alone, without embedding it."""
+        with self._lock:
+            self.fast_path_queries += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "fast_path_queries": self.fast_path_queries,
+                "nodes": self.conn.execute('SELECT COUNT(*) FROM lexical_nodes').fetchone()[0],
+            }
@@ -0,0 +1,302 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, Sequence
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    MessageRole,
+)
+from llama_index.llms.google_genai import GoogleGenAI
+from pydantic import PrivateAttr
+
+from models.llm_pool import RateLimiter
+
+# Rough token estimate used for the tokens/min budget (prompt + expected answer).
+CHARS_PER_TOKEN = 4
+ESTIMATED_OUTPUT_TOKENS = 512
+
+
+class CompletionCache:
+    """Two-tier (in-memory LRU + SQLite) cache of LLM completions.
+
+    Entries are keyed by model + prompt hash + generation params, expire after
+    `ttl` seconds and the disk tier is trimmed to `max_disk_entries` by last access.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = 50000,
+        ttl: float = 7 * 24 * 3600,
+    ):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                expires_at REAL,
+                last_access REAL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)')
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, params: dict) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        raw = json.dumps({"model": model, "prompt": prompt_hash, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return response
+                del self._memory[key]
+
+            row = self.conn.execute(
+                'SELECT response, expires_at FROM llm_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or row[1] <= now:
+                if row is not None:
+                    self.conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                    self.conn.commit()
+                self.misses += 1
+                return None
+
+            self.conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+            self._remember(key, row[1], row[0])
+            self.disk_hits += 1
+            return row[0]
+
+    def set(self, key: str, response: str):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, response)
+            self.conn.execute('''
+                INSERT INTO llm_cache (key, response, expires_at, last_access)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET response=excluded.response,
+                    expires_at=excluded.expires_at, last_access=excluded.last_access
+            ''', (key, response, expires_at, now))
+            self.conn.commit()
+            self._writes_since_trim += 1
+            if self._writes_since_trim >= 100:
+                self._trim_disk(now)
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def _remember(self, key, expires_at, response):
+        self._memory[key] = (expires_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _trim_disk(self, now):
+        self._writes_since_trim = 0
+        self.conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,))
+        count = self.conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+        overflow = count - self.max_disk_entries
+        if overflow > 0:
+            self.conn.execute('''
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_access LIMIT ?
+                )
+            ''', (overflow,))
+            self.evictions += overflow
+        self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.conn.execute('DELETE FROM llm_cache')
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+class CachedGoogleGenAI(GoogleGenAI):
+    """GoogleGenAI that serves repeated prompts from a CompletionCache.
+
+    Calls that do reach Gemini go through the RateLimiter, if one is given.
+    Pass `use_cache=False` to any complete/chat call to bypass the cache.
+    Streaming calls are never cached. Only the chat methods are overridden:
+    GoogleGenAI runs every completion method through its chat counterpart,
+    so a completion takes one limiter slot and one cache entry.
+    """
+
+    _cache: CompletionCache | None = PrivateAttr(default=None)
+    _limiter: RateLimiter | None = PrivateAttr(default=None)
+
+    def __init__(self, cache: CompletionCache | None = None, limiter: RateLimiter | None = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._cache = cache
+        self._limiter = limiter
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedGoogleGenAI"
+
+    def _cache_key(self, kind: str, prompt: str, kwargs: dict) -> str | None:
+        use_cache = kwargs.pop("use_cache", True)
+        if self._cache is None:
+            return None
+        if not use_cache:
+            self._cache.record_bypass()
+            return None
+        params = {"kind": kind, "temperature": self.temperature, "max_tokens": self._max_output_tokens(), **kwargs}
+        return self._cache.make_key(self.model, prompt, params)
+
+    def _max_output_tokens(self) -> int | None:
+        # GoogleGenAI has no max_tokens field, the limit lives in its generation config.
+        return (self._generation_config or {}).get("max_output_tokens")
+
+    @staticmethod
+    def _messages_prompt(messages: Sequence[ChatMessage]) -> str:
+        return json.dumps([[str(m.role), m.content] for m in messages], ensure_ascii=False)
+
+    def _estimate_tokens(self, prompt: str) -> int:
+        return len(prompt) // CHARS_PER_TOKEN + (self._max_output_tokens() or ESTIMATED_OUTPUT_TOKENS)
+
+    def _slot(self, prompt: str):
+        return self._limiter.slot(self._estimate_tokens(prompt)) if self._limiter else nullcontext()
+
+    def _aslot(self, prompt: str):
+        return self._limiter.aslot(self._estimate_tokens(prompt)) if self._limiter else nullcontext()
+
+    def _cached_chat(self, key):
+        text = self._cache.get(key) if key else None
+        if text is None:
+            return None
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=text))
+
+    def _store(self, key, text):
+        if key and text:
+            self._cache.set(key, text)
+
+    # The disk tier is SQLite: the async calls read and write the cache in a worker thread.
+
+    async def _acached_chat(self, key):
+        return await asyncio.to_thread(self._cached_chat, key) if key else None
+
+    async def _astore(self, key, text):
+        if key and text:
+            await asyncio.to_thread(self._cache.set, key, text)
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        prompt = self._messages_prompt(messages)
+        key = self._cache_key("chat", prompt, kwargs)
+        cached = self._cached_chat(key)
+        if cached is not None:
+            return cached
+        with self._slot(prompt):
+            response = super().chat(messages, **kwargs)
+        self._store(key, response.message.content)
+        return response
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        prompt = self._messages_prompt(messages)
+        key = self._cache_key("chat", prompt, kwargs)
+        cached = await self._acached_chat(key)
+        if cached is not None:
+            return cached
+        async with self._aslot(prompt):
+            response = await super().achat(messages, **kwargs)
+        await self._astore(key, response.message.content)
+        return response
+
+    # Streaming calls hold their rate-limiter slot until the stream is exhausted.
+
+    def _limited_stream(self, prompt: str, open_stream):
+        if self._limiter is None:
+            return open_stream()
+        self._limiter.acquire(self._estimate_tokens(prompt))
+        try:
+            stream = open_stream()
+        except BaseException:
+            self._limiter.release()
+            raise
+
+        def gen():
+            try:
+                yield from stream
+            finally:
+                self._limiter.release()
+
+        return gen()
+
+    async def _alimited_stream(self, prompt: str, open_stream):
+        if self._limiter is None:
+            return await open_stream()
+        await self._limiter.aacquire(self._estimate_tokens(prompt))
+        try:
+            stream = await open_stream()
+        except BaseException:
+            self._limiter.release()
+            raise
+
+        async def gen():
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                self._limiter.release()
+
+        return gen()
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return self._limited_stream(
+            self._messages_prompt(messages), lambda: super(CachedGoogleGenAI, self).stream_chat(messages, **kwargs)
+        )
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        return await self._alimited_stream(
+            self._messages_prompt(messages), lambda: super(CachedGoogleGenAI, self).astream_chat(messages, **kwargs)
+        )
@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class TokenBucket:
+    """Per-minute token bucket; reserve() returns how long the caller must wait."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class HybridSemaphore:
+    """FIFO semaphore usable from threads and from asyncio tasks at the same time."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def acquire(self):
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                still_waiting = waiter in self._waiters
+                if still_waiting:
+                    self._waiters.remove(waiter)
+            if not still_waiting and future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation.
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._value += 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                # The waiter's event loop is gone, pass the slot on.
+                self.release()
+
+    def _wake(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class RateLimiter:
+    """Requests/min and tokens/min buckets plus a bounded number of in-flight calls.
+
+    Bursts queue here instead of failing upstream with 429s.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_concurrency: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self._semaphore = HybridSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _enter_queue(self) -> float:
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        return time.monotonic()
+
+    def _leave_queue(self, started: float):
+        waited = time.monotonic() - started
+        with self._lock:
+            self.queue_depth -= 1
+            self.in_flight += 1
+            self.total_requests += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def _bucket_wait(self, tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def acquire(self, tokens: int):
+        started = self._enter_queue()
+        try:
+            wait = self._bucket_wait(tokens)
+            if wait > 0:
+                time.sleep(wait)
+            self._semaphore.acquire()
+        except BaseException:
+            with self._lock:
+                self.queue_depth -= 1
+            raise
+        self._leave_queue(started)
+
+    async def aacquire(self, tokens: int):
+        started = self._enter_queue()
+        try:
+            wait = self._bucket_wait(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._semaphore.aacquire()
+        except BaseException:
+            with self._lock:
+                self.queue_depth -= 1
+            raise
+        self._leave_queue(started)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    @contextmanager
+    def slot(self, tokens: int):
+        self.acquire(tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, tokens: int):
+        await self.aacquire(tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "total_requests": self.total_requests,
+                "avg_wait_seconds": self.total_wait / self.total_requests if self.total_requests else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
+
+
+class LLMClientRegistry:
+    """One shared LLM client per model, built lazily by `factory(model)`."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, model: str):
+        with self._lock:
+            client = self._clients.get(model)
+            if client is None:
+                client = self._factory(model)
+                self._clients[model] = client
+            return client
@@ -12,4 +12,10 @@ class LlmQueryEngine(CustomQueryEngine):
         llm = self.llm_gemini
         llm_prompt = self.prompt.format(query=query_str)
         llm_response = llm.complete(llm_prompt)
+        return str(llm_response)
+
+    async def acustom_query(self, query_str: str):
+        llm = self.llm_gemini
+        llm_prompt = self.prompt.format(query=query_str)
+        llm_response = await llm.acomplete(llm_prompt)
         return str(llm_response)
\ No newline at end of file
@@ -0,0 +1,510 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+# sqlite has a limit on the number of bound parameters per statement.
+LOOKUP_CHUNK = 500
+# Rows copied out of the memory map at once: compaction, IVF assignment, scattered search candidates.
+BLOCK_ROWS = 8192
+# Rows converted to float32 at once while searching, small enough for the copy to stay in cache.
+SCAN_ROWS = 256
+# Deleted rows stay in the vector file until they outnumber the live ones.
+COMPACT_MIN_DEAD_ROWS = 1024
+COLLECTION_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,510}[A-Za-z0-9]")
+DTYPES = {"int8": (np.int8, "i8"), "float16": (np.float16, "f16")}
+
+
+def quantize(matrix: np.ndarray, dtype: str):
+    """(rows, per-row scales) of float32 vectors, int8 is scaled symmetrically per row."""
+    if dtype == "float16":
+        return matrix.astype(np.float16), np.ones(len(matrix), dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    rows = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return rows, scales.astype(np.float32)
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Centroids of a plain Lloyd's k-means, good enough to partition an IVF index."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(vectors, centroids)
+        for i in range(k):
+            members = vectors[assignment == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+    return centroids
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, count: int = 1) -> np.ndarray:
+    # |x - c|^2 without the |x|^2 term, which is the same for every centroid.
+    distances = (centroids * centroids).sum(axis=1) - 2 * vectors @ centroids.T
+    if count == 1:
+        return distances.argmin(axis=1)
+    return np.argsort(distances, axis=1)[:, :count]
+
+
+class LocalCollection:
+    """A vector collection in a local directory, with the subset of the Chroma collection API used here.
+
+    Embeddings are appended to `vectors.<generation>.i8` (or `.f16`) and
+    searched through a memory map with NumPy dot products, block by block.
+    int8 rows carry a per-row scale. Ids, documents and metadata live in the
+    `index.db` SQLite sidecar; metadata is also kept in memory to evaluate
+    Chroma `where` filters. Distances are squared L2 like Chroma's default.
+
+    Writes are append-only, a replaced or deleted node only frees its row at
+    the next compaction, which rewrites the file under a new generation.
+    Collections of `ivf_min_nodes` nodes or more are partitioned with
+    k-means and only the `ivf_probes` nearest partitions are scanned.
+    """
+
+    def __init__(self, path: str, name: str, dtype: str = "int8", ivf_min_nodes: int = 0, ivf_probes: int = 16):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.name = name
+        self.ivf_min_nodes = ivf_min_nodes
+        self.ivf_probes = ivf_probes
+        self._lock = threading.RLock()
+
+        self.conn = sqlite3.connect(os.path.join(path, "index.db"), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS nodes '
+            '(row INTEGER PRIMARY KEY, id TEXT UNIQUE, document TEXT, metadata TEXT, scale REAL, norm REAL)'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+        meta = dict(self.conn.execute('SELECT name, value FROM meta').fetchall())
+        # The dtype of an existing collection wins over the configured one.
+        self.dtype = meta.get("dtype", dtype)
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        self.generation = int(meta.get("generation", 0))
+        self._np_dtype, extension = DTYPES[self.dtype]
+        self._extension = extension
+        self._load()
+
+    # --- storage -------------------------------------------------------------
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.path, f"vectors.{self.generation}.{self._extension}")
+
+    @property
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(self._np_dtype).itemsize
+
+    def _load(self):
+        self.rows = 0
+        if self.dim and os.path.exists(self.vectors_path):
+            # Drop a partially written last row.
+            self.rows = os.path.getsize(self.vectors_path) // self._row_bytes
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(self.rows * self._row_bytes)
+        self._ids = [None] * self.rows
+        self._metadatas = [None] * self.rows
+        self._scales = np.ones(self.rows, dtype=np.float32)
+        self._norms = np.zeros(self.rows, dtype=np.float32)
+        self._row_of = {}
+        for row, id_, metadata, scale, norm in self.conn.execute(
+            'SELECT row, id, metadata, scale, norm FROM nodes WHERE row < ?', (self.rows,)
+        ):
+            self._ids[row] = id_
+            self._metadatas[row] = json.loads(metadata) if metadata else {}
+            self._scales[row] = scale
+            self._norms[row] = norm
+            self._row_of[id_] = row
+        self._alive = np.zeros(self.rows, dtype=bool)
+        self._alive[list(self._row_of.values())] = True
+        self._columns = {}
+        self._map = None
+        self._mapped_rows = 0
+        self._ivf = self._load_ivf()
+
+    def _vectors(self):
+        if self._map is None or self._mapped_rows != self.rows:
+            # A plain ndarray view: indexing a np.memmap costs more than the small blocks it returns.
+            self._map = np.memmap(
+                self.vectors_path, dtype=self._np_dtype, mode="r", shape=(self.rows, self.dim)
+            ).view(np.ndarray)
+            self._mapped_rows = self.rows
+        return self._map
+
+    def _dequantize(self, rows: np.ndarray) -> np.ndarray:
+        if not len(rows):
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self._vectors()[rows].astype(np.float32) * self._scales[rows, None]
+
+    def _set_meta(self, name: str, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, str(value)))
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._row_of)
+
+    def _write(self, ids, embeddings, metadatas, documents, replace: bool):
+        ids = list(ids)
+        if not ids:
+            return
+        if embeddings is None:
+            raise ValueError("Local collections need the embeddings of the nodes they store")
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        metadatas = list(metadatas) if metadatas is not None else [None] * len(ids)
+        documents = list(documents) if documents is not None else [None] * len(ids)
+        with self._lock:
+            if not replace:
+                # Like Chroma's add(), ids that are already stored are ignored.
+                keep = [i for i, id_ in enumerate(ids) if id_ not in self._row_of]
+                ids = [ids[i] for i in keep]
+                matrix, metadatas, documents = matrix[keep], [metadatas[i] for i in keep], [documents[i] for i in keep]
+                if not ids:
+                    return
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._set_meta("dim", self.dim)
+                self._set_meta("dtype", self.dtype)
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match the collection ({self.dim})")
+
+            replaced = [self._row_of[id_] for id_ in ids if id_ in self._row_of]
+            rows, scales = quantize(matrix, self.dtype)
+            norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+            with open(self.vectors_path, "ab") as f:
+                f.write(rows.tobytes())
+            first = self.rows
+            self.conn.executemany('DELETE FROM nodes WHERE id = ?', [(id_,) for id_ in ids])
+            self.conn.executemany(
+                'INSERT INTO nodes (row, id, document, metadata, scale, norm) VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (first + i, id_, document, json.dumps(metadata or {}), float(scale), float(norm))
+                    for i, (id_, document, metadata, scale, norm) in enumerate(zip(ids, documents, metadatas, scales, norms))
+                ]
+            )
+            self.conn.commit()
+
+            self.rows += len(ids)
+            self._ids.extend(ids)
+            self._metadatas.extend(dict(metadata or {}) for metadata in metadatas)
+            self._scales = np.concatenate([self._scales, scales])
+            self._norms = np.concatenate([self._norms, norms])
+            self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+            self._alive[replaced] = False
+            for i, id_ in enumerate(ids):
+                self._row_of[id_] = first + i
+            self._columns = {}
+            self._maybe_compact()
+            # Partitioning a big collection takes a while, the indexing job pays for it rather than a query.
+            self._update_ivf()
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None, **kwargs):
+        self._write(ids, embeddings, metadatas, documents, replace=False)
+
+    def upsert(self, ids, embeddings=None, metadatas=None, documents=None, **kwargs):
+        self._write(ids, embeddings, metadatas, documents, replace=True)
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, **kwargs):
+        with self._lock:
+            rows = self._select_rows(ids, where)
+            if not len(rows):
+                return
+            removed = [self._ids[row] for row in rows]
+            for start in range(0, len(removed), LOOKUP_CHUNK):
+                chunk = removed[start:start + LOOKUP_CHUNK]
+                self.conn.execute(f'DELETE FROM nodes WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+            self.conn.commit()
+            for id_ in removed:
+                del self._row_of[id_]
+            self._alive[rows] = False
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        dead = self.rows - len(self._row_of)
+        if dead >= COMPACT_MIN_DEAD_ROWS and dead > len(self._row_of):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the vector file without its dead rows, as a new generation."""
+        with self._lock:
+            live = np.flatnonzero(self._alive)
+            vectors = self._vectors() if self.rows else None
+            old_path = self.vectors_path
+            self.generation += 1
+            with open(self.vectors_path, "wb") as f:
+                for start in range(0, len(live), BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(vectors[live[start:start + BLOCK_ROWS]]).tobytes())
+            # New rows are never above the old ones, renumbering in row order cannot collide.
+            self.conn.executemany(
+                'UPDATE nodes SET row = ? WHERE row = ?', [(new, int(old)) for new, old in enumerate(live)]
+            )
+            self._set_meta("generation", self.generation)
+            self.conn.commit()
+            self._map = vectors = None
+            if os.path.exists(old_path):
+                os.remove(old_path)
+            for name in os.listdir(self.path):
+                if name.startswith("ivf."):
+                    os.remove(os.path.join(self.path, name))
+            self._load()
+
+    # --- filters -------------------------------------------------------------
+
+    def _column(self, key: str) -> list:
+        column = self._columns.get(key)
+        if column is None:
+            column = self._columns[key] = [
+                metadata.get(key) if metadata is not None else None for metadata in self._metadatas
+            ]
+        return column
+
+    def _compare(self, key: str, operator: str, operand) -> np.ndarray:
+        column = self._column(key)
+        if operator in ("$in", "$nin"):
+            operand = set(operand)
+            test = (lambda v: v in operand) if operator == "$in" else (lambda v: v not in operand)
+        else:
+            test = {
+                "$eq": lambda v: v == operand,
+                "$ne": lambda v: v != operand,
+                "$gt": lambda v: v > operand,
+                "$gte": lambda v: v >= operand,
+                "$lt": lambda v: v < operand,
+                "$lte": lambda v: v <= operand,
+            }.get(operator)
+            if test is None:
+                raise ValueError(f"Unsupported filter operator {operator}")
+        # Like Chroma, nodes without the key only match the negative operators.
+        missing = operator in ("$ne", "$nin")
+        return np.fromiter(
+            (missing if value is None else test(value) for value in column), dtype=bool, count=len(column)
+        )
+
+    def _where_mask(self, where: dict) -> np.ndarray:
+        mask = np.ones(self.rows, dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self._where_mask(clause)
+            elif key == "$or":
+                mask &= np.logical_or.reduce([self._where_mask(clause) for clause in condition])
+            elif isinstance(condition, dict):
+                for operator, operand in condition.items():
+                    mask &= self._compare(key, operator, operand)
+            else:
+                mask &= self._compare(key, "$eq", condition)
+        return mask
+
+    def _select_rows(self, ids=None, where=None) -> np.ndarray:
+        """Live rows with the given ids and matching `where`, in insertion order."""
+        if ids is not None:
+            mask = np.zeros(self.rows, dtype=bool)
+            mask[[self._row_of[id_] for id_ in ids if id_ in self._row_of]] = True
+        else:
+            mask = self._alive.copy()
+        if where:
+            mask &= self._where_mask(where)
+        return np.flatnonzero(mask)
+
+    # --- reads ---------------------------------------------------------------
+
+    def _documents(self, rows) -> List[Optional[str]]:
+        documents = {}
+        ids = [self._ids[row] for row in rows]
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[start:start + LOOKUP_CHUNK]
+            documents.update(self.conn.execute(
+                f'SELECT id, document FROM nodes WHERE id IN ({",".join("?" * len(chunk))})', chunk
+            ).fetchall())
+        return [documents.get(id_) for id_ in ids]
+
+    def _results(self, rows, include) -> dict:
+        return {
+            "ids": [self._ids[row] for row in rows],
+            "metadatas": [dict(self._metadatas[row]) for row in rows] if "metadatas" in include else None,
+            "documents": self._documents(rows) if "documents" in include else None,
+            "embeddings": self._dequantize(np.asarray(rows, dtype=np.int64)) if "embeddings" in include else None,
+        }
+
+    def get(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[dict] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        include=("metadatas", "documents"),
+        **kwargs,
+    ) -> dict:
+        with self._lock:
+            rows = self._select_rows(ids, where)
+            start = offset or 0
+            rows = rows[start:start + limit] if limit is not None else rows[start:]
+            return self._results(rows, include)
+
+    def query(
+        self,
+        query_embeddings,
+        n_results: int = 10,
+        where: Optional[dict] = None,
+        include=("metadatas", "documents", "distances"),
+        **kwargs,
+    ) -> dict:
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None]
+        results = {"ids": [], "distances": [], "metadatas": [], "documents": [], "embeddings": []}
+        with self._lock:
+            candidates = self._select_rows(where=where)
+            for query in queries:
+                rows, distances = self._search(query, candidates, n_results)
+                found = self._results(rows, include)
+                for key in ("ids", "metadatas", "documents", "embeddings"):
+                    results[key].append(found[key])
+                results["distances"].append(distances.tolist())
+        return {key: value if key == "ids" or key in include else None for key, value in results.items()}
+
+    def _search(self, query: np.ndarray, rows: np.ndarray, k: int):
+        if self.dim is None or not len(rows) or k <= 0:
+            return [], np.zeros(0, dtype=np.float32)
+        if self.ivf_min_nodes and len(rows) >= self.ivf_min_nodes:
+            rows = self._probe(query, rows)
+        dots = np.empty(len(rows), dtype=np.float32)
+        buffer = np.empty((SCAN_ROWS, self.dim), dtype=np.float32)
+        vectors = self._vectors()
+        contiguous = rows[-1] - rows[0] + 1 == len(rows)
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            # A slice of the memory map avoids copying the rows before the conversion.
+            stored = vectors[block[0]:block[-1] + 1] if contiguous else vectors[block]
+            for offset in range(0, len(block), SCAN_ROWS):
+                converted = buffer[:min(SCAN_ROWS, len(block) - offset)]
+                np.copyto(converted, stored[offset:offset + len(converted)], casting="unsafe")
+                dots[start + offset:start + offset + len(converted)] = converted @ query
+        dots *= self._scales[rows]
+        distances = self._norms[rows] ** 2 + float(query @ query) - 2 * dots
+        if k < len(rows):
+            best = np.argpartition(distances, k - 1)[:k]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.argsort(distances[best], kind="stable")]
+        return rows[best], distances[best]
+
+    # --- IVF -----------------------------------------------------------------
+
+    def _ivf_path(self) -> str:
+        return os.path.join(self.path, f"ivf.{self.generation}.npz")
+
+    def _load_ivf(self):
+        if not self.ivf_min_nodes or not os.path.exists(self._ivf_path()):
+            return None
+        with np.load(self._ivf_path()) as ivf:
+            return self._inverted_lists(ivf["centroids"], ivf["assignment"], int(ivf["trained_on"]))
+
+    @staticmethod
+    def _inverted_lists(centroids: np.ndarray, assignment: np.ndarray, trained_on: int) -> dict:
+        # The rows of partition i are lists[bounds[i]:bounds[i + 1]].
+        lists = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[lists], np.arange(len(centroids) + 1))
+        return {
+            "centroids": centroids,
+            "assignment": assignment,
+            "trained_on": trained_on,
+            "lists": lists,
+            "bounds": bounds,
+        }
+
+    def _assign(self, centroids: np.ndarray, start: int) -> np.ndarray:
+        parts = [np.zeros(0, dtype=np.int32)]
+        for first in range(start, self.rows, BLOCK_ROWS):
+            rows = np.arange(first, min(first + BLOCK_ROWS, self.rows))
+            parts.append(nearest_centroids(self._dequantize(rows), centroids).astype(np.int32))
+        return np.concatenate(parts)
+
+    def _update_ivf(self):
+        """Partition a big collection, or add the new rows to the nearest partitions."""
+        if not self.ivf_min_nodes or len(self._row_of) < self.ivf_min_nodes:
+            return
+        # Partitions are retrained once the collection has doubled since they were built.
+        if self._ivf is None or len(self._row_of) > 2 * self._ivf["trained_on"]:
+            live = np.flatnonzero(self._alive)
+            count = max(1, int(np.sqrt(len(live))))
+            sample = np.random.default_rng(0).choice(live, min(len(live), count * 64), replace=False)
+            centroids = kmeans(self._dequantize(np.sort(sample)), count)
+            assignment, trained_on = self._assign(centroids, 0), len(live)
+        elif len(self._ivf["assignment"]) < self.rows:
+            centroids, trained_on = self._ivf["centroids"], self._ivf["trained_on"]
+            assignment = np.concatenate([self._ivf["assignment"], self._assign(centroids, len(self._ivf["assignment"]))])
+        else:
+            return
+        np.savez(self._ivf_path(), centroids=centroids, assignment=assignment, trained_on=trained_on)
+        self._ivf = self._inverted_lists(centroids, assignment, trained_on)
+
+    def _probe(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """The candidate rows in the partitions nearest to the query."""
+        if self._ivf is None or len(self._ivf["assignment"]) < self.rows:
+            self._update_ivf()
+        ivf = self._ivf
+        probes = nearest_centroids(query[None], ivf["centroids"], min(self.ivf_probes, len(ivf["centroids"])))[0]
+        probed = np.sort(np.concatenate([ivf["lists"][ivf["bounds"][p]:ivf["bounds"][p + 1]] for p in probes]))
+        selected = np.zeros(self.rows, dtype=bool)
+        selected[rows] = True
+        return probed[selected[probed]]
+
+    def close(self):
+        with self._lock:
+            self._map = None
+            self.conn.close()
+
+
+class LocalVectorClient:
+    """Drop-in for the Chroma client: one LocalCollection directory per collection under `path`."""
+
+    def __init__(self, path: str, dtype: str = "int8", ivf_min_nodes: int = 0, ivf_probes: int = 16):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype}, expected one of {sorted(DTYPES)}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = dtype
+        self.ivf_min_nodes = ivf_min_nodes
+        self.ivf_probes = ivf_probes
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def _collection_path(self, name: str) -> str:
+        if not COLLECTION_NAME.fullmatch(name):
+            raise ValueError(f"Invalid collection name {name!r}")
+        return os.path.join(self.path, name)
+
+    def get_or_create_collection(self, name: str, **kwargs) -> LocalCollection:
+        path = self._collection_path(name)
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = LocalCollection(
+                    path, name, dtype=self.dtype, ivf_min_nodes=self.ivf_min_nodes, ivf_probes=self.ivf_probes
+                )
+            return self._collections[name]
+
+    def get_collection(self, name: str, **kwargs) -> LocalCollection:
+        if not os.path.isdir(self._collection_path(name)):
+            raise ValueError(f"Collection {name} does not exist.")
+        return self.get_or_create_collection(name)
+
+    def delete_collection(self, name: str):
+        path = self._collection_path(name)
+        with self._lock:
+            collection = self._collections.pop(name, None)
+            if collection is not None:
+                collection.close()
+            if not os.path.isdir(path):
+                raise ValueError(f"Collection {name} does not exist.")
+            shutil.rmtree(path)
+
+    def list_collections(self) -> List[LocalCollection]:
+        names = sorted(name for name in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, name)))
+        return [self.get_collection(name) for name in names]
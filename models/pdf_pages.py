@@ -0,0 +1,16 @@
+from typing import List
+
+from pypdf import PdfReader
+
+# Kept free of llama_index / config imports: this module is what the
+# parsing processes import.
+
+
+def count_pdf_pages(file_path: str) -> int:
+    return len(PdfReader(file_path).pages)
+
+
+def parse_pdf_pages(file_path: str, start: int, stop: int) -> List[tuple]:
+    """(text, page_label) of pages [start, stop), like PDFReader does for the whole file."""
+    reader = PdfReader(file_path)
+    return [(reader.pages[i].extract_text(), reader.page_labels[i]) for i in range(start, stop)]
@@ -0,0 +1,425 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+import numpy as np
+from llama_index.core import StorageContext, VectorStoreIndex, get_response_synthesizer
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.packs.raptor.base import DEFAULT_SUMMARY_PROMPT
+from llama_index.vector_stores.chroma import ChromaVectorStore
+
+from models.ingestion import iter_node_batches
+from models.lexical_index import partition_name
+from models.raptor_clustering import ClusterFn, umap_gmm_clusters
+
+logger = logging.getLogger(__name__)
+
+# Metadata used for tree bookkeeping, never embedded nor shown to the LLM.
+TREE_METADATA_KEYS = ["doc_id", "level", "parent_id", "user_id"]
+# Metadata a rewritten summary keeps from the one it replaces.
+SUMMARY_METADATA_KEYS = TREE_METADATA_KEYS + ["file_name"]
+
+
+def file_doc_id(file_path: str) -> str:
+    """Content hash of a file, so re-uploading the same PDF is a no-op."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hide_tree_metadata(node: BaseNode):
+    for key in TREE_METADATA_KEYS:
+        if key not in node.excluded_embed_metadata_keys:
+            node.excluded_embed_metadata_keys.append(key)
+        if key not in node.excluded_llm_metadata_keys:
+            node.excluded_llm_metadata_keys.append(key)
+
+
+async def with_retries(fn, max_retries: int = 3, base_delay: float = 1.0):
+    """Await fn(), retrying failures with exponential backoff and jitter."""
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = base_delay * 2 ** attempt * (0.5 + random.random())
+            logger.warning(f"Attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+def tenant_where(tenant_id: str | None, **conditions) -> dict:
+    """Chroma `where` on the given metadata, restricted to one tenant of a shared collection."""
+    if tenant_id is not None:
+        conditions["user_id"] = tenant_id
+    if len(conditions) == 1:
+        return conditions
+    return {"$and": [{key: value} for key, value in conditions.items()]}
+
+
+def set_doc_id(node: BaseNode, doc_id: str):
+    # The vector store writes the node's ref_doc_id over a "doc_id" metadata key, so the source must match.
+    node.metadata["doc_id"] = doc_id
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=doc_id)
+
+
+def summary_node(text: str, level: int, **metadata) -> TextNode:
+    node = TextNode(text=text, metadata={"level": level, **metadata})
+    if metadata.get("doc_id"):
+        set_doc_id(node, metadata["doc_id"])
+    hide_tree_metadata(node)
+    return node
+
+
+class IncrementalRaptorBuilder:
+    """Adds documents to a RAPTOR collection one at a time.
+
+    Every document gets its own subtree: its chunks plus summary levels
+    0..tree_depth-2, built exactly like RaptorPack but over that document only.
+    Only the top level (tree_depth-1) summarizes across documents. The roots of
+    a new document join the closest existing top summary, which is rewritten in
+    place under the same id, or form new top summaries. Other documents keep
+    their vectors untouched.
+
+    With `cross_document_top=False` (shared document store) the document gets
+    all tree_depth levels on its own and nothing is summarized across documents.
+
+    Embeddings are sent `embed_batch_size` texts per call, and all clusters of
+    a level are summarized concurrently, at most `summary_concurrency` at a
+    time. Both retry with backoff. Time per level and stage is returned with
+    the result. `clusterer` groups the nodes of a level (see
+    models/raptor_clustering.py), RaptorPack's UMAP + GMM by default.
+
+    A `lexical_index` (BM25) is kept in step with every node written or
+    deleted.
+
+    remove_documents() deletes the nodes of some documents and rewrites, level
+    by level, only the summaries above them; summaries left without children
+    are deleted too.
+
+    With a `tenant_id`, the collection is shared by many users: every node
+    is tagged with user_id and the builder only ever reads and joins the
+    nodes of that tenant.
+    """
+
+    def __init__(
+        self,
+        collection,
+        embed_model,
+        llm,
+        tree_depth: int = 3,
+        join_threshold: float = 0.8,
+        cross_document_top: bool = True,
+        embed_batch_size: int = 96,
+        embed_concurrency: int = 4,
+        summary_concurrency: int = 16,
+        max_retries: int = 3,
+        retry_base_delay: float = 1.0,
+        lexical_index=None,
+        tenant_id: str | None = None,
+        clusterer: ClusterFn | None = None,
+    ):
+        self.collection = collection
+        self.embed_model = embed_model
+        self.tree_depth = tree_depth
+        self.top_level = tree_depth - 1
+        self.join_threshold = join_threshold
+        self.cross_document_top = cross_document_top
+        self.embed_batch_size = embed_batch_size
+        self.embed_concurrency = embed_concurrency
+        self.summary_concurrency = summary_concurrency
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.lexical_index = lexical_index
+        self.tenant_id = tenant_id
+        self.clusterer = clusterer or umap_gmm_clusters
+        self.tenant_metadata = {"user_id": tenant_id} if tenant_id is not None else {}
+        self.lexical_partition = partition_name(collection.name, tenant_id)
+        self.summary_synthesizer = get_response_synthesizer(response_mode="tree_summarize", use_async=True, llm=llm)
+        self.timings = {}
+        self.transformations = [SentenceSplitter()]
+        self.index = VectorStoreIndex(
+            nodes=[],
+            storage_context=StorageContext.from_defaults(
+                vector_store=ChromaVectorStore(chroma_collection=collection)
+            ),
+            embed_model=embed_model,
+        )
+
+    def has_document(self, doc_id: str, file_name: str | None = None) -> bool:
+        conditions = {"doc_id": doc_id} if file_name is None else {"doc_id": doc_id, "file_name": file_name}
+        return len(self.collection.get(where=self._where(**conditions), limit=1)["ids"]) > 0
+
+    def _where(self, **conditions) -> dict:
+        return tenant_where(self.tenant_id, **conditions)
+
+    @contextmanager
+    def _timed(self, level, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            level_timings = self.timings.setdefault(level, {})
+            level_timings[stage] = level_timings.get(stage, 0.0) + time.perf_counter() - started
+
+    async def _retrying(self, slots: asyncio.Semaphore, fn):
+        async with slots:
+            return await with_retries(fn, self.max_retries, self.retry_base_delay)
+
+    async def _embed(self, nodes: List[BaseNode]) -> Dict[str, List[float]]:
+        texts = [node.get_content(metadata_mode="embed") for node in nodes]
+        batches = [texts[i:i + self.embed_batch_size] for i in range(0, len(texts), self.embed_batch_size)]
+        results = await asyncio.gather(*(
+            self._retrying(self._embed_slots, lambda batch=batch: self.embed_model.aget_text_embedding_batch(batch))
+            for batch in batches
+        ))
+        embeddings = [embedding for result in results for embedding in result]
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        return {node.id_: embedding for node, embedding in zip(nodes, embeddings)}
+
+    async def _summarize(self, clusters: List[List[BaseNode]]) -> List[str]:
+        """Summarize every cluster of a level concurrently."""
+        async def summarize(cluster):
+            response = await self.summary_synthesizer.aget_response(
+                DEFAULT_SUMMARY_PROMPT, [node.get_content(metadata_mode="llm") for node in cluster]
+            )
+            return str(response)
+
+        return list(await asyncio.gather(*(
+            self._retrying(self._summary_slots, lambda cluster=cluster: summarize(cluster))
+            for cluster in clusters
+        )))
+
+    def _cluster(self, nodes: List[BaseNode], id_to_embedding) -> List[List[BaseNode]]:
+        # The mixture models of umap_gmm need a few points to fit.
+        if len(nodes) <= 2:
+            return [nodes]
+        return self.clusterer(nodes, id_to_embedding)
+
+    async def _parse_and_embed(self, file_path: str, doc_id: str, report):
+        """Chunk and embed the document while its later pages are still being parsed."""
+        batches = iter_node_batches([file_path], self.transformations)
+        nodes, id_to_embedding = [], {}
+        while True:
+            with self._timed(0, "parse"):
+                batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                return nodes, id_to_embedding
+            for node in batch:
+                set_doc_id(node, doc_id)
+                node.metadata.update(self.tenant_metadata)
+                hide_tree_metadata(node)
+            report("embed", level=0, nodes=len(nodes) + len(batch))
+            with self._timed(0, "embed"):
+                id_to_embedding.update(await self._embed(batch))
+            nodes.extend(batch)
+
+    @staticmethod
+    def _link(cluster: List[BaseNode], parent: BaseNode):
+        for node in cluster:
+            node.metadata["parent_id"] = parent.id_
+            hide_tree_metadata(node)
+
+    def _start(self):
+        self.timings = {}
+        # Created per call: asyncio primitives are bound to the event loop running the build.
+        self._embed_slots = asyncio.Semaphore(self.embed_concurrency)
+        self._summary_slots = asyncio.Semaphore(self.summary_concurrency)
+
+    async def add_document(self, file_path: str, progress=None, doc_id: str | None = None) -> dict:
+        """Index one file. `progress(stage, **detail)` is called as the build moves through its stages."""
+        report = progress or (lambda stage, **detail: None)
+        started = time.perf_counter()
+        self._start()
+        doc_id = doc_id or file_doc_id(file_path)
+        file_name = os.path.basename(file_path)
+        # Files are filtered and deleted by name: the same content under another name gets its own nodes.
+        # Without a cross-document top (shared documents) users reach a document by doc_id instead.
+        if self.has_document(doc_id, file_name if self.cross_document_top else None):
+            return {"doc_id": doc_id, "file_name": file_name, "skipped": True}
+
+        if self.cross_document_top:
+            # An older version of the same file is replaced.
+            await self._remove({"file_name": file_name}, report)
+
+        report("parse", file_name=file_name)
+        cur_nodes, id_to_embedding = await self._parse_and_embed(file_path, doc_id, report)
+
+        # Per-document subtree, levels 0..tree_depth-2 (or all levels without a cross-document top).
+        new_nodes = []
+        for level in range(self.top_level if self.cross_document_top else self.tree_depth):
+            if level > 0:
+                report("embed", level=level, nodes=len(cur_nodes))
+                with self._timed(level, "embed"):
+                    id_to_embedding = await self._embed(cur_nodes)
+            report("cluster", level=level, nodes=len(cur_nodes))
+            with self._timed(level, "cluster"):
+                clusters = self._cluster(cur_nodes, id_to_embedding)
+            report("summarize", level=level, clusters=len(clusters))
+            with self._timed(level, "summarize"):
+                summaries = await self._summarize(clusters)
+            parents = [
+                summary_node(summary, level, doc_id=doc_id, file_name=file_name, **self.tenant_metadata)
+                for summary in summaries
+            ]
+            for cluster, parent in zip(clusters, parents):
+                self._link(cluster, parent)
+            new_nodes.extend(cur_nodes)
+            cur_nodes = parents
+
+        roots = cur_nodes
+        report("embed", level=self.top_level, nodes=len(roots))
+        with self._timed(self.top_level, "embed"):
+            await self._embed(roots)
+        new_nodes.extend(roots)
+        refreshed_tops = []
+        if self.cross_document_top:
+            report("summarize", level=self.top_level, roots=len(roots))
+            with self._timed(self.top_level, "summarize"):
+                new_tops, refreshed_tops = await self._attach_roots(roots)
+            new_nodes.extend(new_tops)
+
+        report("persist", nodes=len(new_nodes) + len(refreshed_tops))
+        if refreshed_tops:
+            self._delete([node.id_ for node in refreshed_tops])
+            new_nodes.extend(refreshed_tops)
+        with self._timed("store", "persist"):
+            self._insert(new_nodes)
+
+        return {
+            "doc_id": doc_id,
+            "file_name": file_name,
+            "skipped": False,
+            "nodes_added": len(new_nodes) - len(refreshed_tops),
+            "summaries_refreshed": len(refreshed_tops),
+            "seconds": time.perf_counter() - started,
+            "levels": self.timings,
+        }
+
+    async def _attach_roots(self, roots: List[BaseNode]):
+        """Hang the document roots under the top level, returns (new tops, rewritten tops)."""
+        existing = self.collection.get(where=self._where(level=self.top_level), include=["embeddings"])
+        top_ids = existing["ids"]
+        top_matrix = np.array(existing["embeddings"]) if top_ids else None
+
+        joined = {}
+        unassigned = []
+        for root in roots:
+            if top_matrix is not None:
+                scores = top_matrix @ np.array(root.embedding)
+                scores /= np.linalg.norm(top_matrix, axis=1) * np.linalg.norm(root.embedding) + 1e-12
+                best = int(np.argmax(scores))
+                if scores[best] >= self.join_threshold:
+                    root.metadata["parent_id"] = top_ids[best]
+                    hide_tree_metadata(root)
+                    joined.setdefault(top_ids[best], []).append(root)
+                    continue
+            unassigned.append(root)
+
+        new_tops = []
+        if unassigned:
+            clusters = self._cluster(unassigned, {root.id_: root.embedding for root in unassigned})
+            summaries = await self._summarize(clusters)
+            for cluster, summary in zip(clusters, summaries):
+                top = summary_node(summary, self.top_level, **self.tenant_metadata)
+                self._link(cluster, top)
+                new_tops.append(top)
+
+        # Only the top summaries that gained children are re-summarized, under the same id.
+        refreshed_tops = []
+        if joined:
+            top_ids = list(joined)
+            children_per_top = [self._stored_children(top_id) + joined[top_id] for top_id in top_ids]
+            summaries = await self._summarize(children_per_top)
+            for top_id, summary in zip(top_ids, summaries):
+                top = summary_node(summary, self.top_level, **self.tenant_metadata)
+                top.id_ = top_id
+                refreshed_tops.append(top)
+
+        if new_tops or refreshed_tops:
+            await self._embed(new_tops + refreshed_tops)
+        return new_tops, refreshed_tops
+
+    async def remove_documents(self, where: dict, progress=None) -> dict:
+        """Delete the nodes matching `where`, metadata keys to values or Chroma operators, e.g. {"file_name": {"$in": [...]}}."""
+        report = progress or (lambda stage, **detail: None)
+        started = time.perf_counter()
+        self._start()
+        result = await self._remove(where, report)
+        return {**result, "seconds": time.perf_counter() - started, "levels": self.timings}
+
+    async def _remove(self, where: dict, report) -> dict:
+        removed = set(self.collection.get(where=self._where(**where), include=[])["ids"])
+        result = {"nodes_removed": len(removed), "summaries_refreshed": 0, "summaries_removed": 0}
+        if not removed:
+            return result
+
+        # Every ancestor of the removed nodes, found one level up at a time.
+        affected = {}
+        frontier = list(removed)
+        while frontier:
+            stored = self.collection.get(ids=frontier, include=["metadatas"])
+            parent_ids = {
+                metadata.get("parent_id") for metadata in stored["metadatas"] if metadata and metadata.get("parent_id")
+            } - removed - affected.keys()
+            parents = self.collection.get(ids=list(parent_ids), include=["metadatas"]) if parent_ids else {"ids": []}
+            affected.update(zip(parents["ids"], parents.get("metadatas") or []))
+            frontier = parents["ids"]
+
+        report("remove", nodes=len(removed), summaries=len(affected))
+        with self._timed("store", "remove"):
+            self._delete(list(removed))
+
+        # Bottom-up, so each summary is rewritten from children that are already up to date.
+        for level in sorted({metadata.get("level", 0) for metadata in affected.values()}):
+            ids = [id_ for id_, metadata in affected.items() if metadata.get("level", 0) == level]
+            children = [self._stored_children(id_) for id_ in ids]
+            emptied = [id_ for id_, cluster in zip(ids, children) if not cluster]
+            kept = [(id_, cluster) for id_, cluster in zip(ids, children) if cluster]
+            self._delete(emptied)
+            result["summaries_removed"] += len(emptied)
+            if not kept:
+                continue
+
+            report("summarize", level=level, clusters=len(kept))
+            with self._timed(level, "summarize"):
+                summaries = await self._summarize([cluster for _, cluster in kept])
+            refreshed = []
+            for (id_, _), summary in zip(kept, summaries):
+                metadata = {key: value for key, value in affected[id_].items() if key in SUMMARY_METADATA_KEYS}
+                metadata.pop("level", None)
+                node = summary_node(summary, level, **metadata)
+                node.id_ = id_
+                refreshed.append(node)
+            with self._timed(level, "embed"):
+                await self._embed(refreshed)
+            with self._timed("store", "persist"):
+                self._delete([node.id_ for node in refreshed])
+                self._insert(refreshed)
+            result["summaries_refreshed"] += len(refreshed)
+        return result
+
+    def _insert(self, nodes: List[BaseNode]):
+        self.index.insert_nodes(nodes)
+        if self.lexical_index is not None:
+            self.lexical_index.add(self.lexical_partition, nodes)
+
+    def _delete(self, node_ids: List[str]):
+        if not node_ids:
+            return
+        self.collection.delete(ids=node_ids)
+        if self.lexical_index is not None:
+            self.lexical_index.delete(self.lexical_partition, node_ids)
+
+    def _stored_children(self, parent_id: str) -> List[BaseNode]:
+        stored = self.collection.get(where={"parent_id": parent_id}, include=["documents"])
+        return [TextNode(id_=id_, text=text) for id_, text in zip(stored["ids"], stored["documents"])]
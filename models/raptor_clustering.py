@@ -0,0 +1,196 @@
+"""Clustering of one RAPTOR level: the nodes of each cluster are summarized together.
+
+Every method takes the nodes and their embeddings (by node id) and returns
+lists of nodes. "umap_gmm" is RaptorPack's own (UMAP, then Gaussian mixtures
+chosen by BIC, at every level). The others skip UMAP and the BIC sweep:
+
+* "kmeans": spherical k-means on the embeddings, about `cluster_size` nodes
+  per cluster. Mini-batches above `batch_size` nodes; the `n_init` restarts
+  run on `workers` threads (NumPy releases the GIL in its matrix products).
+* "agglomerative": Ward linkage on a PCA reduction to `reduction_dimension`.
+  Quadratic in memory, meant for the per-document levels.
+
+Like RaptorPack, a cluster above `max_cluster_tokens` tokens is split again,
+so that its summary prompt stays bounded.
+"""
+import functools
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+ClusterFn = Callable[[List[BaseNode], Dict[str, List[float]]], List[List[BaseNode]]]
+
+RANDOM_SEED = 224  # RaptorPack's
+
+
+def umap_gmm_clusters(nodes: List[BaseNode], embedding_map: Dict[str, List[float]]) -> List[List[BaseNode]]:
+    # umap compiles with numba when imported, only pay for it when this method is used.
+    from llama_index.packs.raptor.clustering import get_clusters
+
+    return get_clusters(nodes, embedding_map)
+
+
+@functools.lru_cache(maxsize=1)
+def _tokenizer():
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _normalized(nodes: List[BaseNode], embedding_map) -> np.ndarray:
+    vectors = np.array([embedding_map[node.id_] for node in nodes], dtype=np.float32)
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+
+def _kmeans_plus_plus(vectors: np.ndarray, k: int, rng) -> np.ndarray:
+    centroids = np.empty((k, vectors.shape[1]), dtype=np.float32)
+    centroids[0] = vectors[rng.integers(len(vectors))]
+    distances = np.maximum(1 - vectors @ centroids[0], 0)
+    for i in range(1, k):
+        total = distances.sum()
+        index = rng.choice(len(vectors), p=distances / total) if total > 0 else rng.integers(len(vectors))
+        centroids[i] = vectors[index]
+        distances = np.minimum(distances, np.maximum(1 - vectors @ centroids[i], 0))
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray):
+    similarities = vectors @ centroids.T
+    labels = similarities.argmax(axis=1)
+    return labels, similarities[np.arange(len(vectors)), labels]
+
+
+def _renormalize(centroids: np.ndarray) -> np.ndarray:
+    return centroids / (np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12)
+
+
+def _spherical_kmeans(vectors: np.ndarray, k: int, seed: int, iterations: int, batch_size: int):
+    """(labels, inertia) of one k-means run on unit vectors, cosine distance."""
+    rng = np.random.default_rng(seed)
+    centroids = _kmeans_plus_plus(vectors, k, rng)
+    if len(vectors) <= batch_size:
+        labels = None
+        for _ in range(iterations):
+            new_labels, similarities = _assign(vectors, centroids)
+            if labels is not None and np.array_equal(labels, new_labels):
+                break
+            labels = new_labels
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, vectors)
+            empty = np.bincount(labels, minlength=k) == 0
+            # An empty cluster restarts from the point its centroid fits worst.
+            sums[empty] = vectors[np.argsort(similarities)[:empty.sum()]]
+            centroids = _renormalize(sums)
+    else:
+        counts = np.zeros(k)
+        for _ in range(iterations):
+            batch = vectors[rng.choice(len(vectors), batch_size, replace=False)]
+            batch_labels, _ = _assign(batch, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, batch_labels, batch)
+            batch_counts = np.bincount(batch_labels, minlength=k)
+            counts += batch_counts
+            # Per-centroid learning rate 1 / (points seen so far), as in mini-batch k-means.
+            moved = batch_counts > 0
+            centroids[moved] += (sums[moved] - batch_counts[moved, None] * centroids[moved]) / counts[moved, None]
+            centroids = _renormalize(centroids)
+    labels, similarities = _assign(vectors, centroids)
+    return labels, float((1 - similarities).sum())
+
+
+def _groups(labels: np.ndarray) -> List[List[int]]:
+    """Positions per label, in label order of first appearance."""
+    groups = {}
+    for i, label in enumerate(labels):
+        groups.setdefault(int(label), []).append(i)
+    return list(groups.values())
+
+
+def _split_oversized(nodes, vectors, groups, max_cluster_tokens: int, split) -> List[List[BaseNode]]:
+    """Split the clusters whose text is longer than max_cluster_tokens in two until they fit."""
+    tokens = None
+    clusters = []
+    pending = list(groups)
+    while pending:
+        group = pending.pop()
+        if len(group) > 1 and max_cluster_tokens:
+            if tokens is None:
+                tokens = np.array([len(_tokenizer().encode(node.get_content())) for node in nodes])
+            if tokens[group].sum() > max_cluster_tokens:
+                halves = [[group[i] for i in half] for half in _groups(split(vectors[group], 2))]
+                if len(halves) > 1:
+                    pending.extend(halves)
+                    continue
+        clusters.append([nodes[i] for i in group])
+    return clusters
+
+
+def kmeans_clusters(
+    nodes: List[BaseNode],
+    embedding_map: Dict[str, List[float]],
+    cluster_size: int = 8,
+    max_cluster_tokens: int = 10000,
+    iterations: int = 30,
+    batch_size: int = 1024,
+    n_init: int = 4,
+    workers: int | None = None,
+    seed: int = RANDOM_SEED,
+) -> List[List[BaseNode]]:
+    if len(nodes) <= cluster_size:
+        return [nodes]
+    vectors = _normalized(nodes, embedding_map)
+
+    def split(points: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(points))
+        runs = [seed + i for i in range(n_init)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda run: _spherical_kmeans(points, k, run, iterations, batch_size), runs))
+        return min(results, key=lambda result: result[1])[0]
+
+    groups = _groups(split(vectors, math.ceil(len(nodes) / cluster_size)))
+    return _split_oversized(nodes, vectors, groups, max_cluster_tokens, split)
+
+
+def agglomerative_clusters(
+    nodes: List[BaseNode],
+    embedding_map: Dict[str, List[float]],
+    cluster_size: int = 8,
+    max_cluster_tokens: int = 10000,
+    reduction_dimension: int = 32,
+) -> List[List[BaseNode]]:
+    if len(nodes) <= cluster_size:
+        return [nodes]
+    from sklearn.cluster import AgglomerativeClustering
+
+    vectors = _normalized(nodes, embedding_map)
+    centered = vectors - vectors.mean(axis=0)
+    # PCA through the SVD of the centered vectors.
+    _, _, components = np.linalg.svd(centered, full_matrices=False)
+    reduced = centered @ components[:reduction_dimension].T
+
+    def split(points: np.ndarray, k: int) -> np.ndarray:
+        if len(points) <= k:
+            return np.arange(len(points))
+        return AgglomerativeClustering(n_clusters=k, linkage="ward").fit_predict(points)
+
+    groups = _groups(split(reduced, math.ceil(len(nodes) / cluster_size)))
+    return _split_oversized(nodes, reduced, groups, max_cluster_tokens, split)
+
+
+CLUSTERING_METHODS = {
+    "umap_gmm": umap_gmm_clusters,
+    "kmeans": kmeans_clusters,
+    "agglomerative": agglomerative_clusters,
+}
+
+
+def get_clusterer(method: str = "umap_gmm", **options) -> ClusterFn:
+    """The clustering function of a method, with its options bound ("umap_gmm" takes none)."""
+    if method not in CLUSTERING_METHODS:
+        raise ValueError(f"Unknown clustering method {method}, expected one of {sorted(CLUSTERING_METHODS)}")
+    if method == "umap_gmm":
+        return umap_gmm_clusters
+    return functools.partial(CLUSTERING_METHODS[method], **options)
@@ -1,28 +1,100 @@
 from models.config import *
+import asyncio
+import hashlib
 import time
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.core import SimpleDirectoryReader
-from llama_index.packs.raptor import RaptorPack
-from llama_index.packs.raptor import RaptorRetriever
-# from models.custom_raptor_retriever import CustomRaptorRetriever as RaptorRetriever
-from llama_index.embeddings.cohere import CohereEmbedding
-from llama_index.core.query_engine import RetrieverQueryEngine
-import pandas as pd
+from llama_index.core.base.response.schema import Response
+from llama_index.core.query_engine import CustomQueryEngine, RetrieverQueryEngine
+from llama_index.core.retrievers import BaseRetriever
+import threading
+from collections import OrderedDict
 
 from fastapi.concurrency import run_in_threadpool
 
-import chromadb
+from models.startup import startup
+from models.embedding_cache import CachedEmbedding, EmbeddingStore, embedding_store_path
+from models.lexical_index import LexicalIndex, partition_name
+from models.user_files import get_user_DB
+
+# chromadb and the RAPTOR pack (umap, sklearn) are slow to import,
+# they are imported where they are first needed instead of at server start.
+
+
+def new_embed_model():
+    from llama_index.embeddings.cohere import CohereEmbedding
+    embed_model = CohereEmbedding(
+        model_name=EMBEDDING_MODEL,
+        api_key=cohere_api_key,
+        embed_batch_size=RAPTOR_EMBED_BATCH_SIZE,
+    )  # Explicitly passing the API key
+    if not EMBEDDING_CACHE_ENABLED:
+        return embed_model
+    return CachedEmbedding(embed_model, store=embedding_store.get())
+
+
+def new_embedding_store():
+    return EmbeddingStore(embedding_store_path(EMBEDDING_CACHE_PATH, EMBEDDING_MODEL))
+
+
+def new_lexical_index():
+    return LexicalIndex(LEXICAL_INDEX_PATH)
+
+
+def new_chroma_client():
+    if RAPTOR_VECTOR_BACKEND == "local":
+        from models.local_vector_store import LocalVectorClient
+        return LocalVectorClient(
+            LOCAL_VECTOR_PATH,
+            dtype=LOCAL_VECTOR_DTYPE,
+            ivf_min_nodes=LOCAL_VECTOR_IVF_MIN_NODES,
+            ivf_probes=LOCAL_VECTOR_IVF_PROBES,
+        )
+    import chromadb
+    return chromadb.PersistentClient(path=CHROMA_PATH)
+
+
+# One Chroma client (or local vector client, same API) per process, shared by every collection.
+chroma_client = startup.register("chroma_client", new_chroma_client)
+# Embeddings already computed for a text are read from disk, by the tree build and by queries.
+embedding_store = startup.register("embedding_store", new_embedding_store)
+# One Cohere embedding client per process, shared by retrieval on the serving path.
+embed_model = startup.register("embed_model", new_embed_model)
+# BM25 index of every collection, fused with the vector results.
+lexical_index = startup.register("lexical_index", new_lexical_index)
+
+
+def get_chroma_client():
+    return chroma_client.get()
+
+
+def get_embed_model():
+    return embed_model.get()
+
+
+def get_lexical_index():
+    return lexical_index.get() if RETRIEVAL_HYBRID else None
 
 class RAPTOR:
-    def __init__(self, files, llm, collection_name="edubot_raptor", force_rebuild=False):
+    def __init__(
+        self,
+        files,
+        llm,
+        collection_name="edubot_raptor",
+        force_rebuild=False,
+        doc_ids=None,
+        excluded_file_names=None,
+        tenant_id=None,
+    ):
         self.files = files
+        self.tenant_id = tenant_id
+        self.doc_ids = doc_ids
+        self.excluded_file_names = excluded_file_names
         self.collection_name = collection_name
         self.llm = llm
         # Set up logging
         print("Initializing RAPTOR with collection_name: %s", collection_name)
 
         try:
-            self.client = chromadb.PersistentClient(path="chroma_db")
+            self.client = get_chroma_client()
 
             if force_rebuild:
                 print("Force rebuilding collection...")
@@ -33,14 +105,13 @@ class RAPTOR:
 
             self.collection = self.client.get_or_create_collection(collection_name)
 
+            from llama_index.vector_stores.chroma import ChromaVectorStore
             self.vector_store = ChromaVectorStore(chroma_collection=self.collection)
 
-            print("Loading provided documents...")
-
-            if force_rebuild or len(os.listdir("chroma_db")) == 1:
-                self.documents = SimpleDirectoryReader(input_files=files).load_data()
-                self.retriever = self.build_raptor_tree()
-            #How to wait for retriever is done ?
+            # Without force_rebuild the persisted tree is only opened; the course collection is
+            # filled by models.course_index, users' collections by their uploads.
+            if force_rebuild:
+                self.build_raptor_tree()
 
             self.retriever = self.setup_retriever()
             self.query_engine = self.setup_query_engine()
@@ -51,20 +122,14 @@ class RAPTOR:
 
     def build_raptor_tree(self):
         try:
-            print("Creating RaptorPack and building raptor tree...")
-            raptor_pack = RaptorPack(
-                self.documents,
-                embed_model=CohereEmbedding(
-                    model_name=EMBEDDING_MODEL,
-                    api_key=cohere_api_key
-                ),  # Explicitly passing the API key
-                llm=self.llm,
-                vector_store=self.vector_store,
-                similarity_top_k=SIMILARITY_TOP_K,
-                mode=RETRIEVAL_METHOD,
+            # Same tree and clustering (RAPTOR_CLUSTERING) as an upload, one file after the other.
+            print("Building raptor tree with the incremental builder...")
+            builder = new_builder(
+                self.collection_name, self.llm, join_threshold=RAPTOR_JOIN_THRESHOLD, tenant_id=self.tenant_id
             )
-            modules = raptor_pack.get_modules()
-            return modules["retriever"]
+            for file_path in self.files:
+                result = asyncio.run(builder.add_document(file_path))
+                print(f"Indexed {file_path}: {result}")
         except Exception as e:
             print("An error occurred while building raptor tree: %s", e)
             raise
@@ -72,16 +137,26 @@ class RAPTOR:
     def setup_retriever(self):
         try:
             print("Setting up RaptorRetriever")
+            from models.custom_raptor_retriever import CustomRaptorRetriever as RaptorRetriever
+            lexical = get_lexical_index()
+            if lexical is not None:
+                lexical.sync(self.collection, tenant_id=self.tenant_id)
             return RaptorRetriever(
                 [],
-                embed_model=CohereEmbedding(
-                    model_name=EMBEDDING_MODEL,
-                    api_key=cohere_api_key
-                ),  # Explicitly passing the API key
+                embed_model=get_embed_model(),
                 llm=self.llm,
                 vector_store=self.vector_store,
                 similarity_top_k=SIMILARITY_TOP_K,
+                tree_depth=RAPTOR_TREE_DEPTH,
                 mode=RETRIEVAL_METHOD,
+                tenant_id=self.tenant_id,
+                doc_ids=self.doc_ids,
+                excluded_file_names=self.excluded_file_names,
+                children_top_k=RAPTOR_CHILDREN_TOP_K,
+                lexical_index=lexical,
+                lexical_collection=partition_name(self.collection_name, self.tenant_id),
+                rrf_k=HYBRID_RRF_K,
+                fast_path_max_terms=LEXICAL_FAST_PATH_MAX_TERMS,
             )
         except Exception as e:
             print("An error occurred while setting up RaptorRetriever: %s", e)
@@ -99,15 +174,6 @@ class RAPTOR:
             raise
 
 UPLOAD_DIR = "models/uploaded_files"
-STATE_FILE = "models/file_state.csv"
-
-def get_files():
-    df = pd.read_csv(STATE_FILE)
-    used_files_df = df[df['is_used'] == True]
-    used_files = used_files_df['file_name'].tolist()
-    full_paths = [os.path.join(UPLOAD_DIR, file) for file in used_files]
-    print("full_paths", full_paths)
-    return full_paths
 
 
 def get_files_user(user_id, file_paths):
@@ -115,8 +181,293 @@ def get_files_user(user_id, file_paths):
     return full_paths
 
 
-def get_raptor(files, llm, force_rebuild=False):
-    velociraptor = RAPTOR(files=files,llm=llm, collection_name="edubot_raptor", force_rebuild=force_rebuild)
-    return velociraptor
+class RetrievedContextQueryEngine(CustomQueryEngine):
+    """Answers with the text of the retrieved nodes, for tools whose answer is written by one final prompt."""
+
+    retriever: BaseRetriever
+
+    def custom_query(self, query_str: str):
+        nodes = self.retriever.retrieve(query_str)
+        return Response(response=node_context(nodes), source_nodes=nodes)
+
+    async def acustom_query(self, query_str: str):
+        nodes = await self.retriever.aretrieve(query_str)
+        return Response(response=node_context(nodes), source_nodes=nodes)
+
+
+def node_context(nodes) -> str:
+    return "\n\n".join(node.node.get_content() for node in nodes)
+
+
+def get_course_query_engine(llm, raw_output=False):
+    """Query engine over the course collection as last synced by models.course_index."""
+    velociraptor = RAPTOR(files=[], llm=llm, collection_name=COURSE_COLLECTION)
+    if raw_output:
+        return RetrievedContextQueryEngine(retriever=velociraptor.retriever)
+    return velociraptor.query_engine
+
+
+
+
+class QueryEnginePool:
+    """Size-bounded LRU of ready RAPTOR query engines, keyed by collection name.
+
+    An engine captures the user's files (doc ids, tombstones) when it is
+    built. invalidate() bumps the key's generation, so an engine whose build
+    was under way at the time is returned to its caller but never pooled.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, factory):
+        with self._lock:
+            if key in self._engines:
+                self._engines.move_to_end(key)
+                self.hits += 1
+                return self._engines[key]
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # Concurrent misses for the same key wait for a single build.
+        with build_lock:
+            with self._lock:
+                if key in self._engines:
+                    self.hits += 1
+                    return self._engines[key]
+                self.misses += 1
+                generation = self._generations.get(key, 0)
+            engine = factory()
+            with self._lock:
+                if self._generations.get(key, 0) == generation:
+                    self._engines[key] = engine
+                    while len(self._engines) > self.max_size:
+                        self._engines.popitem(last=False)
+                        self.evictions += 1
+                self._build_locks.pop(key, None)
+            return engine
+
+    def invalidate(self, key):
+        with self._lock:
+            self._engines.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._engines),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+query_engine_pool = QueryEnginePool(RAPTOR_ENGINE_POOL_SIZE)
+
+
+def tenant_collection(user_id):
+    """Shard of the tenant layout holding a user's nodes, stable across restarts and processes."""
+    shard = int(hashlib.sha1(user_id.encode("utf-8")).hexdigest(), 16) % RAPTOR_TENANT_SHARDS
+    return f"{TENANT_COLLECTION_PREFIX}_{shard:03d}"
+
+
+def user_storage(user_id):
+    """(collection name, tenant id) of a user's own collection, tenant id None unless shared by tenants."""
+    if RAPTOR_STORAGE_LAYOUT == "tenant":
+        return tenant_collection(user_id), user_id
+    return user_id, None
+
+
+def build_user_query_engine(user_id, llm):
+    if RAPTOR_STORAGE_LAYOUT == "dedup":
+        db = get_user_DB()
+        doc_ids = db.get_user_document_ids(user_id)
+        db.close()
+        return RAPTOR(
+            files=[], collection_name=SHARED_DOCUMENTS_COLLECTION, llm=llm, force_rebuild=False, doc_ids=doc_ids
+        ).query_engine
+    db = get_user_DB()
+    deleted_files = db.get_tombstones(user_id)
+    db.close()
+    collection_name, tenant_id = user_storage(user_id)
+    return RAPTOR(
+        files=[],
+        collection_name=collection_name,
+        llm=llm,
+        force_rebuild=False,
+        excluded_file_names=deleted_files,
+        tenant_id=tenant_id,
+    ).query_engine
+
+
+def get_user_query_engine(user_id, llm):
+    """Ready query engine over the user's documents, built once and reused until invalidated."""
+    return query_engine_pool.get(user_id, lambda: build_user_query_engine(user_id, llm))
+
+
+def get_user_file_query_engine(user_id, file_paths, llm):
+    """The user's pooled query engine, restricted to some of the uploaded files (all files when empty)."""
+    engine = get_user_query_engine(user_id, llm)
+    if not file_paths:
+        return engine
+    file_names = [os.path.basename(file_path) for file_path in file_paths]
+    if RAPTOR_STORAGE_LAYOUT == "dedup":
+        # Shared nodes carry the file name of whoever uploaded the document first.
+        db = get_user_DB()
+        doc_ids = db.get_user_document_ids(user_id, file_names)
+        db.close()
+        return engine.with_retriever(engine.retriever.scoped(doc_ids=doc_ids))
+    return engine.with_retriever(engine.retriever.scoped(file_names=file_names))
+
+
+def invalidate_user_query_engine(user_id):
+    """Call after the user's collection changes (upload / delete)."""
+    query_engine_pool.invalidate(user_id)
+
+
+def new_clusterer():
+    from models.raptor_clustering import get_clusterer
+    if RAPTOR_CLUSTERING == "umap_gmm":
+        return get_clusterer(RAPTOR_CLUSTERING)
+    options = dict(cluster_size=RAPTOR_CLUSTER_SIZE)
+    if RAPTOR_CLUSTERING == "kmeans":
+        options["workers"] = RAPTOR_CLUSTER_WORKERS
+    return get_clusterer(RAPTOR_CLUSTERING, **options)
+
+
+def new_builder(collection_name, llm, **kwargs):
+    from models.raptor_builder import IncrementalRaptorBuilder
+
+    return IncrementalRaptorBuilder(
+        get_chroma_client().get_or_create_collection(collection_name),
+        embed_model=new_embed_model(),  # the build runs in its own event loop
+        llm=llm,
+        tree_depth=RAPTOR_TREE_DEPTH,
+        embed_batch_size=RAPTOR_EMBED_BATCH_SIZE,
+        embed_concurrency=RAPTOR_EMBED_CONCURRENCY,
+        summary_concurrency=RAPTOR_SUMMARY_CONCURRENCY,
+        max_retries=RAPTOR_BUILD_MAX_RETRIES,
+        lexical_index=get_lexical_index(),
+        clusterer=new_clusterer(),
+        **kwargs,
+    )
+
+
+def index_user_file(user_id, file_path, llm, progress=None):
+    """Add one uploaded PDF to the user's collection; the user's other documents are not re-processed."""
+    if RAPTOR_STORAGE_LAYOUT == "dedup":
+        return index_shared_document(user_id, file_path, llm, progress=progress)
+
+    collection_name, tenant_id = user_storage(user_id)
+    builder = new_builder(collection_name, llm, join_threshold=RAPTOR_JOIN_THRESHOLD, tenant_id=tenant_id)
+    result = asyncio.run(builder.add_document(file_path, progress=progress))
+    print(f"Indexed {file_path} for {user_id}: {result}")
+    return result
+
+
+_document_locks = {}
+_document_locks_lock = threading.Lock()
+
+
+def document_lock(doc_id):
+    """Serializes the indexing of one document when several users upload it at the same time."""
+    with _document_locks_lock:
+        return _document_locks.setdefault(doc_id, threading.Lock())
+
+
+def store_unique_file(file_path, doc_id):
+    """Keep one copy of each unique PDF: the user's file becomes a hard link to it."""
+    os.makedirs(DOCUMENT_STORE_DIR, exist_ok=True)
+    stored_path = os.path.join(DOCUMENT_STORE_DIR, f"{doc_id}.pdf")
+    try:
+        if not os.path.exists(stored_path):
+            os.link(file_path, stored_path)
+        elif not os.path.samefile(file_path, stored_path):
+            tmp_path = f"{file_path}.tmp"
+            os.link(stored_path, tmp_path)
+            os.replace(tmp_path, file_path)
+    except OSError as e:
+        # Hard links are not supported everywhere; the upload then simply keeps its own copy.
+        print(f"Could not deduplicate {file_path}: {e}")
+    return stored_path
+
+
+def index_shared_document(user_id, file_path, llm, progress=None):
+    """Index a PDF into the shared collection once, then reference it from the user."""
+    from models.raptor_builder import file_doc_id
+
+    doc_id = file_doc_id(file_path)
+    # The reference is recorded under the lock too: remove_shared_document must not
+    # see the document unreferenced between its indexing and the user's reference.
+    with document_lock(doc_id):
+        store_unique_file(file_path, doc_id)
+        builder = new_builder(SHARED_DOCUMENTS_COLLECTION, llm, cross_document_top=False)
+        result = asyncio.run(builder.add_document(file_path, progress=progress, doc_id=doc_id))
+        db = get_user_DB()
+        db.add_user_document(user_id, os.path.basename(file_path), doc_id)
+        db.close()
+    print(f"Indexed {file_path} for {user_id}: {result}")
+    return result
+
+
+def tombstone_user_file(user_id, file_name):
+    """Hide a deleted file from the user's retrieval at once, returns its number of nodes still stored."""
+    from models.raptor_builder import tenant_where
+
+    collection_name, tenant_id = user_storage(user_id)
+    collection = get_chroma_client().get_or_create_collection(collection_name)
+    nodes = len(collection.get(where=tenant_where(tenant_id, file_name=file_name), include=[])["ids"])
+    db = get_user_DB()
+    db.add_tombstone(user_id, file_name, nodes)
+    db.close()
+    return nodes
+
+
+def clear_tombstone(user_id, file_name):
+    """A file uploaded again under a deleted name must not stay hidden."""
+    db = get_user_DB()
+    db.remove_tombstones(user_id, [file_name])
+    db.close()
+
+
+def compact_user_collection(user_id, llm, progress=None):
+    """Remove the nodes of the user's tombstoned files and refresh only the summaries above them."""
+    db = get_user_DB()
+    file_names = db.get_tombstones(user_id)
+    db.close()
+    if not file_names:
+        return {"files": []}
+
+    collection_name, tenant_id = user_storage(user_id)
+    builder = new_builder(collection_name, llm, tenant_id=tenant_id)
+    result = asyncio.run(builder.remove_documents({"file_name": {"$in": file_names}}, progress=progress))
+    db = get_user_DB()
+    db.remove_tombstones(user_id, file_names)
+    db.close()
+    print(f"Compacted {user_id}: {result}")
+    return {"files": file_names, **result}
 
 
+def remove_shared_document(doc_id, llm, progress=None):
+    """Drop a document from the shared collection once no user references it any more."""
+    with document_lock(doc_id):
+        db = get_user_DB()
+        references = db.count_document_references(doc_id)
+        db.close()
+        if references:
+            return {"doc_id": doc_id, "skipped": True}
+        builder = new_builder(SHARED_DOCUMENTS_COLLECTION, llm, cross_document_top=False)
+        result = asyncio.run(builder.remove_documents({"doc_id": doc_id}, progress=progress))
+        stored_path = os.path.join(DOCUMENT_STORE_DIR, f"{doc_id}.pdf")
+        if os.path.exists(stored_path):
+            os.remove(stored_path)
+    return {"doc_id": doc_id, "skipped": False, **result}
@@ -0,0 +1,237 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, List
+
+import numpy as np
+
+from models.lexical_index import STOPWORDS
+from models.text_similarity import WORD_RE, cosine, extract_user_query, normalize_text, question_key, text_vector
+
+logger = logging.getLogger(__name__)
+
+# Operators and symbols ("==", "C#", "C++", "x += 1"), which normalize_text drops.
+SYMBOL_RE = re.compile(r"[^\w\s'-]")
+# Words that only say a question is asked; every other word must be shared ("list vs tuple" is not "list vs dict").
+QUESTION_WORDS = STOPWORDS | frozenset("""
+define definition definitions describe difference explain example examples mean means meaning meanings me
+please tell about word term vs versus use used using
+giải thích nghĩa định ví dụ cách sao thế
+""".split())
+
+
+@dataclass
+class SemanticCacheEntry:
+    question: str
+    intent: str
+    answer: str
+    vector: dict | np.ndarray
+    key_terms: frozenset
+    expires_at: float
+    hits: int = field(default=0)
+
+
+def content_word(word: str) -> str:
+    """Lowercase word without a plural "s", so "closures" and "closure" compare equal."""
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def key_terms(question: str) -> frozenset:
+    """Terms two questions must share to share an answer, whatever their similarity.
+
+    Numbers, named entities and symbols ("ES6", "Python 3.12", "JavaScript",
+    "C#", "===") and the content words, i.e. every word but QUESTION_WORDS.
+    An entity is a word with a digit, a capital after its first letter, or a
+    capital first letter anywhere but at the start of the question.
+    """
+    terms = {content_word(word) for word in normalize_text(question).split() if word not in QUESTION_WORDS}
+    for position, word in enumerate(WORD_RE.findall(extract_user_query(question))):
+        if word.lower() in QUESTION_WORDS:
+            continue
+        if any(c.isdigit() for c in word) or word[1:] != word[1:].lower() or (position and word[0].isupper()):
+            terms.add(word.lower())
+    for token in question_key(question).split():
+        token = token.rstrip(",;:?.!") or token
+        if SYMBOL_RE.search(token):
+            terms.add(token)
+    return frozenset(terms)
+
+
+class SemanticCache:
+    """Nearest-neighbour cache of past answers, partitioned by intent.
+
+    With `embed_fn` (text -> embedding), questions are compared by the cosine
+    of their embeddings, so paraphrases and translations ("define X", "X
+    nghĩa là gì") find each other; the entries of an intent are scored in one
+    matrix product. Without it they are vectorized locally and a lookup only
+    scans the entries sharing a word with the question (inverted index).
+    Either way the best entry above `threshold` is returned, provided it has
+    the same numbers, named entities, symbols and content words as the
+    question (key_terms).
+    Entries are keyed by question_key, which keeps symbols: "What is C#?"
+    never finds the answer to "What is C++?".
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        ttl_per_intent: dict | None = None,
+        default_ttl: float = 3600,
+        max_entries_per_intent: int = 5000,
+        embed_fn: Callable[[str], List[float]] | None = None,
+    ):
+        self.threshold = threshold
+        self.ttl_per_intent = ttl_per_intent or {}
+        self.default_ttl = default_ttl
+        self.max_entries_per_intent = max_entries_per_intent
+        self.embed_fn = embed_fn
+        self._entries = {}  # intent -> OrderedDict[question_key -> entry]
+        self._index = {}  # intent -> {normalized word -> set of question keys}
+        self._matrices = {}  # intent -> (question keys, embedding matrix), rebuilt after a change
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _ttl(self, intent: str) -> float:
+        return self.ttl_per_intent.get(intent, self.default_ttl)
+
+    def _vector(self, key: str):
+        if self.embed_fn is None:
+            return text_vector(key)
+        vector = np.asarray(self.embed_fn(key), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _candidates(self, intent: str, key: str, vector):
+        """(score, question key) of the entries of `intent`, best first."""
+        entries = self._entries[intent]
+        if self.embed_fn is None:
+            candidates = set()
+            for word in set(normalize_text(key).split()):
+                candidates |= self._index[intent].get(word, set())
+            scored = [(cosine(vector, entries[candidate].vector), candidate) for candidate in candidates]
+            return sorted(scored, reverse=True)
+        if intent not in self._matrices:
+            keys = list(entries)
+            self._matrices[intent] = (keys, np.stack([entries[name].vector for name in keys]) if keys else None)
+        keys, matrix = self._matrices[intent]
+        if matrix is None:
+            return []
+        scores = matrix @ vector
+        return [(float(scores[i]), keys[i]) for i in np.argsort(-scores)]
+
+    def _nearest(self, key: str, vector, terms: frozenset, now: float):
+        best, best_score = None, self.threshold
+        for intent, entries in self._entries.items():
+            for score, candidate in self._candidates(intent, key, vector):
+                if score < best_score:
+                    break
+                entry = entries[candidate]
+                if entry.expires_at > now and entry.key_terms == terms:
+                    best, best_score = entry, score
+                    break
+        return best
+
+    def lookup(self, question: str) -> SemanticCacheEntry | None:
+        key = question_key(question)
+        if not key:
+            return None
+        terms = key_terms(question)
+        now = time.time()
+
+        with self._lock:
+            # The same key is the same question up to case and spacing, symbols included.
+            best = next((
+                entries[key] for entries in self._entries.values()
+                if key in entries and entries[key].expires_at > now
+            ), None)
+        if best is None:
+            try:
+                # Outside the lock: embedding the question may call the embedding API.
+                vector = self._vector(key)
+            except Exception as e:
+                logger.warning("Semantic cache lookup failed to embed the question: %s", e)
+                vector = None
+            if vector is not None:
+                with self._lock:
+                    best = self._nearest(key, vector, terms, now)
+
+        with self._lock:
+            if best is None:
+                self.misses += 1
+                return None
+            best.hits += 1
+            self.hits += 1
+            return best
+
+    def store(self, question: str, intent: str, answer: str):
+        ttl = self._ttl(intent)
+        key = question_key(question)
+        if ttl <= 0 or not key or not answer:
+            return
+        try:
+            vector = self._vector(key)
+        except Exception as e:
+            logger.warning("Semantic cache store skipped, no embedding: %s", e)
+            return
+        entry = SemanticCacheEntry(
+            question=key,
+            intent=intent,
+            answer=answer,
+            vector=vector,
+            key_terms=key_terms(question),
+            expires_at=time.time() + ttl,
+        )
+        with self._lock:
+            entries = self._entries.setdefault(intent, OrderedDict())
+            if key in entries:
+                self._remove(intent, key)
+            entries[key] = entry
+            self._matrices.pop(intent, None)
+            for word in set(normalize_text(key).split()):
+                self._index.setdefault(intent, {}).setdefault(word, set()).add(key)
+            while len(entries) > self.max_entries_per_intent:
+                self._remove(intent, next(iter(entries)))
+
+    def _remove(self, intent: str, key: str):
+        self._entries[intent].pop(key, None)
+        self._matrices.pop(intent, None)
+        index = self._index.get(intent, {})
+        for word in set(normalize_text(key).split()):
+            keys = index.get(word)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[word]
+
+    def invalidate(self, intent: str | None = None, question: str | None = None) -> int:
+        """Drop entries of one intent, one question, or everything. Returns the number removed."""
+        key = question_key(question) if question else None
+        removed = 0
+        with self._lock:
+            for name in list(self._entries):
+                if intent and name != intent:
+                    continue
+                if key is not None:
+                    if key in self._entries[name]:
+                        self._remove(name, key)
+                        removed += 1
+                    continue
+                removed += len(self._entries[name])
+                del self._entries[name]
+                self._index.pop(name, None)
+                self._matrices.pop(name, None)
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": {intent: len(entries) for intent, entries in self._entries.items()},
+            }
@@ -0,0 +1,41 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Collapse identical concurrent requests into one in-flight computation.
+
+    The first caller for a key starts the work as a task; callers arriving
+    while it runs await the same task. The task is shielded, so a caller that
+    disconnects does not cancel the work for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.executed += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        total = self.executed + self.shared
+        return {
+            "executed": self.executed,
+            "saved": self.shared,
+            "saved_rate": self.shared / total if total else 0.0,
+            "in_flight": len(self._calls),
+        }
@@ -4,6 +4,9 @@ from llama_index.llms.google_genai import GoogleGenAI
 from sqlalchemy import text, create_engine, MetaData
 from sqlalchemy.schema import CreateTable
 from pydantic import Field
+from functools import lru_cache
+import asyncio
+import json
 import os
 
 
@@ -38,6 +41,18 @@ def get_create_table_statement(table_name: str) -> str:
         print(f"An error occurred while generating the CREATE TABLE statement: {e}")
         return None
 
+def get_schemas_str() -> str:
+    """CREATE TABLE statements of every table, from a single reflection of the database."""
+    try:
+        metadata = MetaData()
+        metadata.reflect(bind=get_engine())
+        print(f"Tables in the database: {list(metadata.tables.keys())}")
+        return "\n".join(str(CreateTable(table)) for table in metadata.tables.values())
+    except Exception as e:
+        print(f"An error occurred while reflecting the database schema: {e}")
+        return ""
+
+@lru_cache(maxsize=None)
 def get_engine():
     db_path = os.path.join(os.path.dirname(__file__), 'db', 'database.db')
     db_uri = f'sqlite:///{db_path}'
@@ -85,11 +100,22 @@ def get_sql_template(schemas_str: str):
                 )
     return sql_prompt
 
+def format_rows(query_str: str, rows) -> str:
+    """Compact JSON of the executed query and its rows keyed by column name."""
+    if rows is None:
+        return json.dumps({"sql": query_str, "error": "query failed"})
+    return json.dumps(
+        {"sql": query_str, "rows": [row._asdict() for row in rows]},
+        ensure_ascii=False, default=str
+    )
+
 class SQLQueryEngine(CustomQueryEngine):
     """Custom query engine for SQL queries."""
 
     llm: GoogleGenAI | None = Field(default=None)
     prompt: PromptTemplate
+    # Return rows keyed by column so the final answer prompt can use them directly.
+    raw_output: bool = Field(default=False)
 
     def custom_query(self, query_str: str):
 
@@ -104,10 +130,30 @@ class SQLQueryEngine(CustomQueryEngine):
 
         print(f"SQL result: {result}")
 
+        if self.raw_output:
+            return format_rows(query_normalized, result)
+
         # st.session_state["generated_query.text"] = query_normalized # ???
 
         # answer_prompt = f"Answer the user question: {query_str} based on the result from the database query: {result}. Answer in Croatian."
         # answer = llm.complete(answer_prompt)
 
         return str(result)
-        # return str(answer)
\ No newline at end of file
+        # return str(answer)
+
+    async def acustom_query(self, query_str: str):
+
+        llm_prompt = self.prompt.format(query_str=query_str)
+
+        generated_query = await self.llm.acomplete(llm_prompt)
+
+        query_normalized = remove_sql_markdown(generated_query.text)
+
+        # SQLite is blocking, keep it off the event loop
+        result = await asyncio.to_thread(run_query, query_normalized)
+
+        print(f"SQL result: {result}")
+
+        if self.raw_output:
+            return format_rows(query_normalized, result)
+        return str(result)
\ No newline at end of file
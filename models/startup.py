@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LazyComponent:
+    """A component built on first use, exactly once, with its build time recorded."""
+
+    def __init__(self, name: str, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self.ready = False
+        self.seconds = None
+        self.error = None
+
+    def get(self):
+        if self.ready:
+            return self._value
+        with self._lock:
+            if not self.ready:
+                started = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.seconds = time.perf_counter() - started
+                self.error = None
+                self.ready = True
+                logger.info("Initialized %s in %.3fs", self.name, self.seconds)
+            return self._value
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "seconds": self.seconds, "error": self.error}
+
+
+class StartupRegistry:
+    """Lazy components of the server, plus timings of the eager startup phases."""
+
+    def __init__(self):
+        self._components = {}
+        self._phases = {}
+        self._warm_up_thread = None
+
+    def register(self, name: str, factory) -> LazyComponent:
+        component = LazyComponent(name, factory)
+        self._components[name] = component
+        return component
+
+    def record_phase(self, name: str, seconds: float):
+        self._phases[name] = seconds
+
+    def warm_up(self, names=None):
+        """Build the given components (all by default) in registration order, errors are only logged."""
+        started = time.perf_counter()
+        for name in names or list(self._components):
+            try:
+                self._components[name].get()
+            except Exception as e:
+                logger.warning(f"Warm-up of {name} failed: {e}")
+        self.record_phase("warm_up", time.perf_counter() - started)
+
+    def start_warm_up(self, names=None) -> threading.Thread:
+        """Warm up in a daemon thread, so the server accepts traffic right away."""
+        if self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(
+                target=self.warm_up, args=(names,), name="startup-warm-up", daemon=True
+            )
+            self._warm_up_thread.start()
+        return self._warm_up_thread
+
+    def is_ready(self, names=None) -> bool:
+        """The given components (all by default) are built."""
+        return all(self._components[name].ready for name in (self._components if names is None else names))
+
+    def serving_ready(self, required=()) -> bool:
+        """Ready for traffic: the warm-up, if one was started, is over and the `required` components are built.
+
+        Without warm-up the components are built by the first requests, so
+        the server is ready as soon as it runs. A component that failed to
+        warm up and is not required is retried by the first request using it.
+        """
+        if self._warm_up_thread is None:
+            return True
+        return not self._warm_up_thread.is_alive() and self.is_ready(required)
+
+    def stats(self, required=()) -> dict:
+        return {
+            "ready": self.serving_ready(required),
+            "required": list(required),
+            "phases": dict(self._phases),
+            "components": {name: c.status() for name, c in self._components.items()},
+        }
+
+
+startup = StartupRegistry()
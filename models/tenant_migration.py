@@ -0,0 +1,70 @@
+"""Move per-user RAPTOR collections into the shared collections of the "tenant" layout.
+
+    python -m models.tenant_migration [--users USER ...] [--delete]
+
+Nodes are copied with their embeddings, nothing is re-embedded nor
+re-summarized, and tagged with user_id. A user whose nodes are all in the
+shard already is skipped, so the migration can be interrupted and run
+again. Switch RAPTOR_STORAGE_LAYOUT to "tenant" once it is done; --delete
+then drops the per-user collections.
+"""
+import argparse
+
+from models.config import COURSE_COLLECTION, SHARED_DOCUMENTS_COLLECTION, TENANT_COLLECTION_PREFIX
+from models.raptor_query import get_chroma_client, get_lexical_index, tenant_collection
+
+PAGE_SIZE = 500
+
+
+def per_user_collections(client):
+    """Names of the collections of the per-user layout."""
+    names = [getattr(collection, "name", collection) for collection in client.list_collections()]
+    return [
+        name for name in names
+        if not name.startswith(f"{TENANT_COLLECTION_PREFIX}_")
+        and name not in (SHARED_DOCUMENTS_COLLECTION, COURSE_COLLECTION)
+    ]
+
+
+def migrate_user(client, user_id: str, delete: bool = False) -> int:
+    """Copy one user's collection into its shard, returns the number of nodes copied."""
+    source = client.get_collection(user_id)
+    target = client.get_or_create_collection(tenant_collection(user_id))
+    total = source.count()
+    copied = len(target.get(where={"user_id": user_id}, include=[])["ids"])
+    if copied != total:
+        for offset in range(0, total, PAGE_SIZE):
+            page = source.get(include=["embeddings", "documents", "metadatas"], limit=PAGE_SIZE, offset=offset)
+            target.upsert(
+                ids=page["ids"],
+                embeddings=page["embeddings"],
+                documents=page["documents"],
+                metadatas=[{**(metadata or {}), "user_id": user_id} for metadata in page["metadatas"]],
+            )
+        copied = total
+
+    lexical = get_lexical_index()
+    if lexical is not None:
+        lexical.sync(target, tenant_id=user_id)
+    if delete:
+        client.delete_collection(user_id)
+        if lexical is not None:
+            lexical.drop(user_id)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", nargs="+", help="Only these users (default: every per-user collection).")
+    parser.add_argument("--delete", action="store_true", help="Drop each per-user collection once copied.")
+    args = parser.parse_args()
+
+    client = get_chroma_client()
+    user_ids = args.users or per_user_collections(client)
+    for i, user_id in enumerate(user_ids, 1):
+        nodes = migrate_user(client, user_id, delete=args.delete)
+        print(f"[{i}/{len(user_ids)}] {user_id}: {nodes} nodes -> {tenant_collection(user_id)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+CHAT_WRAPPER_RE = re.compile(r"^\s*user:\s*(.*?)\s*(bot:)?\s*$", re.IGNORECASE | re.DOTALL)
+
+
+def extract_user_query(text: str) -> str:
+    """Strip the 'User: ...\\nBot:' wrapper used by the /chat route."""
+    match = CHAT_WRAPPER_RE.match(text)
+    return match.group(1) if match else text
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, NFC-normalize and drop punctuation so near-identical questions compare equal."""
+    text = unicodedata.normalize("NFC", extract_user_query(text)).lower()
+    return " ".join(WORD_RE.findall(text))
+
+
+def question_key(text: str) -> str:
+    """Casefolded, whitespace-collapsed question; unlike normalize_text it keeps symbols, so "C#" is not "C++"."""
+    text = unicodedata.normalize("NFC", extract_user_query(text)).casefold()
+    return " ".join(text.split()).rstrip("?.! ")
+
+
+def tokenize(text: str) -> list[str]:
+    return WORD_RE.findall(normalize_text(text))
+
+
+def text_vector(text: str, ngram: int = 3) -> dict[str, float]:
+    """Sparse L2-normalized bag of words plus character n-grams.
+
+    Character n-grams make the vector tolerant to typos and inflections
+    ("define" / "definition") without any model or API call.
+    """
+    features = Counter()
+    for token in tokenize(text):
+        features["w:" + token] += 1.0
+        padded = f" {token} "
+        for i in range(max(len(padded) - ngram + 1, 1)):
+            features["c:" + padded[i:i + ngram]] += 0.5
+    norm = math.sqrt(sum(v * v for v in features.values()))
+    if not norm:
+        return {}
+    return {k: v / norm for k, v in features.items()}
+
+
+def cosine(a: dict[str, float], b: dict[str, float]) -> float:
+    """Cosine similarity of two vectors produced by text_vector."""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
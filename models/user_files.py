@@ -2,6 +2,7 @@ import sqlite3
 import json
 from typing import List, Optional
 import os
+import time
 
 class UserFileDB:
     def __init__(self, db_path: str):
@@ -16,6 +17,26 @@ class UserFileDB:
                 file_paths TEXT
             )
         ''')
+        # Files of a user that point to a shared, content-addressed document.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_documents (
+                user_id TEXT,
+                file_name TEXT,
+                doc_id TEXT,
+                PRIMARY KEY (user_id, file_name)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_documents_doc_id ON user_documents(doc_id)')
+        # Deleted files whose nodes are hidden from retrieval until the collection is compacted.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tombstones (
+                collection TEXT,
+                file_name TEXT,
+                nodes INTEGER,
+                created_at REAL,
+                PRIMARY KEY (collection, file_name)
+            )
+        ''')
         self.conn.commit()
 
     def insert_user_files(self, user_id: str, file_paths: List[str]):
@@ -36,6 +57,62 @@ class UserFileDB:
         self.cursor.execute('DELETE FROM user_files WHERE user_id = ?', (user_id,))
         self.conn.commit()
 
+    def add_user_document(self, user_id: str, file_name: str, doc_id: str):
+        self.cursor.execute('''
+            INSERT INTO user_documents (user_id, file_name, doc_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, file_name) DO UPDATE SET doc_id=excluded.doc_id
+        ''', (user_id, file_name, doc_id))
+        self.conn.commit()
+
+    def get_user_document_ids(self, user_id: str, file_names: Optional[List[str]] = None) -> List[str]:
+        if file_names is None:
+            self.cursor.execute('SELECT DISTINCT doc_id FROM user_documents WHERE user_id = ?', (user_id,))
+        else:
+            placeholders = ",".join("?" * len(file_names))
+            self.cursor.execute(
+                f'SELECT DISTINCT doc_id FROM user_documents WHERE user_id = ? AND file_name IN ({placeholders})',
+                (user_id, *file_names)
+            )
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def remove_user_document(self, user_id: str, file_name: str) -> Optional[str]:
+        """Drop the user's reference to a file, returns the doc_id it pointed to."""
+        self.cursor.execute(
+            'SELECT doc_id FROM user_documents WHERE user_id = ? AND file_name = ?', (user_id, file_name)
+        )
+        result = self.cursor.fetchone()
+        self.cursor.execute('DELETE FROM user_documents WHERE user_id = ? AND file_name = ?', (user_id, file_name))
+        self.conn.commit()
+        return result[0] if result else None
+
+    def count_document_references(self, doc_id: str) -> int:
+        self.cursor.execute('SELECT COUNT(*) FROM user_documents WHERE doc_id = ?', (doc_id,))
+        return self.cursor.fetchone()[0]
+
+    def add_tombstone(self, collection: str, file_name: str, nodes: int):
+        self.cursor.execute('''
+            INSERT INTO tombstones (collection, file_name, nodes, created_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(collection, file_name) DO UPDATE SET nodes=excluded.nodes, created_at=excluded.created_at
+        ''', (collection, file_name, nodes, time.time()))
+        self.conn.commit()
+
+    def get_tombstones(self, collection: str) -> List[str]:
+        self.cursor.execute('SELECT file_name FROM tombstones WHERE collection = ?', (collection,))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def get_tombstoned_collections(self) -> List[str]:
+        self.cursor.execute('SELECT DISTINCT collection FROM tombstones')
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def remove_tombstones(self, collection: str, file_names: List[str]):
+        self.cursor.executemany(
+            'DELETE FROM tombstones WHERE collection = ? AND file_name = ?',
+            [(collection, file_name) for file_name in file_names]
+        )
+        self.conn.commit()
+
     def close(self):
         self.conn.close()
     def delete_all_users(self):
@@ -9,6 +9,9 @@ import random
 import urllib3
 from cachetools import TTLCache
 import logging
+import asyncio
+import json
+from models.config import selected_web_url, max_number_of_posts
 
 # Thiết lập logging để debug hiệu suất
 logging.basicConfig(level=logging.INFO)
@@ -27,10 +30,41 @@ class Config:
 articles_cache = TTLCache(maxsize=1, ttl=Config.CACHE_TTL)
 content_cache = TTLCache(maxsize=100, ttl=Config.CACHE_TTL)
 
+def fetch_page(url: str) -> BeautifulSoup:
+    """Tải và phân tích HTML của một URL."""
+    response = requests.get(url, verify=False, timeout=Config.REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    # Phân tích HTML
+    return BeautifulSoup(response.text, 'html.parser')
+
+def fetch_latest_news(url: str = selected_web_url, limit: int = max_number_of_posts) -> list[dict]:
+    """Lấy danh sách tin mới nhất (tiêu đề + link), có cache."""
+    if url in articles_cache:
+        logger.info("Fetching articles from cache")
+        return articles_cache[url]
+
+    soup = fetch_page(url)
+    articles = []
+    seen_links = set()
+    for container in soup.find_all(['article', 'h2', 'h3', 'h6']):
+        link_tag = container.find('a', href=True)
+        if not link_tag or not link_tag.text.strip() or link_tag['href'] in seen_links:
+            continue
+        seen_links.add(link_tag['href'])
+        articles.append({'title': link_tag.text.strip(), 'link': link_tag['href']})
+        if len(articles) >= limit:
+            break
+
+    articles_cache[url] = articles
+    return articles
+
 class WebScraperQueryEngine(CustomQueryEngine):
     """Custom query engine for scraping IELTS vocabulary articles from ielts-fighter.com."""
 
     llm: GoogleGenAI | None = Field(default=None)
+    # Return the scraped data itself and let the caller write the single final answer.
+    raw_output: bool = Field(default=False)
 
     # def fetch_articles(self, custom_url=None):
     #     """Lấy danh sách bài viết từ ielts-fighter.com hoặc URL tùy chỉnh, sử dụng cache nếu có."""
@@ -110,17 +144,9 @@ class WebScraperQueryEngine(CustomQueryEngine):
     #     logger.info("Articles cached successfully")
     #     return article_list
 
-    def custom_query(self, query_str: str, custom_url: str = None):
-        """Xử lý truy vấn người dùng dựa trên bài viết được cào."""
-        logger.info(f"Processing query: {query_str}")
-        # Lấy danh sách bài viết
-        # articles = self.fetch_articles(custom_url)
-        if(custom_url):
-            response = requests.get(custom_url, verify=False, timeout=Config.REQUEST_TIMEOUT)
-            response.raise_for_status()
-                    
-                    # Phân tích HTML
-            soup = BeautifulSoup(response.text, 'html.parser')
+    def build_prompt(self, query_str: str, soup: BeautifulSoup | None = None):
+        """Tạo prompt cho LLM từ câu hỏi và nội dung trang (nếu có)."""
+        if soup is not None:
             # if not articles:
             #     logger.error("No articles found")
             #     raise HTTPException(status_code=404, detail="No articles found")
@@ -129,7 +155,7 @@ class WebScraperQueryEngine(CustomQueryEngine):
             # selected_article = articles[0] if custom_url else random.choice(articles)
             
             # Tạo prompt cho LLM
-            prompt = (
+            return (
                 f"Based on the following article content, please answer the user's question about IELTS vocabulary.\n\n"
                 f"User's question: {query_str}\n\n"
                 # f"Article title: {selected_article['title']}\n"
@@ -152,11 +178,27 @@ class WebScraperQueryEngine(CustomQueryEngine):
                 # f"Please ensure each section is clearly separated and formatted with proper markdown syntax."
             )
         else:
-            prompt = (
+            return (
                 f"User's question: {query_str}\n"
                 # f"Article title: {selected_article['title']}\n"
                 # f"Article content:\n{selected_article['content']}\n\n"
             )
+
+    def raw_data(self, soup: BeautifulSoup | None = None) -> str:
+        """Dữ liệu thô cho bước trả lời cuối: nội dung trang hoặc danh sách tin mới nhất."""
+        if soup is not None:
+            return soup.get_text(separator='\n', strip=True)
+        return json.dumps(fetch_latest_news(), ensure_ascii=False)
+
+    def custom_query(self, query_str: str, custom_url: str = None):
+        """Xử lý truy vấn người dùng dựa trên bài viết được cào."""
+        logger.info(f"Processing query: {query_str}")
+        # Lấy danh sách bài viết
+        # articles = self.fetch_articles(custom_url)
+        soup = fetch_page(custom_url) if custom_url else None
+        if self.raw_output:
+            return self.raw_data(soup)
+        prompt = self.build_prompt(query_str, soup)
         # Gọi LLM
         try:
             logger.info("Calling LLM for response")
@@ -168,6 +210,22 @@ class WebScraperQueryEngine(CustomQueryEngine):
                 # },
                 "response": str(answer)
             }
+        except Exception as e:
+            logger.error(f"Error processing query with LLM: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error processing query with LLM: {str(e)}")
+
+    async def acustom_query(self, query_str: str, custom_url: str = None):
+        """Phiên bản bất đồng bộ của custom_query."""
+        logger.info(f"Processing query: {query_str}")
+        soup = await asyncio.to_thread(fetch_page, custom_url) if custom_url else None
+        if self.raw_output:
+            return await asyncio.to_thread(self.raw_data, soup)
+        prompt = self.build_prompt(query_str, soup)
+        # Gọi LLM
+        try:
+            logger.info("Calling LLM for response")
+            answer = await self.llm.acomplete(prompt)
+            return {"response": str(answer)}
         except Exception as e:
             logger.error(f"Error processing query with LLM: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error processing query with LLM: {str(e)}")
\ No newline at end of file
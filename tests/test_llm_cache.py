@@ -0,0 +1,78 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from google.genai import types
+from google.genai.models import Models
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
+from llama_index.llms.google_genai import GoogleGenAI
+
+from models.llm_cache import CachedGoogleGenAI, CompletionCache
+from models.llm_pool import RateLimiter
+
+
+@pytest.fixture
+def gemini_calls():
+    """Patches the Gemini API: the model lookup, and chat calls answering with the prompt."""
+    calls = []
+
+    def chat(self, messages, **kwargs):
+        calls.append(messages[-1].content)
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=f"answer to {messages[-1].content}"))
+
+    async def achat(self, messages, **kwargs):
+        return chat(self, messages, **kwargs)
+
+    model = types.Model(name="models/gemini-test", input_token_limit=1000, output_token_limit=100)
+    with mock.patch.object(Models, "get", return_value=model), \
+            mock.patch.object(GoogleGenAI, "chat", chat), \
+            mock.patch.object(GoogleGenAI, "achat", achat):
+        yield calls
+
+
+@pytest.fixture
+def llm(tmp_path, gemini_calls):
+    cache = CompletionCache(str(tmp_path / "llm_cache.db"))
+    return CachedGoogleGenAI(model="gemini-test", api_key="test", cache=cache)
+
+
+@pytest.fixture
+def limited_llm(gemini_calls):
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=10 ** 6, max_concurrency=1)
+    return CachedGoogleGenAI(model="gemini-test", api_key="test", limiter=limiter)
+
+
+def test_complete_is_cached(llm, gemini_calls):
+    assert llm.complete("hello").text == "answer to hello"
+    assert llm.complete("hello").text == "answer to hello"
+    assert gemini_calls == ["hello"]
+
+
+def test_acomplete_is_cached(llm, gemini_calls):
+    assert asyncio.run(llm.acomplete("hello")).text == "answer to hello"
+    assert asyncio.run(llm.acomplete("hello")).text == "answer to hello"
+    assert gemini_calls == ["hello"]
+
+
+def test_chat_takes_a_limiter_slot(limited_llm, gemini_calls):
+    response = limited_llm.chat([ChatMessage(role=MessageRole.USER, content="hello")])
+    assert response.message.content == "answer to hello"
+    assert limited_llm._limiter.stats()["total_requests"] == 1
+
+
+def test_use_cache_false_calls_gemini(llm, gemini_calls):
+    llm.complete("hello")
+    llm.complete("hello", use_cache=False)
+    assert gemini_calls == ["hello", "hello"]
+
+
+def test_complete_takes_a_single_limiter_slot(limited_llm, gemini_calls):
+    # The completion runs through chat: a second, nested slot would never be granted with max_concurrency=1.
+    assert limited_llm.complete("hello").text == "answer to hello"
+    assert asyncio.run(limited_llm.acomplete("hello")).text == "answer to hello"
+    assert limited_llm._limiter.stats()["total_requests"] == 2
+
+
+def test_complete_writes_one_cache_entry(llm, gemini_calls):
+    llm.complete("hello")
+    assert llm._cache.stats()["memory_entries"] == 1